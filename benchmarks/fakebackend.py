@@ -0,0 +1,86 @@
+# An in-process stand-in for Crossref and arXiv, which answers requests with
+# synthetic but realistic-looking metadata derived from the arXiv ID or DOI.
+# Install it with imbibe.backend.set_backend(FakeBackend()).
+
+import time
+import zlib
+import threading
+
+given_names = [ 'José', 'Zoë', 'Anna', 'Wei', 'Ólafur', 'Priya', 'John', 'Łucja' ]
+family_names = [ 'Pérez', 'Ng', 'Smith', 'Ødegård', 'Müller', 'van der Berg', 'Kitaev', 'Öztürk' ]
+title_words = [ 'Topological', 'phases', 'of', 'matter', 'in', 'α-RuCl$_3$', 'Schrödinger',
+                'naïve', 'SU(2)', '<i>ab initio</i>', 'Kitaev', 'Γ-point', 'Hall', 'effect',
+                'quantum', 'spin', 'liquids', 'the', 'and', 'a', 'fermions', 'Majorana', 'Dirac' ]
+journals = [ ('Physical Review B', 'Phys. Rev. B'), ('Physical Review Letters', 'Phys. Rev. Lett.'),
+             ('Nature Physics', 'Nat. Phys.'), ('Journal of Made-up Results', 'J. Made-up Res.') ]
+
+def _pick(seq, seed, n):
+    return [ seq[(seed >> (3*i)) % len(seq)] for i in range(n) ]
+
+def _seed(s):
+    return zlib.crc32(s.encode('utf-8'))
+
+def arxiv_doi(arxivid):
+    # Every second paper has been published.
+    if _seed(arxivid) % 2 == 0:
+        return '10.5555/bench.' + arxivid
+    return None
+
+class FakeBackend(object):
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = { 'crossref': 0, 'arxiv': 0, 'http': 0 }
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def authors(self, seed):
+        n = 1 + seed % 6
+        return [ (given, family) for given,family in
+                 zip(_pick(given_names, seed, n), _pick(family_names, seed >> 1, n)) ]
+
+    def title(self, seed):
+        return ' '.join(_pick(title_words, seed, 4 + seed % 8)).capitalize()
+
+    def arxiv_result(self, arxivid):
+        seed = _seed(arxivid)
+        return { 'id': 'http://arxiv.org/abs/' + arxivid + 'v1',
+                 'authors': [ given + ' ' + family for given,family in self.authors(seed) ],
+                 'title': self.title(seed),
+                 'summary': ' '.join(_pick(title_words, seed, 20)) * 5,
+                 'doi': arxiv_doi(arxivid) }
+
+    def crossref_item(self, doi):
+        seed = _seed(doi.lower())
+        journal,journal_short = journals[seed % len(journals)]
+        return { 'DOI': doi,
+                 'type': 'journal-article',
+                 'container-title': [ journal ],
+                 'short-container-title': [ journal_short ],
+                 'author': [ { 'given': given, 'family': family } for given,family in self.authors(seed) ],
+                 'publisher': 'Benchmark Publishing',
+                 'issued': { 'date-parts': [ [ 1995 + seed % 30 ] ] },
+                 'title': [ self.title(seed) ],
+                 'volume': str(seed % 120),
+                 'page': str(seed % 9000) + '-' + str(seed % 9000 + 10) }
+
+    def crossref_works(self, ids=None, filter=None, limit=None, **kwargs):
+        self.count('crossref')
+        if ids is not None:
+            return { 'message': self.crossref_item(ids) }
+        return { 'message': { 'items': [ self.crossref_item(doi) for doi in filter.get('doi', []) ] } }
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        self.count('arxiv')
+        return [ self.arxiv_result(arxivid) for arxivid in (id_list or []) ][:max_results]
+
+    def http_get(self, url):
+        self.count('http')
+        return url, b''
+
+    def save(self):
+        pass
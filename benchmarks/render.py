@@ -0,0 +1,95 @@
+# Measures the throughput of BibTeX rendering (BibItem.output_bib writing to a
+# BibtexWriter) on large synthetic sets of entries. Run as
+#
+#     python benchmarks/render.py [--sizes 1000 10000 50000] [--output results.json]
+#
+# from the repository root.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import imbibe
+
+words = [ 'Topological', 'phases', 'of', 'matter', 'in', 'α-RuCl₃', 'Schrödinger', 'Łódź',
+          'naïve', 'x−y', 'SU(2)', '$\\alpha_{1}$', 'Kitaev', 'Γ-point', 'Hall', 'effect',
+          'Quantum', 'spin', 'liquids', 'the', 'and', 'a', 'fermions', 'Café' ]
+journals = [ 'Physical Review B', 'Physical Review Letters', 'Nature Physics', 'Some Unknown Journal' ]
+
+def make_bibitems(n, seed=0):
+    rng = random.Random(seed)
+    def text(nwords):
+        return ' '.join(rng.choice(words) for i in range(nwords))
+
+    bibitems = []
+    for i in range(n):
+        bibitem = imbibe.BibItem(arxivid='%04d.%05d' % (1000 + i % 1200, i))
+        bibitem.bibtex_id = None
+        bibitem.suppress_volumewarning = True
+        bibitem.comment = None
+        bibitem.extra_bibtex_fields = { 'addendum': text(3) } if i % 4 == 0 else {}
+        authors = [ rng.choice(['José', 'Zoë', 'Anna', 'Wei']) + ' ' +
+                    rng.choice(['Pérez', 'Ng', 'Smith', 'Ødegård']) for j in range(rng.randint(1,6)) ]
+        bibitem.apply_arxiv_record({ 'authors': authors, 'title': text(rng.randint(4, 14)),
+                                     'abstract': text(120), 'doi': None })
+        if i % 2 == 0:
+            bibitem.doi = '10.1103/Bench.%d' % i
+            bibitem.apply_doi_record({
+                'type': 'journal-article', 'journal': rng.choice(journals), 'journal_short': '',
+                'detailed_authors': [ { 'family': a.split()[1], 'given': a.split()[0] } for a in authors ],
+                'publisher': 'Publisher', 'year': 2000 + i % 25, 'title': text(rng.randint(4, 14)),
+                'volume': str(i % 100), 'page': str(i) })
+        bibitems.append(bibitem)
+    return bibitems
+
+def run(n, bibtex_encoding, repeat):
+    bibitems = make_bibitems(n)
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        out = imbibe.BibtexWriter(bibtex_encoding)
+        for bibitem in bibitems:
+            bibitem.output_bib(True, out)
+        text = out.getvalue()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return { 'entries': n, 'bibtex_encoding': bibtex_encoding, 'seconds': best,
+             'entries_per_second': n / best, 'output_bytes': len(text.encode('utf-8')) }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs='+', default=[ 1000, 10000, 50000 ])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    # The journal abbreviation index and lock files shouldn't go into the
+    # user's cache directory.
+    with tempfile.TemporaryDirectory(prefix='imbibe-bench-cache-') as cachedir:
+        os.environ['IMBIBE_CACHE_DIR'] = cachedir
+        imbibe.args = argparse.Namespace(eprint_as_note=False, suppress_optional_fields=False,
+                                         bibtex_encoding=False)
+        imbibe.get_journal_abbreviations()
+
+        results = []
+        for n in args.sizes:
+            for bibtex_encoding in (False, True):
+                result = run(n, bibtex_encoding, args.repeat)
+                print("%7d entries, bibtex_encoding=%-5s: %8.0f entries/s" %
+                      (n, bibtex_encoding, result['entries_per_second']), file=sys.stderr)
+                results.append(result)
+
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump({ 'benchmark': 'render', 'results': results }, f, indent=2)
+        else:
+            json.dump({ 'benchmark': 'render', 'results': results }, sys.stdout, indent=2)
+            print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Regression check for imbibe's startup cost. Run as
+#
+#     python benchmarks/startup.py
+#
+# from the repository root. It fails (exit status 1) if importing imbibe pulls
+# in any of the heavy dependencies that should only be loaded on demand, or if
+# a run whose entries are all already cached takes longer than the budget. The
+# budget applies to the time on top of starting a bare interpreter, so that it
+# doesn't depend on how slow the local Python installation is to start.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+repodir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repodir)
+
+lazy_modules = [ 'arxiv', 'habanero', 'lxml', 'bibtexparser', 'titlecase', 'progressbar',
+                 'unidecode', 'urllib.request', 'concurrent.futures', 'requests', 'httpx' ]
+
+def subprocess_env(cachedir):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = repodir + os.pathsep + env.get('PYTHONPATH', '')
+    env['IMBIBE_CACHE_DIR'] = cachedir
+    return env
+
+def imported_modules(env):
+    out = subprocess.run([ sys.executable, '-X', 'importtime', '-c', 'import imbibe' ],
+                         env=env, stderr=subprocess.PIPE, check=True, text=True).stderr
+    modules = set()
+    for line in out.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip())
+    return modules
+
+def make_warm_project(dirname, nentries):
+    import imbibe
+
+    lines = [ '%04d.%05d' % (1000 + i % 1200, i) for i in range(nentries) ]
+    with open(os.path.join(dirname, 'refs.txt'), 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+    imbibe.BibItem.load_cache(os.path.join(dirname, 'imbibe-cache.json'))
+    for i,line in enumerate(lines):
+        imbibe.BibItem.cache.put(imbibe.arxiv_cache_key(line), {
+            'authors': [ 'Author%d Lastname%d' % (i,j) for j in range(3) ],
+            'title': 'A synthetic paper about Topological Phases, number %d' % i,
+            'abstract': 'An abstract. ' * 40,
+            'doi': None })
+    imbibe.BibItem.save_cache()
+
+def median_run_time(cmd, dirname, env, repeat):
+    # The first run is a warm-up (e.g. it builds the journal abbreviation index).
+    subprocess.run(cmd, cwd=dirname, env=env, check=True)
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=dirname, env=env, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=100.,
+            help="Maximum median wall time of a fully cached run, not counting "
+                 "interpreter startup (default: 100).")
+    parser.add_argument("--entries", type=int, default=20,
+            help="Number of entries in the cached project (default: 20).")
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as dirname:
+        env = subprocess_env(os.path.join(dirname, 'usercache'))
+
+        eager = sorted(m for m in imported_modules(env) if m in lazy_modules)
+        if len(eager) > 0:
+            print("FAIL: 'import imbibe' imports " + ', '.join(eager))
+            failed = True
+        else:
+            print("ok: 'import imbibe' imports none of the on-demand dependencies")
+
+        os.environ['IMBIBE_CACHE_DIR'] = env['IMBIBE_CACHE_DIR']
+        make_warm_project(dirname, args.entries)
+        baseline = median_run_time([ sys.executable, '-c', 'pass' ], dirname, env, args.repeat)
+        runtime = median_run_time([ sys.executable, '-m', 'imbibe', 'refs.txt', 'out.bib' ],
+                                  dirname, env, args.repeat)
+        overhead_ms = 1000*(runtime - baseline)
+        status = "ok" if overhead_ms <= args.budget_ms else "FAIL"
+        print("%s: warm-cache run with %d entries took %.1f ms on top of %.1f ms interpreter startup"
+              " (median of %d, budget %.0f ms)"
+              % (status, args.entries, overhead_ms, 1000*baseline, args.repeat, args.budget_ms))
+        failed = failed or status == "FAIL"
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
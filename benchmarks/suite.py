@@ -0,0 +1,210 @@
+# Offline benchmark suite. Run as
+#
+#     python benchmarks/suite.py [--sizes 100 1000 10000 100000] [--output results.json]
+#
+# from the repository root. The end-to-end benchmarks run imbibe's main() in
+# this process on synthetic refs.txt files, with Crossref and arXiv replaced by
+# the in-process FakeBackend, once with an empty cache ("cold") and then again
+# with everything cached ("warm"). The microbenchmarks time the text
+# processing functions and loading and saving the cache. The results are
+# written as JSON, to stdout unless --output is given.
+
+import os
+import sys
+import json
+import time
+import timeit
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+repodir = os.path.dirname(benchdir)
+sys.path.insert(0, repodir)
+sys.path.insert(0, benchdir)
+
+import imbibe
+from imbibe import backend
+from fakebackend import FakeBackend
+
+# imbibe's messages and progress bars are sent here. It's never closed, since
+# progressbar keeps hold of the stream it first wrote to.
+devnull = open(os.devnull, 'w')
+
+def synthetic_lines(n):
+    # About 80% arXiv IDs, some with options, and 20% DOIs.
+    lines = []
+    for i in range(n):
+        arxivid = '%02d%02d.%05d' % (10 + i % 14, 1 + i % 12, i)
+        if i % 5 == 4:
+            lines.append('doi:10.5555/bench.doi.%d [bibtex_id:Doi%d]' % (i,i))
+        elif i % 7 == 0:
+            lines.append(arxivid + ' [bibtex_id:Key%d, addendum:Some note with Ünïcode %d]' % (i,i))
+        else:
+            lines.append(arxivid)
+    return lines
+
+def reset_imbibe_state():
+    imbibe.BibItem.cache = None
+    imbibe.BibItem.shared_cache = None
+
+def run_main(argv):
+    fake = FakeBackend()
+    backend.set_backend(fake)
+    reset_imbibe_state()
+    sys.argv = [ 'imbibe' ] + argv
+    with contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        imbibe.main()
+        elapsed = time.perf_counter() - start
+    return elapsed, fake.requests
+
+def end_to_end(n, cache_backend):
+    dirname = tempfile.mkdtemp(prefix='imbibe-bench-')
+    olddir = os.getcwd()
+    try:
+        os.chdir(dirname)
+        with open('refs.txt', 'w') as f:
+            f.write('\n'.join(synthetic_lines(n)) + '\n')
+        argv = [ '--no-shared-cache', '--cache-backend', cache_backend, '--crossref-rate', '0',
+                 'refs.txt', 'refs.bib' ]
+        results = []
+        for phase in ('cold', 'warm'):
+            elapsed, requests = run_main(argv)
+            results.append({ 'benchmark': 'end_to_end', 'phase': phase, 'entries': n,
+                             'cache_backend': cache_backend, 'seconds': elapsed,
+                             'entries_per_second': n / elapsed, 'requests': requests })
+        return results
+    finally:
+        os.chdir(olddir)
+        shutil.rmtree(dirname)
+
+def time_call(fn, repeat):
+    # Best time per call, using enough calls to take at least 0.2 seconds.
+    timer = timeit.Timer(fn)
+    number,_ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+sample_titles = [
+    'Topological phases of matter in α-RuCl₃ and the Kitaev model',
+    'Quantum spin liquids: SCHRÖDINGER CATS IN THE {Γ}-POINT',
+    'A plain ASCII title about the Hall effect in two dimensions',
+    'Majorana fermions in <i>ab initio</i> models of SU(2) <sub>2</sub> anyons',
+]
+sample_crossref_titles = [
+    'Plain title without any markup',
+    'Observation of the <i>ν</i>=5/2 state in Ga<sub>1−x</sub>Al<sub>x</sub>As &amp; friends',
+    'Spin liquids in α-RuCl<sub>3</sub> and <b>Kitaev</b> materials',
+]
+sample_texts = [ 'Ødegård, Zoë and Pérez, José and Müller, Łucja', 'Smith, John and Ng, Wei' ]
+
+def micro(repeat):
+    benchmarks = {
+        'process_text': lambda: [ imbibe.process_text(t, False) for t in sample_texts + sample_titles ],
+        'process_text_bibtex_encoding':
+            lambda: [ imbibe.process_text(t, True) for t in sample_texts + sample_titles ],
+        'protect_words': lambda: [ imbibe.protect_words(t) for t in sample_titles ],
+        'crossref_title_to_latex':
+            lambda: [ imbibe.crossref_title_to_latex(t) for t in sample_crossref_titles ],
+        'encode_latex_accents': lambda: [ imbibe.encode_latex_accents(t) for t in sample_texts + sample_titles ],
+        'bibtex_escape': lambda: [ imbibe.bibtex_escape(t) for t in sample_titles + [ '{Unmatched} brace}' ] ],
+        'load_journal_abbreviations': lambda: imbibe.load_journal_abbreviations(),
+    }
+    results = []
+    for name,fn in benchmarks.items():
+        results.append({ 'benchmark': 'micro', 'name': name, 'seconds_per_call': time_call(fn, repeat) })
+    return results
+
+def cache_io(n, cache_backend, repeat):
+    # Loading and saving a project cache with n arXiv entries, after changing
+    # one of them.
+    dirname = tempfile.mkdtemp(prefix='imbibe-bench-')
+    try:
+        filename = os.path.join(dirname, 'imbibe-cache.' + cache_backend)
+        fake = FakeBackend()
+        reset_imbibe_state()
+        imbibe.BibItem.use_shared_cache = False
+        with contextlib.redirect_stderr(devnull):
+            imbibe.BibItem.load_cache(filename, cache_backend)
+        for line in synthetic_lines(n):
+            imbibe.BibItem.cache.put(imbibe.arxiv_cache_key(line),
+                    imbibe.arxiv_result_to_record(fake.arxiv_result(line)))
+        imbibe.BibItem.save_cache()
+        imbibe.BibItem.cache.close()
+
+        def load():
+            if imbibe.BibItem.cache is not None:
+                imbibe.BibItem.cache.close()
+            imbibe.BibItem.load_cache(filename, cache_backend)
+        def save():
+            key = imbibe.arxiv_cache_key(synthetic_lines(1)[0])
+            record = dict(imbibe.BibItem.cache.get(key))
+            record['title'] += ' '
+            imbibe.BibItem.cache.put(key, record)
+            imbibe.BibItem.save_cache()
+
+        load_time = time_call(load, repeat)
+        save_time = time_call(save, repeat)
+        imbibe.BibItem.cache.close()
+        return [ { 'benchmark': 'micro', 'name': 'BibItem.load_cache', 'entries': n,
+                   'cache_backend': cache_backend, 'seconds_per_call': load_time },
+                 { 'benchmark': 'micro', 'name': 'BibItem.save_cache', 'entries': n,
+                   'cache_backend': cache_backend, 'seconds_per_call': save_time } ]
+    finally:
+        reset_imbibe_state()
+        shutil.rmtree(dirname)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs='+', default=[ 100, 1000, 10000, 100000 ],
+            help="Numbers of lines of the synthetic refs.txt files for the end-to-end runs.")
+    parser.add_argument("--cache-backends", nargs='+', choices=[ 'json', 'sqlite' ],
+            default=[ 'json', 'sqlite' ], dest='cache_backends')
+    parser.add_argument("--cache-entries", type=int, default=10000, dest='cache_entries',
+            help="Number of entries in the cache for the load_cache/save_cache benchmarks.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--no-end-to-end", action='store_false', dest='end_to_end')
+    parser.add_argument("--no-micro", action='store_false', dest='micro')
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    # The benchmarks shouldn't read or write the user's shared cache.
+    cachedir = tempfile.mkdtemp(prefix='imbibe-bench-cache-')
+    os.environ['IMBIBE_CACHE_DIR'] = cachedir
+
+    results = []
+    try:
+        if args.micro:
+            imbibe.args = argparse.Namespace(bibtex_encoding=False)
+            results += micro(args.repeat)
+            for cache_backend in args.cache_backends:
+                results += cache_io(args.cache_entries, cache_backend, args.repeat)
+        if args.end_to_end:
+            for n in args.sizes:
+                for cache_backend in args.cache_backends:
+                    results += end_to_end(n, cache_backend)
+    finally:
+        shutil.rmtree(cachedir)
+
+    for result in results:
+        if result['benchmark'] == 'micro':
+            print("%-32s %-7s %10.1f us" % (result['name'], result.get('cache_backend', ''),
+                  1e6*result['seconds_per_call']), file=sys.stderr)
+        else:
+            print("end-to-end %-4s %7d entries %-7s %8.2f s  %8.0f entries/s" % (result['phase'],
+                  result['entries'], result['cache_backend'], result['seconds'],
+                  result['entries_per_second']), file=sys.stderr)
+
+    report = { 'python': platform.python_version(), 'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'results': results }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
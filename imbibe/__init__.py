@@ -1,44 +1,53 @@
-import arxiv
 import sys
-import habanero
 import re
 import os
 import os.path
-import html
-import unidecode
 import argparse
 import time
-import progressbar
 import json
-import inspect
-import urllib.request
-import bibtexparser
-import titlecase
 import unicodedata
-from lxml import etree
+import threading
+import functools
 from io import StringIO
+from imbibe import profiling
+
+# Most runs are served entirely from the cache, so the network clients, the
+# heavier third-party modules and the data tables below are only imported or
+# loaded the first time a code path actually needs them.
 
 try:
     from imbibe.opts import optional_bibtex_fields
 except ModuleNotFoundError:
     from imbibe.opts_default import optional_bibtex_fields
 
-try:
-    with open("capitalized_words.txt", "r") as f:
-        protected_words = [ line.rstrip("\n") for line in f ]
-except FileNotFoundError:
-    protected_words = []
-protected_words = set(protected_words)
-protected_words_uppercase = dict( (word.upper(),word) for word in protected_words )
+@functools.lru_cache(maxsize=None)
+def get_protected_words():
+    try:
+        with open("capitalized_words.txt", "r") as f:
+            protected_words = [ line.rstrip("\n") for line in f ]
+    except FileNotFoundError:
+        protected_words = []
+    return set(protected_words)
 
-def thisdir():
-    thisfile = inspect.getfile(inspect.currentframe())
-    thisdir = os.path.dirname(thisfile)
-    return thisdir
+@functools.lru_cache(maxsize=None)
+def get_protected_words_uppercase():
+    return dict( (word.upper(),word) for word in get_protected_words() )
 
-def load_journal_abbreviations():
-    abbrev = {}
+def thisdir():
+    return os.path.dirname(os.path.abspath(__file__))
+
+def user_cache_dir():
+    if 'IMBIBE_CACHE_DIR' in os.environ:
+        return os.environ['IMBIBE_CACHE_DIR']
+    elif sys.platform == 'win32' and 'LOCALAPPDATA' in os.environ:
+        base = os.environ['LOCALAPPDATA']
+    elif 'XDG_CACHE_HOME' in os.environ:
+        base = os.environ['XDG_CACHE_HOME']
+    else:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'imbibe')
 
+def journal_abbreviation_sources():
     import_order = [ 
       'journals/journal_abbreviations_acs.csv',
       'journals/journal_abbreviations_mathematics.csv',
@@ -56,7 +65,14 @@ def load_journal_abbreviations():
     import_order = [ os.path.join(thisdir(), filename) for filename in import_order ]
     custom_journals_filename = "journal_abbrev.csv"
     if os.path.exists(custom_journals_filename):
-        import_order += [ custom_journals_filename ]
+        import_order += [ os.path.abspath(custom_journals_filename) ]
+    return import_order
+
+def load_journal_abbreviations(import_order=None):
+    abbrev = {}
+
+    if import_order is None:
+        import_order = journal_abbreviation_sources()
     
     for filename in import_order:
         with open(filename, "r", encoding='utf-8') as f:
@@ -69,7 +85,36 @@ def load_journal_abbreviations():
 
                     abbrev[name] = name_abbrev
     return abbrev
-journal_abbreviations = load_journal_abbreviations()
+
+def load_journal_abbreviation_index():
+    # Returns a precompiled, memory-mapped index of the abbreviation tables,
+    # falling back to parsing them into a dict if the index can't be written.
+    import hashlib
+    from imbibe import abbrevindex
+
+    sources = journal_abbreviation_sources()
+    key = hashlib.sha1('\0'.join(sources).encode('utf-8')).hexdigest()[0:16]
+    filename = os.path.join(user_cache_dir(), 'journal-abbreviations-' + key + '.idx')
+    try:
+        return abbrevindex.open_index(filename, sources,
+                lambda: load_journal_abbreviations(sources))
+    except OSError as e:
+        print("Warning: could not use journal abbreviation index " + filename + ": " + str(e),
+                file=sys.stderr)
+        return load_journal_abbreviations(sources)
+
+@functools.lru_cache(maxsize=None)
+def get_journal_abbreviations():
+    return load_journal_abbreviation_index()
+
+def reload_journal_abbreviations():
+    # Makes the next get_journal_abbreviations() read them again, closing the
+    # memory-mapped index currently in use (if any).
+    if get_journal_abbreviations.cache_info().currsize > 0:
+        abbreviations = get_journal_abbreviations()
+        if hasattr(abbreviations, 'close'):
+            abbreviations.close()
+    get_journal_abbreviations.cache_clear()
 
 def load_journal_aliases():
     filename = os.path.join(thisdir(), 'journal_aliases.txt')
@@ -87,14 +132,37 @@ def load_journal_aliases():
     if len(current_set) != 0:
         raise RuntimeError("Syntax error in journal_aliases.txt")
     return aliases
-journal_aliases = load_journal_aliases()
 
-cr = habanero.Crossref(ua_string = "imbibe")
+@functools.lru_cache(maxsize=None)
+def get_journal_aliases():
+    return load_journal_aliases()
+
+@functools.lru_cache(maxsize=None)
+def get_crossref_client():
+    from imbibe import backend
+    return backend.crossref_client()
+
+_lazy_globals = {
+        'journal_abbreviations': get_journal_abbreviations,
+        'journal_aliases': get_journal_aliases,
+        'protected_words': get_protected_words,
+        'protected_words_uppercase': get_protected_words_uppercase,
+        'cr': get_crossref_client,
+        }
+def __getattr__(name):
+    # Keeps the data tables and Crossref client available as module
+    # attributes (e.g. imbibe.cr) for code outside this module.
+    if name in _lazy_globals:
+        return _lazy_globals[name]()
+    raise AttributeError("module 'imbibe' has no attribute '" + name + "'")
 
 def unescape_string(s):
     return re.sub(r'(?<!\\)\\', '', s)
 
 def bibtex_escape(s):
+    if '{' not in s and '}' not in s:
+        return s
+
     # Bibtex can't deal with unmatched braces inside the entry, so we get rid of
     # them.
     def unmatched_brace_deleter(s, opposite=False):
@@ -137,61 +205,251 @@ def canonicalize_title(s):
 def titles_equal(t1,t2):
     return canonicalize_title(t1) == canonicalize_title(t2)
 
-def populate_arxiv_information(list_of_bibitems):
+def normalize_arxivid(arxivid):
+    return re.sub(r'v[0-9]+$', '', arxivid.strip())
+
+def normalize_doi(doi):
+    return doi.strip().lower()
+
+def arxiv_cache_key(arxivid):
+    return 'arXiv:' + normalize_arxivid(arxivid)
+
+def doi_cache_key(doi):
+    return 'doi:' + normalize_doi(doi)
+
+def cached_metadata(key):
+    # Looks in the project's cache first, then in the user-level cache shared
+    # by all projects.
+    record = None
+    if BibItem.cache is not None:
+        record = BibItem.cache.get(key)
+    if record is not None:
+        profiling.count('metadata hits (project)')
+        return record
+
+    shared_cache = BibItem.get_shared_cache()
+    if shared_cache is not None:
+        record = shared_cache.get(key)
+        if record is not None and BibItem.cache is not None:
+            BibItem.cache.put(key, record)
+    profiling.count('metadata misses' if record is None else 'metadata hits (shared)')
+    return record
+
+def cache_metadata(key, record):
+    if BibItem.cache is not None:
+        BibItem.cache.put(key, record)
+    shared_cache = BibItem.get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.put(key, record)
+
+def arxiv_result_to_record(result):
+    from imbibe.cache import today
+    return { 'authors': result['authors'],
+             'title': result['title'],
+             'abstract': result['summary'],
+             'doi': result['doi'],
+             'fetched': today() }
+
+def eprint_needs_refresh(bibitem, record, min_age=0):
+    # A DOI given in the input file already says where the paper was
+    # published, so there is nothing for a refresh to find. With min_age,
+    # records fetched less than that many days ago are left alone.
+    from imbibe.cache import today
+    return (record['doi'] is None and bibitem.doi is None
+            and (min_age <= 0 or today() - record.get('fetched', 0) >= min_age))
+
+class ArxivIDNotFoundError(Exception):
+    def __init__(self, missing_ids, records):
+        Exception.__init__(self, "arXiv IDs not found: " + ", ".join(missing_ids))
+        self.missing_ids = missing_ids
+        # The records of the IDs that were found.
+        self.records = records
+
+def _search_arxiv(arxiv_ids, records, missing):
+    from imbibe.backend import get_backend, HTTPError
+    try:
+        results = get_backend().arxiv_search(id_list=arxiv_ids, max_results=len(arxiv_ids))
+    except HTTPError as e:
+        # arXiv rejects the whole query if any of the IDs is malformed.
+        if e.status != 400:
+            raise
+        results = []
+
+    if len(arxiv_ids) == 1 and len(results) == 1:
+        records[arxiv_ids[0]] = arxiv_result_to_record(results[0])
+        return
+
+    # Results don't necessarily come back in the order they were asked for,
+    # so match them up by ID.
+    requested = dict( (normalize_arxivid(arxivid), arxivid) for arxivid in arxiv_ids )
+    for result in results:
+        arxivid = requested.get(normalize_arxivid(result['id'].split('arxiv.org/abs/')[-1]))
+        if arxivid is not None:
+            records[arxivid] = arxiv_result_to_record(result)
+    remaining = [ arxivid for arxivid in arxiv_ids if arxivid not in records ]
+
+    if len(remaining) == 0:
+        return
+    elif len(arxiv_ids) == 1:
+        missing.append(arxiv_ids[0])
+    elif len(remaining) < len(arxiv_ids):
+        _search_arxiv(remaining, records, missing)
+    else:
+        # Nothing came back. Find out which IDs are bad by splitting the list
+        # in half, so that k bad IDs out of n cost O(k log n) queries.
+        mid = len(arxiv_ids) // 2
+        _search_arxiv(arxiv_ids[:mid], records, missing)
+        _search_arxiv(arxiv_ids[mid:], records, missing)
+
+def iter_arxiv_records(arxiv_ids, chunk_size=100, missing=None):
+    # Looks up the arXiv IDs in chunks of at most chunk_size, yielding a dict
+    # mapping each ID in the chunk to its metadata record as soon as the chunk
+    # is done. IDs that don't exist are appended to `missing`.
+    if missing is None:
+        missing = []
+    for i in range(0, len(arxiv_ids), chunk_size):
+        records = {}
+        _search_arxiv(arxiv_ids[i:(i+chunk_size)], records, missing)
+        yield records
+
+def populate_arxiv_information(list_of_bibitems, refresh_eprints=False, chunk_size=100,
+                               refresh_min_age=0):
     bibitems_with_arxivid = [ b for b in list_of_bibitems if
             (b.arxivid is not None and not b.arxiv_populated) ]
-    arxiv_ids = [ b.arxivid for b in bibitems_with_arxivid ]
 
+    # Anything we already know about is served from the cache. With
+    # refresh_eprints, papers which weren't published yet are looked up again
+    # (see eprint_needs_refresh).
+    to_fetch = []
+    for bibitem in bibitems_with_arxivid:
+        record = cached_metadata(arxiv_cache_key(bibitem.arxivid))
+        if record is not None and not (refresh_eprints
+                                       and eprint_needs_refresh(bibitem, record, refresh_min_age)):
+            bibitem.apply_arxiv_record(record, fetched=False)
+        else:
+            if record is not None:
+                profiling.count('metadata stale')
+            to_fetch.append(bibitem)
+
+    # Entries giving the same arXiv ID, with or without a version, share one
+    # lookup.
+    bibitems_by_arxivid = {}
+    for bibitem in to_fetch:
+        bibitems_by_arxivid.setdefault(normalize_arxivid(bibitem.arxivid), []).append(bibitem)
+    arxiv_ids = [ bibitems[0].arxivid for bibitems in bibitems_by_arxivid.values() ]
     if len(arxiv_ids) == 0:
         return
 
-    results = list(arxiv.Search(id_list=arxiv_ids, max_results=len(arxiv_ids)).results())
-    if len(results) != len(arxiv_ids):
-        # Need to try all the arXiv IDs individually to find out which one was
-        # not found.
-        for i in range(len(arxiv_ids)):
-            ret = list(arxiv.Search(id_list=[arxiv_ids[i]]).results())
-            if len(ret) != 1:
-                print("arXiv ID not found:" + arxiv_ids[i], file=sys.stderr)
-                sys.exit(1)
-        assert False
-
-    for bibitem,result in zip(bibitems_with_arxivid, results):
-        bibitem.read_arxiv_information(result)
-
-def crossref_find_from_journalref(journaltitle, volume, number, year, articletitle=None, titlesearchbydefault=False, check_aliases=True):
-    if check_aliases:
-        lower = journaltitle.lower()
-        try:
-            aliases = journal_aliases[lower]
-        except KeyError:
-            aliases = [journaltitle]
-        for alias in aliases:
-            ret = crossref_find_from_journalref(
-                    alias, volume, number, year, articletitle, titlesearchbydefault,
-                    check_aliases=False)
-            if ret is not None:
-                return ret
-        return None
-
-    # Weirdly Crossref search by journal seems to be case sensitive...
-    journaltitle = titlecase.titlecase(journaltitle)
-
+    # Each chunk is applied and cached as soon as it arrives, so whatever was
+    # found is kept even if some IDs were not.
+    found = {}
+    missing = []
+    for records in iter_arxiv_records(arxiv_ids, chunk_size, missing):
+        for arxivid,record in records.items():
+            cache_metadata(arxiv_cache_key(arxivid), record)
+            for bibitem in bibitems_by_arxivid[normalize_arxivid(arxivid)]:
+                bibitem.apply_arxiv_record(record)
+        found.update(records)
+
+    if len(missing) > 0:
+        raise ArxivIDNotFoundError(missing, found)
+
+# Results of crossref_find_from_journalref and arxiv_find, including failed
+# lookups, are kept in an SQLite database in the user cache directory, so that
+# running bibextract again on the same or overlapping files doesn't repeat the
+# queries. Failed lookups expire sooner, since the paper may turn up later.
+LOOKUP_TTL = 180*24*3600.
+LOOKUP_MISS_TTL = 14*24*3600.
+use_lookup_cache = True
+_lookup_cache = None
+_lookup_cache_lock = threading.Lock()
+
+def get_lookup_cache():
+    global _lookup_cache, use_lookup_cache
+    with _lookup_cache_lock:
+        if _lookup_cache is None and use_lookup_cache:
+            import sqlite3
+            from imbibe import cache
+
+            filename = os.path.join(user_cache_dir(), 'lookups.sqlite')
+            try:
+                os.makedirs(user_cache_dir(), exist_ok=True)
+                _lookup_cache = cache.SqliteCacheStore(filename)
+            except (OSError, sqlite3.Error) as e:
+                print("Warning: could not open lookup cache " + filename + ": " + str(e),
+                        file=sys.stderr)
+                use_lookup_cache = False
+        return _lookup_cache
+
+def save_lookup_cache():
+    if _lookup_cache is not None:
+        _lookup_cache.save()
+
+def cached_lookup(key, lookup):
+    store = get_lookup_cache()
+    if store is not None:
+        entry = store.get(key)
+        if entry is not None:
+            ttl = LOOKUP_TTL if entry['result'] is not None else LOOKUP_MISS_TTL
+            if time.time() - entry['time'] < ttl:
+                profiling.count('lookup hits')
+                return entry['result']
+            profiling.count('lookup expired')
+        else:
+            profiling.count('lookup misses')
+
+    result = lookup()
+    if store is not None:
+        store.put(key, { 'result': result, 'time': time.time() })
+    return result
+
+def journalref_lookup_key(journaltitle, volume, number, year, articletitle=None):
+    title = None if articletitle is None else canonicalize_title(articletitle)
+    return 'journalref:' + json.dumps([ ' '.join(journaltitle.lower().split()), str(volume).strip(),
+        str(number).replace(' ', '').lower(), str(year).strip(), title ])
+
+def crossref_find_from_journalref(journaltitle, volume, number, year, articletitle=None, titlesearchbydefault=False):
+    return cached_lookup(journalref_lookup_key(journaltitle, volume, number, year, articletitle),
+            lambda: _crossref_find_from_journalref(journaltitle, volume, number, year, articletitle,
+                titlesearchbydefault))
+
+def _crossref_find_from_journalref(journaltitle, volume, number, year, articletitle=None, titlesearchbydefault=False):
+    # Once the journal's ISSNs are known, a single search by ISSN is usually
+    # enough. Otherwise, or if that finds nothing (the ISSNs learned so far
+    # may not be all of the journal's, e.g. only the print one), each of its
+    # names is tried in turn, full title first.
+    import titlecase
+    from imbibe import journalnames
+    names = journalnames.candidate_titles(journaltitle)
+    issns = journalnames.known_issns(journaltitle)
+    if len(issns) > 0:
+        ret = _crossref_find_in_journal({ 'issn': issns }, names, issns, volume, number, year,
+                articletitle, titlesearchbydefault)
+        if ret is not None:
+            return ret
+
+    for name in names:
+        # Weirdly Crossref search by journal seems to be case sensitive...
+        ret = _crossref_find_in_journal({ 'container-title': titlecase.titlecase(name) }, names, issns,
+                volume, number, year, articletitle, titlesearchbydefault)
+        if ret is not None:
+            journalnames.learn_issns(journaltitle, ret)
+            return ret
+    return None
+
+def _crossref_find_in_journal(journal_filter, names, issns, volume, number, year, articletitle=None, titlesearchbydefault=False):
+    from imbibe import journalnames
+    from imbibe.backend import get_backend
+    works = get_backend().crossref_works
+
+    dates = { 'from-pub-date': str(int(year)-1), 'until-pub-date': year }
     if titlesearchbydefault:
         assert articletitle is not None
-        ret = cr.works(filter={'container-title': journaltitle,
-                               'from-pub-date': str(int(year)-1),
-                               'until-pub-date': year},
-                       query_bibliographic=articletitle)
+        ret = works(filter=dict(journal_filter, **dates), query_bibliographic=articletitle)
         if len(ret['message']['items']) == 0:
-            ret = cr.works(filter={'from-pub-date': str(int(year)-1),
-                                   'until-pub-date': year},
-                           query_bibliographic=articletitle)
+            ret = works(filter=dates, query_bibliographic=articletitle)
     else:
-        ret = cr.works(filter={'article-number': number, 
-                               'container-title': journaltitle,
-                               'from-pub-date': str(int(year)-1),
-                               'until-pub-date': year})
+        ret = works(filter=dict(journal_filter, **dates, **{ 'article-number': number }))
     matches = ret['message']['items']
     matches = [ match for match in matches if 
             (
@@ -204,10 +462,7 @@ def crossref_find_from_journalref(journaltitle, volume, number, year, articletit
                   ('article-number' in match and match['article-number'] == number) or
                   ('page' in match and match['page'].split('-')[0] == number.replace(' ','').split('-')[0])
                ) and
-               (
-                   ('container-title' in match and match['container-title'][0] == journaltitle) or
-                   ('short-container-title' in match and match['short-container-title'][0] == journaltitle)
-               )
+               journalnames.matches_journal(match, names, issns)
             )
             ]
 
@@ -215,25 +470,34 @@ def crossref_find_from_journalref(journaltitle, volume, number, year, articletit
         raise RuntimeError("More than one match for journal ref.")
     elif len(matches) == 0:
         if articletitle is not None and not titlesearchbydefault:
-            return crossref_find_from_journalref(journaltitle, volume, number, year, articletitle,
-                    titlesearchbydefault=True,
-                    check_aliases=check_aliases)
+            return _crossref_find_in_journal(journal_filter, names, issns, volume, number, year,
+                    articletitle, titlesearchbydefault=True)
         else:
             return None
     else:
-        match = matches[0]
         return matches[0]
 
-def arxiv_find(doi, title=None, searchbytitlefirst=False):
+def arxiv_find_lookup_key(doi, title=None):
+    # The title is part of the key, since a lookup with a title also searches
+    # by title and can find what one without it didn't.
+    title = None if title is None else canonicalize_title(title)
+    return 'arxiv_find:' + json.dumps([ normalize_doi(doi), title ])
+
+def arxiv_find(doi, title=None):
+    return cached_lookup(arxiv_find_lookup_key(doi, title), lambda: _arxiv_find(doi, title))
+
+def _arxiv_find(doi, title=None, searchbytitlefirst=False):
+    from imbibe.backend import get_backend
+
     if searchbytitlefirst:
-        matches = arxiv.Search(query=title, max_results=10).results()
+        matches = get_backend().arxiv_search(query=title, max_results=10)
     else:
-        matches = arxiv.Search(query=doi, max_results=10).results()
+        matches = get_backend().arxiv_search(query=doi, max_results=10)
 
-    matches = [ match for match in matches if match.doi is not None and match.doi.lower() == doi.lower() ]
+    matches = [ match for match in matches if match['doi'] is not None and match['doi'].lower() == doi.lower() ]
     if len(matches) == 0:
         if title is not None and not searchbytitlefirst:
-            return arxiv_find(doi, title, True)
+            return _arxiv_find(doi, title, True)
         else:
             return None
     elif len(matches) > 1:
@@ -247,40 +511,112 @@ def arxiv_find(doi, title=None, searchbytitlefirst=False):
         raise RuntimeError("arXiv ID not properly formatted:" + match['id'])
     return re_m.group(1)
 
-def crossref_read(dois):
-    chunk_size = 1
-    if len(dois) <= chunk_size:
-        results = cr.works(ids=dois)
-        if len(dois) == 1:
-            results = [ results ]
-        return results
-    else:
-        results = []
-        it = range(0,len(dois),chunk_size)
-
-        if len(dois) > 5:
-            print("Retrieving Crossref data (might take a while)...", file=sys.stderr)
-            it = progressbar.progressbar(it)
+class RateLimiter(object):
+    # Spaces out calls to wait() across all threads so that at most `rate` of
+    # them return per second. A rate of None means no limit.
+    def __init__(self, rate):
+        if rate is None or rate <= 0:
+            self.interval = 0.
+        else:
+            self.interval = 1./rate
+        self.next_time = 0.
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def fetch_concurrently(fetch, items, workers, rate, message=None):
+    # Calls fetch(item) for each item using a pool of worker threads, and
+    # returns the results in the same order as the items.
+    import concurrent.futures
+
+    limiter = RateLimiter(rate)
+    def job(item):
+        limiter.wait()
+        return fetch(item)
+
+    results = [ None ] * len(items)
+    bar = None
+    if message is not None:
+        import progressbar
+        print(message, file=sys.stderr)
+        bar = progressbar.ProgressBar(max_value=len(items))
+        bar.start()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = dict( (executor.submit(job, item), i) for i,item in enumerate(items) )
+        for ndone,future in enumerate(concurrent.futures.as_completed(futures)):
+            results[futures[future]] = future.result()
+            if bar is not None:
+                bar.update(ndone+1)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    if bar is not None:
+        bar.finish()
+    return results
+
+def crossref_read_batch(dois):
+    # A single /works query whose filter ORs together one doi: clause per DOI.
+    # If Crossref rejects it, e.g. because one of the DOIs contains a comma,
+    # nothing is returned, so that crossref_read looks the DOIs up one by one.
+    from imbibe.backend import get_backend, HTTPError
+    try:
+        ret = get_backend().crossref_works(filter={'doi': list(dois)}, limit=len(dois))
+    except HTTPError:
+        return []
+    return ret['message']['items']
 
-        for i in it:
-            results += crossref_read(dois[i:(i+chunk_size)])
-            time.sleep(0.1)
-        return results
+def crossref_read(dois, workers=4, rate=10., batch_size=1):
+    if len(dois) > 5:
+        message = "Retrieving Crossref data (might take a while)..."
+    else:
+        message = None
+
+    if batch_size <= 1 or len(dois) <= 1:
+        from imbibe.backend import get_backend
+        return fetch_concurrently(lambda doi: get_backend().crossref_works(ids=doi), dois, workers, rate, message)
+
+    unique_dois = list(dict( (doi.lower(), doi) for doi in dois ).values())
+    batches = [ unique_dois[i:(i+batch_size)] for i in range(0, len(unique_dois), batch_size) ]
+    found = {}
+    for items in fetch_concurrently(crossref_read_batch, batches, workers, rate, message):
+        for item in items:
+            # Wrap the item so that it looks like the response to a single-DOI lookup.
+            found[item['DOI'].lower()] = { 'message': item }
+
+    # Crossref occasionally leaves records out of filter queries, and batches
+    # it rejected come back empty, so look up anything that didn't come back
+    # individually.
+    missing = [ doi for doi in unique_dois if doi.lower() not in found ]
+    if len(missing) > 0:
+        for doi,result in zip(missing, crossref_read(missing, workers, rate)):
+            found[doi.lower()] = result
+
+    return [ found[doi.lower()] for doi in dois ]
 
 def aps_read(dois):
     if len(dois) == 0:
         return []
     elif len(dois) == 1:
+        import bibtexparser
+        from imbibe.backend import get_backend
         url = "https://dx.doi.org/" + dois[0]
-        redirecturl = urllib.request.urlopen(url).geturl()
+        redirecturl,_ = get_backend().http_get(url)
         exporturl = redirecturl.replace("abstract", "export")
-        bibtex = urllib.request.urlopen(exporturl).read()
+        _,bibtex = get_backend().http_get(exporturl)
         bibtex_data = bibtexparser.loads(bibtex).entries[0]
         return [bibtex_data]
     else:
         results = []
         it = range(len(dois))
         if len(dois) > 5:
+            import progressbar
             print("Retrieving APS data (might take a while)...", file=sys.stderr)
             it = progressbar.progressbar(it)
 
@@ -289,17 +625,90 @@ def aps_read(dois):
             time.sleep(0.1)
         return results
 
-def populate_doi_information(list_of_bibitems):
+def crossref_result_to_record(cr_result):
+    import html
+    try:
+        cr_result = cr_result['message']
+        crossref_type = cr_result['type']
+        if crossref_type != "journal-article":
+            return { 'type': crossref_type }
+
+        record = { 'type': crossref_type }
+        record['journal'] = html.unescape(cr_result['container-title'][0])
+        try:
+            record['journal_short'] = cr_result['short-container-title'][0]
+        except IndexError:
+            record['journal_short'] = record['journal']
+        record['detailed_authors'] = [ compact_author(auth) for auth in cr_result['author'] ]
+        record['publisher'] = cr_result['publisher']
+        record['year'] = cr_result['issued']['date-parts'][0][0]
+        record['title'] = cr_result['title'][0]
+        record['volume'] = cr_result.get('volume')
+
+        try:
+            record['page'] = cr_result['article-number']
+        except KeyError:
+            record['page'] = cr_result['page'].split('-')[0]
+        return intern_fields(record, INTERNED_RECORD_FIELDS)
+    except KeyError:
+        print(cr_result)
+        raise
+
+def find_duplicate_bibitems(list_of_bibitems):
+    # Returns the groups of positions in the list of entries that refer to the
+    # same paper, going by arXiv ID and DOI (including DOIs found on arXiv),
+    # for groups of more than one entry.
+    parent = list(range(len(list_of_bibitems)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first = {}
+    for i,bibitem in enumerate(list_of_bibitems):
+        keys = []
+        if bibitem.arxivid is not None:
+            keys.append(arxiv_cache_key(bibitem.arxivid))
+        if bibitem.doi is not None:
+            keys.append(doi_cache_key(bibitem.doi))
+        for key in keys:
+            if key in first:
+                parent[find(i)] = find(first[key])
+            else:
+                first[key] = i
+
+    groups = {}
+    for i in range(len(list_of_bibitems)):
+        groups.setdefault(find(i), []).append(i)
+    return [ group for group in groups.values() if len(group) > 1 ]
+
+def populate_doi_information(list_of_bibitems, workers=4, rate=10., batch_size=1):
     bibitems_with_doi = [ b for b in list_of_bibitems if (b.doi is not None and
         not b.doi_populated) ]
-    dois = [ b.doi for b in bibitems_with_doi ]
+
+    to_fetch = []
+    for bibitem in bibitems_with_doi:
+        record = cached_metadata(doi_cache_key(bibitem.doi))
+        if record is not None:
+            bibitem.apply_doi_record(record)
+        else:
+            to_fetch.append(bibitem)
+
+    dois = list(dict( (normalize_doi(b.doi), b.doi) for b in reversed(to_fetch) ).values())[::-1]
     if len(dois) == 0:
         return
 
-    results = crossref_read(dois)
+    results = crossref_read(dois, workers, rate, batch_size)
 
-    for bibitem,result in zip(bibitems_with_doi, results):
-        bibitem.read_journal_information(result)
+    records = {}
+    for doi,result in zip(dois, results):
+        record = crossref_result_to_record(result)
+        records[normalize_doi(doi)] = record
+        cache_metadata(doi_cache_key(doi), record)
+
+    for bibitem in to_fetch:
+        bibitem.apply_doi_record(records[normalize_doi(bibitem.doi)])
 
 def populate_aps_information(list_of_bibitems):
     bibitems_aps = [ b for b in list_of_bibitems if ((not b.aps_populated) and b.is_aps()) ]
@@ -317,7 +726,7 @@ def format_author(auth):
     given = auth['given']
     if isallcaps(family + given):
         family,given = (capitalize_first_letter(s.lower()) for s in (family,given))
-    return family + ", " + given
+    return sys.intern(family + ", " + given)
 
 def format_authorlist(l):
     if len(l) == 0:
@@ -337,6 +746,7 @@ def make_bibtexid_from_arxivid(firstauthorlastname, arxivid):
         yymm = arxivid.split(".")[0]
         assert len(yymm) == 4
 
+    import unidecode
     firstauthorlastname = unidecode.unidecode(strip_nonalphabetic(firstauthorlastname))
     return firstauthorlastname + "_" + yymm
 
@@ -443,41 +853,70 @@ def _decode_latex_accents_yielder(text):
 def decode_latex_accents(text):
     return unicodedata.normalize('NFC', ''.join(_decode_latex_accents_yielder(text)))
 
-def _encode_latex_accents_yielder(text):
-    i = 0
-    while i < len(text):
-        if i >= len(text)-1 or text[i+1] not in accent_map_reversed:
-            yield text[i]
-            i += 1
-        else:
-            yield '\\'
-            yield accent_map_reversed[text[i+1]]
-            yield '{'
-            yield text[i]
-            yield '}'
-            i += 2
+# A character followed by one of the combining accents we know how to encode.
+_accented_char_re = re.compile('(.)([' + ''.join(accent_map_reversed.keys()) + '])', re.DOTALL)
 
 def encode_latex_accents(text):
+    if text.isascii():
+        return text
     text = unicodedata.normalize('NFD', text)
-    return ''.join(_encode_latex_accents_yielder(text))
+    return _accented_char_re.sub(
+            lambda m: '\\' + accent_map_reversed[m.group(2)] + '{' + m.group(1) + '}', text)
 
-def process_text(text):
-    if isinstance(text, str):
-        def replace(c):
-            if c in charsubs.keys():
-                return charsubs[c]
-            else:
-                return c
+charsubs_table = str.maketrans(charsubs)
 
-        ret = "".join(replace(c) for c in text)
-        if args.bibtex_encoding:
+def process_text(text, bibtex_encoding=None):
+    if isinstance(text, str):
+        if bibtex_encoding is None:
+            bibtex_encoding = args.bibtex_encoding
+        # None of the substituted characters are ASCII.
+        if text.isascii():
+            return text
+        ret = text.translate(charsubs_table)
+        if bibtex_encoding:
             ret = encode_latex_accents(ret)
         return ret
     else:
         return text
 
+class BibtexWriter(object):
+    # Collects the generated output as a list of strings, applying the
+    # character substitutions of process_text to everything written (unless
+    # `substitute` is False). Warnings are collected separately.
+    def __init__(self, bibtex_encoding=False, substitute=True):
+        self.bibtex_encoding = bibtex_encoding
+        self.substitute = substitute
+        self.chunks = []
+        self.warnings = []
+
+    def convert(self, text):
+        if self.substitute:
+            return process_text(text, self.bibtex_encoding)
+        else:
+            return text
+
+    def write(self, text):
+        self.chunks.append(self.convert(text))
+
+    def write_line(self, text=''):
+        self.chunks.append(self.convert(text))
+        self.chunks.append('\n')
+
+    def write_raw(self, text):
+        self.chunks.append(text)
+
+    def warn(self, text):
+        self.warnings.append(self.convert(text) + '\n')
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+    def getwarnings(self):
+        return ''.join(self.warnings)
+
 
 def protect_words(title):
+    protected_words = get_protected_words()
     def protect_words_base(title):
         split = re.split(r"([-\s`'])", title)
         for i in range(len(split)):
@@ -509,6 +948,7 @@ def capitalize_first_letter(s):
         return s[0].upper() + s[1:]
 
 def unallcapsify(title, protect, firstwordcapitalized):
+    protected_words_uppercase = get_protected_words_uppercase()
     split = re.split(r'([-\s])', title)
     for i in range(len(split)):
         word = split[i]
@@ -544,7 +984,14 @@ def origcase_heuristic(title):
 class ValueUnknownException(Exception):
     pass
 
-def crossref_title_to_latex(s):
+def crossref_title_to_latex(s, warn=None):
+    # Warnings go to warn(text) if given (so that they are kept with the
+    # rendered entry), and to stderr otherwise.
+    if '<' not in s and '&' not in s and '\r' not in s:
+        # Nothing for the XML parser to do.
+        return s
+
+    from lxml import etree
     out = StringIO()
     root = etree.fromstring("<root>" + s + "</root>")
     for x in root.iter():
@@ -561,7 +1008,11 @@ def crossref_title_to_latex(s):
             out.write(r'\textsuperscript{' + text + '}')
         else:
             out.write(r'\textsuperscript{' + text + '}')
-            print("WARNING: Unsupported markup in title: <" + x.tag + ">", file=sys.stderr)
+            message = "WARNING: Unsupported markup in title: <" + x.tag + ">"
+            if warn is not None:
+                warn(message)
+            else:
+                print(message, file=sys.stderr)
         if x.tail is not None:
             out.write(x.tail)
 
@@ -572,9 +1023,23 @@ def default_fn_for_json_encoding(obj):
         return {'titletype': 'latex', 'title': obj.title}
     elif isinstance(obj, CrossrefTitle):
         return {'titletype': 'crossref', 'title': obj.title}
+    elif isinstance(obj, BibItem):
+        return obj.to_dict()
     else:
         return obj
 
+# Strings that repeat across many records (author names, journals,
+# publishers) are interned, so that a large cache keeps one copy of each.
+INTERNED_AUTHOR_FIELDS = ('given', 'family', 'name')
+INTERNED_RECORD_FIELDS = ('type', 'journal', 'journal_short', 'publisher')
+
+def intern_fields(d, fields):
+    for field in fields:
+        value = d.get(field)
+        if value.__class__ is str:
+            d[field] = sys.intern(value)
+    return d
+
 def object_hook_for_json_decoding(d):
     if 'titletype' in d:
         if d['titletype'] == 'latex':
@@ -583,101 +1048,220 @@ def object_hook_for_json_decoding(d):
             return CrossrefTitle(d['title'])
         else:
             raise NotImplementedError
+    elif 'family' in d or 'given' in d:
+        return intern_fields(d, INTERNED_AUTHOR_FIELDS)
+    elif 'journal' in d:
+        return intern_fields(d, INTERNED_RECORD_FIELDS)
     else:
         return d
 
+def compact_author(auth):
+    # Only the names are used; Crossref's affiliations, ORCIDs and so on
+    # aren't kept.
+    return intern_fields(dict( (field, auth[field]) for field in INTERNED_AUTHOR_FIELDS
+                               if field in auth ), INTERNED_AUTHOR_FIELDS)
+
+def compact_doi_record(record):
+    if 'detailed_authors' in record:
+        record['detailed_authors'] = [ compact_author(auth) for auth in record['detailed_authors'] ]
+    return intern_fields(record, INTERNED_RECORD_FIELDS)
+
+# Version 2 caches metadata records by arXiv ID and DOI instead of whole
+# BibItems by input line; version 3 keeps only the names of Crossref authors.
+CACHE_SCHEMA = '3'
+
+def migrate_cache(store):
+    # Brings a cache written by an older version of imbibe up to date, once.
+    # Returns whether anything was done.
+    schema = store.get_meta('schema')
+    if schema == CACHE_SCHEMA:
+        return False
+    if schema is None:
+        migrate_line_keyed_cache(store)
+    for key in store.keys():
+        if key.startswith('doi:'):
+            record = store.get(key)
+            if record is not None and record.get('type') == 'journal-article':
+                store.put(key, compact_doi_record(record))
+    store.set_meta('schema', CACHE_SCHEMA)
+    return True
+
+def migrate_line_keyed_cache(store):
+    # Older versions of imbibe cached whole BibItems keyed by the input line.
+    # Turn them into the arXiv and DOI metadata records which are cached now.
+    for key in store.keys():
+        d = store.get(key)
+        if not isinstance(d, dict) or 'canonical_id' not in d:
+            continue
+        store.delete(key)
+        try:
+            arxivid, manual_doi, options = BibItem.parse_input_file_line(key)
+        except (RuntimeError, IndexError):
+            continue
+
+        titles = d.get('title', [])
+        if isinstance(titles, str):
+            titles = [ LatexTitle(titles) ]
+        latex_titles = [ t.title for t in titles if isinstance(t, LatexTitle) ]
+        crossref_titles = [ t.title for t in titles if isinstance(t, CrossrefTitle) ]
+
+        if (arxivid is not None and d.get('arxiv_populated') and 'authors' in d
+                and len(latex_titles) > 0
+                and store.get(arxiv_cache_key(arxivid)) is None):
+            store.put(arxiv_cache_key(arxivid), {
+                'authors': d['authors'],
+                'title': latex_titles[0],
+                'abstract': d.get('abstract'),
+                'doi': d.get('doi') if manual_doi is None else None })
+
+        if (d.get('doi_populated') and d.get('doi') is not None and len(crossref_titles) > 0
+                and store.get(doi_cache_key(d['doi'])) is None):
+            store.put(doi_cache_key(d['doi']), {
+                'type': 'journal-article',
+                'journal': d['journal'],
+                'journal_short': d.get('journal_short', d['journal']),
+                'detailed_authors': d['detailed_authors'],
+                'publisher': d.get('publisher'),
+                'year': d['year'],
+                'title': crossref_titles[-1],
+                'volume': d.get('volume'),
+                'page': d['page'] })
+
 class LatexTitle(object):
+    __slots__ = ('title',)
+
     def __init__(self, title):
         self.title = title
 
-    def to_latex(self):
+    def to_latex(self, warn=None):
         return self.title
 
 class CrossrefTitle(object):
+    __slots__ = ('title',)
+
     def __init__(self, title):
         self.title = title
 
-    def to_latex(self):
-        return crossref_title_to_latex(self.title)
+    def to_latex(self, warn=None):
+        return crossref_title_to_latex(self.title, warn)
 
 class BibItem(object):
-    cache = {}
-    badjournals = []
+    cache = None
+    shared_cache = None
+    use_shared_cache = False
+    # Entries of the project's cache that haven't been used for this many
+    # days are dropped when it is saved (None to keep everything).
+    cache_max_age = None
+    badjournals = None
+
+    # Every field is set in __init__, so no entry needs a __dict__, and code
+    # reading the fields doesn't have to allow for them to be missing.
+    __slots__ = ('canonical_id', 'arxivid', 'doi',
+                 'bibtex_id', 'suppress_volumewarning', 'comment', 'extra_bibtex_fields',
+                 'title', 'authors', 'detailed_authors', 'abstract',
+                 'journal', 'journal_short', 'publisher', 'year', 'volume', 'page',
+                 'arxiv_populated', 'doi_populated', 'aps_populated')
 
     def __init__(self, arxivid=None, doi=None):
         if arxivid is None and doi is None:
             raise ValueError("Need to specify either arXiv ID or DOI!")
 
         if arxivid is not None:
-            self.canonical_id = 'arXiv:' + arxivid
+            self.canonical_id = arxiv_cache_key(arxivid)
         else:
-            self.canonical_id = 'doi:' + doi
+            self.canonical_id = doi_cache_key(doi)
 
         self.arxivid = arxivid
         self.doi = doi
-        self.journal = None
-        self.detailed_authors = None
+
         self.bibtex_id = None
-        self.abstract = None
+        self.suppress_volumewarning = False
         self.comment = None
-        self.publisher = None
+        self.extra_bibtex_fields = {}
+
         self.title = []
+        self.authors = None
+        self.detailed_authors = None
+        self.abstract = None
+        self.journal = None
+        self.journal_short = None
+        self.publisher = None
+        self.year = None
+        self.volume = None
+        self.page = None
 
         self.arxiv_populated = False
         self.doi_populated = False
         self.aps_populated = False
 
     def load_bad_journals():
-        thisfile = inspect.getfile(inspect.currentframe())
-        filename = os.path.join(os.path.dirname(thisfile), "badjournals.txt")
+        filename = os.path.join(thisdir(), "badjournals.txt")
         with open(filename, "r") as f:
             return [ line.rstrip("\n") for line in f ]
 
-    def __getattr__(self, name):
-        if name == 'aps_populated':
-            return False
-        else:
-            raise AttributeError(name)
+    def to_dict(self):
+        return dict( (name, getattr(self, name)) for name in BibItem.__slots__ )
 
     @staticmethod
-    def load_cache(filename):
-        try:
-            with open(filename, 'rb') as f:
-                def init_from_dict(d):
-                    obj = BibItem.__new__(BibItem)
-                    obj.__dict__ = d
-                    return obj
-
-                BibItem.cache = dict( (k, init_from_dict(obj)) for k,obj in 
-                        json.load(f, object_hook=object_hook_for_json_decoding).items())
-        except FileNotFoundError:
-            print("Warning: cache file not found.", file=sys.stderr)
+    def load_cache(filename, backend='json'):
+        from imbibe import cache
+
+        BibItem.cache = cache.open_store(filename, backend,
+                default=default_fn_for_json_encoding,
+                object_hook=object_hook_for_json_decoding)
+
+        legacy_filename = os.path.splitext(filename)[0] + '.json'
+        if (backend != 'json' and BibItem.cache.is_new and legacy_filename != filename
+                and os.path.exists(legacy_filename)):
+            n = BibItem.cache.migrate_from_json(legacy_filename)
+            print("Imported " + str(n) + " entries from " + legacy_filename + " into " + filename + ".",
+                    file=sys.stderr)
+
+        if migrate_cache(BibItem.cache):
+            # Make the metadata this project already has available to other
+            # projects. (Rendered entries depend on the project's options, so
+            # they stay in its own cache.)
+            shared_cache = BibItem.get_shared_cache()
+            if shared_cache is not None:
+                for key in BibItem.cache.keys():
+                    if key.startswith(('arXiv:', 'doi:')) and shared_cache.peek(key) is None:
+                        shared_cache.put(key, BibItem.cache.peek(key))
 
     @staticmethod
-    def save_cache(filename):
-        with open(filename, 'w') as f:
-            json.dump(dict( (k,i.__dict__) for k,i in BibItem.cache.items()),
-                    f, indent=2, default=default_fn_for_json_encoding)
-
-    def is_fresh(self):
-        global args
-        try:
-            if self.is_aps() and not self.aps_populated:
-                return False
-            if args.refresh_eprints and not self.doi_populated:
-                return False
-            else:
-                return True
-        except ValueUnknownException:
-            return False
+    def get_shared_cache():
+        # The user-level cache is an SQLite database, which takes care of
+        # locking when several imbibe processes use it at the same time. It is
+        # only opened once something is missing from the project's cache.
+        if BibItem.shared_cache is None and BibItem.use_shared_cache:
+            import sqlite3
+            from imbibe import cache
+
+            filename = os.path.join(user_cache_dir(), 'metadata.sqlite')
+            try:
+                os.makedirs(user_cache_dir(), exist_ok=True)
+                BibItem.shared_cache = cache.SqliteCacheStore(filename,
+                        default=default_fn_for_json_encoding,
+                        object_hook=object_hook_for_json_decoding)
+                migrate_cache(BibItem.shared_cache)
+            except (OSError, sqlite3.Error) as e:
+                print("Warning: could not open shared cache " + filename + ": " + str(e),
+                        file=sys.stderr)
+                BibItem.use_shared_cache = False
+        return BibItem.shared_cache
 
     @staticmethod
-    def init_from_input_file_line(line):
-        if line in BibItem.cache:
-            cached = BibItem.cache[line]
-            if cached.is_fresh():
-                return cached
+    def save_cache():
+        if BibItem.cache is not None:
+            if BibItem.cache_max_age is not None:
+                BibItem.cache.compact(BibItem.cache_max_age)
+            BibItem.cache.save()
+        if BibItem.shared_cache is not None:
+            BibItem.shared_cache.save()
 
+    @staticmethod
+    def parse_input_file_line(line):
+        # Returns the arXiv ID, the DOI and a dict of the options given on
+        # the line.
         splitline = re.split(r'(?<!\\)\[|(?<!\\)\]', line)
         main = splitline[0]
         doi = None
@@ -689,11 +1273,10 @@ class BibItem(object):
         else:
             arxivid = main
 
-        bibtex_id = None
-        suppress_volumewarning = False
-
-        comment = None
-        extra_bibtex_fields = {}
+        options = { 'bibtex_id': None,
+                    'suppress_volumewarning': False,
+                    'comment': None,
+                    'extra_bibtex_fields': {} }
         if len(splitline) > 1:
             opts = splitline[1]
             for opt in opts.split(","):
@@ -708,28 +1291,33 @@ class BibItem(object):
                     else:
                         doi = value
                 elif key == 'bibtex_id':
-                    bibtex_id = value
+                    options['bibtex_id'] = value
                 elif key == 'suppress_volumewarning':
                     if value == 'yes':
-                        suppress_volumewarning = True
+                        options['suppress_volumewarning'] = True
                     elif value == 'no':
                         pass
                     else:
                         raise RuntimeError("Invalid value: '" + value + "'")
                 elif key == 'comment':
-                    comment = unescape_string(value)
+                    options['comment'] = unescape_string(value)
                 elif key in optional_bibtex_fields:
-                    extra_bibtex_fields[key] = unescape_string(value)
+                    options['extra_bibtex_fields'][key] = unescape_string(value)
                 else:
                     raise RuntimeError("Invalid option name: '" + key + "'")
 
-        bibitem = BibItem(arxivid, doi)
-        bibitem.bibtex_id = bibtex_id
-        bibitem.suppress_volumewarning = suppress_volumewarning
-        bibitem.comment = comment
-        bibitem.extra_bibtex_fields = extra_bibtex_fields
+        return arxivid, doi, options
 
-        BibItem.cache[line] = bibitem
+    @staticmethod
+    def init_from_input_file_line(line):
+        # The per-line options are applied on top of the paper's metadata,
+        # which populate_arxiv_information and populate_doi_information take
+        # from the cache (keyed by the canonical ID) whenever possible.
+        arxivid, doi, options = BibItem.parse_input_file_line(line)
+
+        bibitem = BibItem(arxivid, doi)
+        for key,value in options.items():
+            setattr(bibitem, key, value)
         return bibitem
 
     # def is_aps(self):
@@ -770,7 +1358,17 @@ class BibItem(object):
     def __hash__(self):
         return hash(self.canonical_id)
 
-    def output_bib(self, eprint_published):
+    def render_digest(self, config_digest):
+        import hashlib
+        if self.journal is not None:
+            abbrevname = get_journal_abbreviations().get(self.journal)
+        else:
+            abbrevname = None
+        data = json.dumps([ config_digest, abbrevname, self.to_dict() ], sort_keys=True,
+                default=default_fn_for_json_encoding)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def output_bib(self, eprint_published, out):
         global args
 
         if self.bibtex_id is not None:
@@ -778,14 +1376,11 @@ class BibItem(object):
         else:
             bibtex_id = self.generate_bibtexid()
 
-        try:
-            if self.comment is not None:
-                print(self.comment)
-        except AttributeError:
-            pass
+        if self.comment is not None:
+            out.write_line(self.comment)
 
         def printfield(field,value, lastone=False):
-            print("  " + field + "={" + bibtex_escape(value) + "}" +
+            out.write_line("  " + field + "={" + bibtex_escape(value) + "}" +
                     ("" if lastone else ","))
 
         
@@ -794,7 +1389,7 @@ class BibItem(object):
         else:
             bibtex_type="unpublished"
 
-        print("@" + bibtex_type + "{" + self.generate_bibtexid() + ",")
+        out.write_line("@" + bibtex_type + "{" + self.generate_bibtexid() + ",")
         if self.abstract is not None:
             printfield("abstract", self.abstract)
         if self.arxivid is not None and (self.doi is None or eprint_published):
@@ -803,7 +1398,7 @@ class BibItem(object):
         if self.arxivid is not None and self.doi is None and args.eprint_as_note:
             printfield("note", "arXiv eprint " + self.arxivid)
         if self.journal is not None:
-            abbrevname = journal_abbreviations.get(self.journal)
+            abbrevname = get_journal_abbreviations().get(self.journal)
             if abbrevname is None:
                 abbrevname = self.journal
             printfield("journal", abbrevname)
@@ -814,16 +1409,12 @@ class BibItem(object):
             if self.volume is not None:
                 printfield("volume", self.volume)
             elif not self.suppress_volumewarning:
-                print("WARNING: No volume in CrossRef data for paper:", file=sys.stderr)
-                print("   " + str(self.title), file=sys.stderr)
+                out.warn("WARNING: No volume in CrossRef data for paper:")
+                out.warn("   " + str(self.title))
         if self.doi is not None:
             printfield("doi", self.doi)
 
-        # Compatibility for old cache files
-        if isinstance(self.title, str):
-            title = self.title
-        else:
-            title = self.title[-1].to_latex()
+        title = self.title[-1].to_latex(out.warn)
 
         allcaps = isallcaps(title)
         if allcaps:
@@ -834,33 +1425,36 @@ class BibItem(object):
                 title = "{" + title + "}"
             else:
                 title = protect_words(title)
-        print("  title={" + title + "},")
+        out.write_line("  title={" + title + "},")
 
         if not args.suppress_optional_fields:
-            try:
-                extra_bibtex_fields = self.extra_bibtex_fields
-            except AttributeError:
-                extra_bibtex_fields = {}
-            for key,value in extra_bibtex_fields.items():
+            for key,value in self.extra_bibtex_fields.items():
                 printfield(key, value)
 
         printfield("author", format_authorlist(self.authors), lastone=True)
-        print("}")
-        print("")
+        out.write_line("}")
+        out.write_line("")
 
     def read_arxiv_information(self,arxivresult):
-        self.authors = [ str(author) for author in arxivresult.authors ]
-        self.title.append(LatexTitle(arxivresult.title))
-        self.abstract = arxivresult.summary
-
-        if self.doi is not None and arxivresult.doi is not None and self.doi != arxivresult.doi:
-            print("WARNING: manually specified DOI for arXiv:" + self.arxivid + " disagrees with arXiv information.", file=sys.stderr)
-            print("You have: ", file=sys.stderr)
-            print("arXiv has: " + arxivresult.doi, file=sys.stderr)
-            print("Using your DOI.", file=sys.stderr)
-            print(file=sys.stderr)
-        elif arxivresult.doi is not None:
-            self.doi = arxivresult.doi
+        self.apply_arxiv_record(arxiv_result_to_record(arxivresult))
+
+    def apply_arxiv_record(self, record, fetched=True):
+        # The warning about a disagreeing DOI is only given when the record
+        # has just been fetched, not again on every run that takes it from
+        # the cache.
+        self.authors = [ sys.intern(author) for author in record['authors'] ]
+        self.title.append(LatexTitle(record['title']))
+        self.abstract = record['abstract']
+
+        if self.doi is not None and record['doi'] is not None and self.doi != record['doi']:
+            if fetched:
+                print("WARNING: manually specified DOI for arXiv:" + self.arxivid + " disagrees with arXiv information.", file=sys.stderr)
+                print("You have: ", file=sys.stderr)
+                print("arXiv has: " + record['doi'], file=sys.stderr)
+                print("Using your DOI.", file=sys.stderr)
+                print(file=sys.stderr)
+        elif record['doi'] is not None:
+            self.doi = record['doi']
 
         self.arxiv_populated = True
 
@@ -901,61 +1495,118 @@ class BibItem(object):
         sys.exit(1)
 
     def read_journal_information(self,cr_result):
-        try:
-            cr_result = cr_result['message']
-            crossref_type = cr_result['type']
-            if crossref_type != "journal-article":
-                self.bad_type_exit(crossref_type)
-
-            self.journal = html.unescape(cr_result['container-title'][0])
-            if self.journal in BibItem.badjournals:
-                self.bad_journal_exit(self.journal)
-            try:
-                self.journal_short = cr_result['short-container-title'][0]
-            except IndexError:
-                self.journal_short = self.journal
-            self.detailed_authors = cr_result['author']
-            self.authors = [ format_author(auth) for auth in self.detailed_authors ]
-            self.publisher = cr_result['publisher']
-            self.year = cr_result['issued']['date-parts'][0][0]
-            self.title.append(CrossrefTitle(cr_result['title'][0]))
-
-            try:
-                self.volume = cr_result['volume']
-            except KeyError:
-                self.volume = None
-
-            try:
-                self.page = cr_result['article-number']
-            except KeyError:
-                self.page = cr_result['page'].split('-')[0]
-
-            self.doi_populated = True
-        except KeyError:
-            print(cr_result)
-            raise
-BibItem.badjournals = BibItem.load_bad_journals()
-
-class OpenFileWithPath:
-    @staticmethod
-    def open(path, *args, **kwargs):
-        return OpenFileWithPath(path, open(path, *args, **kwargs))
-
-    def __init__(self, path, f):
-        self.f = f
-        self.path = path
+        self.apply_doi_record(crossref_result_to_record(cr_result))
+
+    def apply_doi_record(self, record):
+        crossref_type = record['type']
+        if crossref_type != "journal-article":
+            self.bad_type_exit(crossref_type)
+
+        self.journal = record['journal']
+        if BibItem.badjournals is None:
+            BibItem.badjournals = BibItem.load_bad_journals()
+        if self.journal in BibItem.badjournals:
+            self.bad_journal_exit(self.journal)
+        self.journal_short = record['journal_short']
+        self.detailed_authors = record['detailed_authors']
+        self.authors = [ format_author(auth) for auth in self.detailed_authors ]
+        self.publisher = record['publisher']
+        self.year = record['year']
+        self.title.append(CrossrefTitle(record['title']))
+        self.volume = record['volume']
+        self.page = record['page']
+
+        self.doi_populated = True
+
+RENDER_VERSION = '2'
+
+def render_config_digest(args):
+    # Digest of everything apart from the entry itself which affects the
+    # output of BibItem.output_bib.
+    import hashlib
+    config = [ RENDER_VERSION, args.eprint_published, args.eprint_as_note,
+               args.suppress_optional_fields, args.bibtex_encoding,
+               sorted(get_protected_words()) ]
+    return hashlib.sha1(json.dumps(config).encode('utf-8')).hexdigest()
+
+def output_bibitems(bibitems, keys, out, eprint_published, config_digest):
+    # Writes the BibTeX entries to the BibtexWriter `out`, reusing the
+    # rendered text stored in the cache for any entry whose metadata, options
+    # and configuration are unchanged since the last run. Warnings emitted
+    # while rendering are stored along with the text and repeated.
+    for key,bibitem in zip(keys, bibitems):
+        digest = bibitem.render_digest(config_digest)
+        cache_key = 'rendered:' + key
+        rendered = BibItem.cache.get(cache_key)
+        if rendered is None or rendered['digest'] != digest:
+            profiling.count('rendered misses')
+            entry_out = BibtexWriter(out.bibtex_encoding, out.substitute)
+            bibitem.output_bib(eprint_published, entry_out)
+            rendered = { 'digest': digest, 'text': entry_out.getvalue(),
+                         'warnings': entry_out.getwarnings() }
+            BibItem.cache.put(cache_key, rendered)
+        else:
+            profiling.count('rendered hits')
+        out.write_raw(rendered['text'])
+        sys.stderr.write(rendered['warnings'])
 
-    def close_and_delete(self):
-        self.f.close()
-        os.remove(self.path)
+def write_output_if_changed(filename, text):
+    # Leaving the file alone when nothing changed keeps its modification
+    # time, so that LaTeX build tools don't rerun BibTeX for nothing.
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            if f.read() == text:
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
 
-    def __getattr__(self, attr):
-        return getattr(self.f, attr)
+    # A file with other hard links to it, or one that isn't a regular file
+    # (e.g. /dev/stdout), is written in place; replacing it would break the
+    # links.
+    import stat
+    try:
+        st = os.stat(filename)
+        in_place = st.st_nlink > 1 or not stat.S_ISREG(st.st_mode)
+    except FileNotFoundError:
+        in_place = False
+    if in_place:
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        from imbibe import cache
+        cache.write_atomically(filename, text)
+    profiling.add_bytes('output written', len(text.encode('utf-8')))
+    return True
+
+def use_snapshots(arxiv_index=None, crossref_index=None):
+    # Puts the backends answering requests from local snapshots of arXiv's
+    # and Crossref's metadata in front of the current backend. An index of ''
+    # means the default location.
+    from imbibe import backend
+    if arxiv_index is not None:
+        from imbibe import arxivsnapshot
+        backend.set_backend(arxivsnapshot.ArxivSnapshotBackend(
+            arxiv_index or arxivsnapshot.default_index_filename(), backend.get_backend()))
+    if crossref_index is not None:
+        from imbibe import crossrefsnapshot
+        backend.set_backend(crossrefsnapshot.CrossrefSnapshotBackend(
+            crossref_index or crossrefsnapshot.default_index_filename(), backend.get_backend()))
+
+def report_profile(profile, print_report, json_filename):
+    for name,store in (('cache', BibItem.cache), ('shared cache', BibItem.shared_cache)):
+        if store is not None:
+            profile.add_bytes(name + ' read', store.bytes_read)
+            profile.add_bytes(name + ' written', store.bytes_written)
+
+    report = profile.report()
+    if print_report:
+        sys.stderr.write(profiling.format_report(report))
+    if json_filename is not None:
+        with open(json_filename, 'w') as f:
+            json.dump(report, f, indent=2)
 
 def main():
-    global print
     global args
-    global print_
 
     parser = argparse.ArgumentParser(prog='imbibe')
     parser.add_argument("--no-eprint-published", action='store_false',
@@ -963,7 +1614,12 @@ def main():
             help="For published papers, don't include the arXiv ID in the BibTeX file.")
     parser.add_argument("--refresh-eprints", action='store_true',
             dest='refresh_eprints',
-            help="Ignore cache for entries where the cached entry has no publication information.")
+            help="Look up again entries whose cached information has no publication "
+                 "information and which have no DOI in the input file.")
+    parser.add_argument("--refresh-eprints-after", type=int, default=0, metavar='DAYS',
+            dest='refresh_eprints_after',
+            help="With --refresh-eprints, only look up entries whose cached information is at "
+                 "least DAYS days old (default: 0, i.e. look up all of them on every run).")
     parser.add_argument("--eprint-as-note", action='store_true',
             dest='eprint_as_note',
             help="For entries that have no published journal information, put arXiv information in the note field.")
@@ -979,67 +1635,285 @@ def main():
     parser.add_argument("--bibtex-encoding", action='store_true',
             dest='bibtex_encoding',
             help="Where possible, convert accented characters to a LaTeX escaped character.")
+    parser.add_argument("--no-duplicate-warnings", action='store_false',
+            dest='duplicate_warnings',
+            help="Don't warn about lines of the input file that refer to the same paper, "
+                 "e.g. when citing a paper both by its arXiv ID and by its DOI on purpose.")
+    parser.add_argument("--crossref-workers", type=int, default=4,
+            dest='crossref_workers',
+            help="Number of Crossref requests to have in flight at once (default: 4).")
+    parser.add_argument("--crossref-rate", type=float, default=10.,
+            dest='crossref_rate',
+            help="Maximum number of Crossref requests per second (default: 10).")
+    parser.add_argument("--cache-backend", choices=['json', 'sqlite'], default='json',
+            dest='cache_backend',
+            help="Store the cache in imbibe-cache.json (default), or in an SQLite database "
+                 "imbibe-cache.sqlite which is read and written one entry at a time. An existing "
+                 "imbibe-cache.json is imported the first time the SQLite database is created.")
+    parser.add_argument("--no-shared-cache", action='store_false',
+            dest='shared_cache',
+            help="Don't use the user-level cache of metadata shared between projects "
+                 "(kept in $XDG_CACHE_HOME/imbibe, or $IMBIBE_CACHE_DIR if set).")
+    parser.add_argument("--cache-max-age", type=int, default=180, metavar='DAYS',
+            dest='cache_max_age',
+            help="Drop entries from the project's cache that haven't been used for this many "
+                 "days, e.g. those of lines removed from the input file (default: 180; 0 to "
+                 "keep everything).")
+    parser.add_argument("--crossref-batch-size", type=int, default=20,
+            dest='crossref_batch_size',
+            help="Number of DOIs to resolve per Crossref query (default: 20). Use 1 to look up each DOI separately.")
+    parser.add_argument("--arxiv-chunk-size", type=int, default=100,
+            dest='arxiv_chunk_size',
+            help="Maximum number of arXiv IDs to look up per arXiv query (default: 100).")
+    parser.add_argument("--arxiv-snapshot", nargs='?', const='', metavar='INDEX',
+            dest='arxiv_snapshot',
+            help="Look up arXiv papers in a local index built from arXiv's bulk metadata "
+                 "snapshot with 'python -m imbibe.arxivsnapshot', going to arXiv only for "
+                 "papers that are not in it. INDEX defaults to arxiv-snapshot.sqlite in the "
+                 "user cache directory.")
+    parser.add_argument("--crossref-snapshot", nargs='?', const='', metavar='INDEX',
+            dest='crossref_snapshot',
+            help="Look up DOIs in a local index of part of Crossref's public data file, built "
+                 "with 'python -m imbibe.crossrefsnapshot', going to Crossref only for DOIs "
+                 "that are not in it. INDEX defaults to crossref-snapshot.sqlite in the user "
+                 "cache directory.")
+    parser.add_argument("--profile", action='store_true',
+            help="At the end, print how long each phase of the run took, the requests made "
+                 "to each server and their latencies, cache hits and misses and the amount "
+                 "of data read and written.")
+    parser.add_argument("--profile-json", metavar='FILE', dest='profile_json',
+            help="Write the same report as --profile to FILE as JSON.")
+    parser.add_argument("--watch", action='store_true',
+            help="Keep running, and regenerate the output file whenever the input file, "
+                 "capitalized_words.txt, journal_abbrev.csv or imbibe/opts.py change.")
+    parser.add_argument("--watch-interval", type=float, default=0.2, dest='watch_interval',
+            metavar='SECONDS', help="How often --watch checks for changes (default: 0.2).")
+    parser.add_argument("--no-daemon", action='store_false', dest='daemon',
+            help="Fetch metadata directly, even if an imbibe daemon (python -m imbibe.daemon) "
+                 "is running.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--record", metavar='CASSETTE',
+            help="Record all requests to Crossref, arXiv and doi.org, and their responses, "
+                 "in the file CASSETTE.")
+    group.add_argument("--replay", metavar='CASSETTE',
+            help="Serve all requests from a file written by --record, without any network access.")
+    group.add_argument("--offline", action='store_true',
+            help="Don't access the network. Anything that isn't in the cache or in the indexes "
+                 "given with --arxiv-snapshot and --crossref-snapshot is an error.")
+    parser.add_argument("--replay-latency", type=float, default=0., metavar='SECONDS',
+            dest='replay_latency',
+            help="With --replay, wait this long for each request to simulate the network.")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--arxiv")
     group.add_argument("--doi")
+    group.add_argument("--batch", metavar='MANIFEST',
+            help="Regenerate the output files of all the projects listed in MANIFEST, a JSON "
+                 "list of objects with the keys 'input', 'output' and optionally 'cache' and "
+                 "'flags', looking up the papers of all of them together.")
     group.add_argument("inputfile", nargs='?')
     parser.add_argument("outputfile", nargs='?')
     args = parser.parse_args()
 
-    use_cache=False
-    fout=None
-    try:
-        if args.arxiv is not None:
-            bibitems = [ BibItem(arxivid=args.arxiv) ]
-        elif args.doi is not None:
-            bibitems = [ BibItem(doi=args.doi) ]
-            bibitems[0].bibtex_id = 'ARTICLE'
+    BibItem.use_shared_cache = args.shared_cache
+    BibItem.cache_max_age = args.cache_max_age if args.cache_max_age > 0 else None
+
+    if not args.daemon:
+        from imbibe import backend
+        backend.set_backend(backend.LiveBackend())
+
+    if args.record is not None or args.replay is not None:
+        from imbibe import backend
+        if args.record is not None:
+            recorder = backend.RecordingBackend(args.record)
+            backend.set_backend(recorder)
+            # Also save what was recorded when a run exits with an error.
+            import atexit
+            atexit.register(recorder.save)
+        else:
+            backend.set_backend(backend.ReplayBackend(args.replay, args.replay_latency))
+        # Records in the shared cache would make the requests depend on
+        # what other projects have looked up.
+        BibItem.use_shared_cache = False
+
+    if args.offline:
+        from imbibe import backend
+        backend.set_backend(backend.OfflineBackend())
+
+    if args.profile or args.profile_json is not None:
+        # Only requests that go to the network are timed, not those answered
+        # from a snapshot or, since it counts them separately, by the daemon.
+        from imbibe import backend, daemon
+        current = backend.get_backend()
+        if isinstance(current, daemon.DaemonBackend):
+            current.fallback = profiling.ProfilingBackend(current.fallback)
         else:
-            use_cache = True
-            cache_filename = "imbibe-cache.json"
-            BibItem.load_cache(cache_filename)
+            backend.set_backend(profiling.ProfilingBackend(current))
+    use_snapshots(args.arxiv_snapshot, args.crossref_snapshot)
+
+    if args.batch is not None:
+        from imbibe import batch
+        batch.run_batch(args, parser)
+    elif args.watch:
+        if args.inputfile is None or args.outputfile is None:
+            parser.error("--watch needs an input and an output file")
+        watch(args)
+    else:
+        run(args)
+
+def read_input_file(filename):
+    # Returns the non-empty lines of the input file and their BibItems.
+    with open(filename) as f:
+        lines = [ line for line in f.readlines() if line.strip() != '' ]
+        profiling.add_bytes('input read', f.tell())
+    return lines, [ BibItem.init_from_input_file_line(line) for line in lines ]
+
+def new_output(args):
+    # The output is collected in memory and only written out at the end, so
+    # a failed run never leaves a truncated output file.
+    out = BibtexWriter(args.bibtex_encoding)
+    if not args.print_keys:
+        if 'IMBIBE_MSG' in os.environ:
+            msg = os.environ['IMBIBE_MSG']
+        else:
+            msg = "File automatically generated by imbibe. DO NOT EDIT."
+        out.write_line(msg)
+        out.write_line()
+    return out
+
+def report_duplicates(bibitems, lines):
+    # Duplicates are only looked up once, but still each get an entry.
+    for group in find_duplicate_bibitems(bibitems):
+        profiling.count('duplicate entries', len(group) - 1)
+        print("Warning: these lines refer to the same paper:", file=sys.stderr)
+        for i in group:
+            print("    " + lines[i].strip(), file=sys.stderr)
+
+def render_bibitems(args, bibitems, lines, out):
+    if args.print_eprints:
+        for bibitem in bibitems:
+            if bibitem.doi is None:
+                out.write_line(bibitem.arxivid)
+    elif args.print_keys:
+        for bibitem in bibitems:
+            out.write(bibitem.generate_bibtexid() + ", ")
+        out.write_line()
+    else:
+        output_bibitems(bibitems, [ line.strip() for line in lines ], out,
+                args.eprint_published, render_config_digest(args))
+
+def run(args):
+    # Generates the output once. In --watch mode this is called again after
+    # every change, reusing the cache and anything else already loaded.
+    profile = None
+    if args.profile or args.profile_json is not None:
+        profile = profiling.start()
+
+    if args.arxiv is not None:
+        bibitems = [ BibItem(arxivid=args.arxiv) ]
+        out = BibtexWriter(substitute=False)
+    elif args.doi is not None:
+        bibitems = [ BibItem(doi=args.doi) ]
+        bibitems[0].bibtex_id = 'ARTICLE'
+        out = BibtexWriter(substitute=False)
+    else:
+        cache_filename = "imbibe-cache." + args.cache_backend
+        with profiling.phase('load cache'):
+            if BibItem.cache is None:
+                BibItem.load_cache(cache_filename, args.cache_backend)
 
-            if args.outputfile is not None:
-                outputfilename = args.outputfile
-                fout = OpenFileWithPath.open(outputfilename, 'w', encoding='utf-8')
-            else:
-                fout = sys.stdout
-            print_ = print
-            def myprint(*args, file=fout, **kwargs):
-                print_(*(process_text(arg) for arg in args), file=file, **kwargs)
-            print = myprint
-
-            f = open(args.inputfile)
-            bibitems = [ BibItem.init_from_input_file_line(line) for line in f.readlines() 
-                    if line.strip() != '' ]
-
-            if not args.print_keys:
-                if 'IMBIBE_MSG' in os.environ:
-                    msg = os.environ['IMBIBE_MSG']
-                else:
-                    msg = "File automatically generated by imbibe. DO NOT EDIT."
-                print(msg)
-                print()
+        with profiling.phase('read input'):
+            lines, bibitems = read_input_file(args.inputfile)
+        out = new_output(args)
 
-        populate_arxiv_information(bibitems)
-        populate_doi_information(bibitems)
+    try:
+        with profiling.phase('arXiv'):
+            populate_arxiv_information(bibitems, args.refresh_eprints, args.arxiv_chunk_size,
+                                       args.refresh_eprints_after)
+    except ArxivIDNotFoundError as e:
+        for arxivid in e.missing_ids:
+            print("arXiv ID not found: " + arxivid, file=sys.stderr)
+        BibItem.save_cache()
+        sys.exit(1)
+    if args.inputfile is not None and args.duplicate_warnings:
+        report_duplicates(bibitems, lines)
+    with profiling.phase('Crossref'):
+        populate_doi_information(bibitems, args.crossref_workers, args.crossref_rate,
+                args.crossref_batch_size)
+    with profiling.phase('APS'):
         populate_aps_information(bibitems)
 
-        if args.print_eprints:
-            for bibitem in bibitems:
-                if bibitem.doi is None:
-                    print(bibitem.arxivid)
-        elif args.print_keys:
-            for bibitem in bibitems:
-                print(bibitem.generate_bibtexid(), end=", ")
-            print()
+    with profiling.phase('render'):
+        if args.inputfile is not None:
+            render_bibitems(args, bibitems, lines, out)
         else:
             for bibitem in bibitems:
-                bibitem.output_bib(args.eprint_published)
+                bibitem.output_bib(args.eprint_published, out)
+            sys.stderr.write(out.getwarnings())
 
-        if use_cache:
-            BibItem.save_cache(cache_filename)
-    except:
-        if fout is not None and isinstance(fout, OpenFileWithPath):
-            fout.close_and_delete()
-        raise
+    with profiling.phase('write output'):
+        if args.inputfile is not None and args.outputfile is not None:
+            write_output_if_changed(args.outputfile, out.getvalue())
+        else:
+            sys.stdout.write(out.getvalue())
+
+    with profiling.phase('save cache'):
+        BibItem.save_cache()
+
+    if profile is not None:
+        report_profile(profile, args.profile, args.profile_json)
+
+def reload_opts():
+    global optional_bibtex_fields
+    import importlib
+    importlib.invalidate_caches()
+    try:
+        from imbibe import opts
+        optional_bibtex_fields = importlib.reload(opts).optional_bibtex_fields
+    except ModuleNotFoundError:
+        from imbibe.opts_default import optional_bibtex_fields
+
+def watch(args):
+    # Regenerates the output whenever one of the files it depends on changes.
+    # Everything loaded so far stays in memory, so only new entries have to be
+    # looked up, and a failed run just waits for the next change.
+    def stamp(filename):
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    watched = { 'input': args.inputfile,
+                'words': "capitalized_words.txt",
+                'journals': "journal_abbrev.csv",
+                'opts': os.path.join(thisdir(), 'opts.py') }
+    stamps = None
+    print("Watching " + ', '.join(watched.values()) + " (press Ctrl-C to stop).", file=sys.stderr)
+    try:
+        while True:
+            new_stamps = dict( (name, stamp(filename)) for name,filename in watched.items() )
+            if new_stamps != stamps:
+                if stamps is not None:
+                    changed = [ name for name in watched if new_stamps[name] != stamps[name] ]
+                    if 'words' in changed:
+                        get_protected_words.cache_clear()
+                        get_protected_words_uppercase.cache_clear()
+                    if 'journals' in changed:
+                        reload_journal_abbreviations()
+                    if 'opts' in changed:
+                        reload_opts()
+                stamps = new_stamps
+
+                start = time.perf_counter()
+                try:
+                    run(args)
+                except (Exception, SystemExit) as e:
+                    if not isinstance(e, SystemExit):
+                        print("Error: " + str(e), file=sys.stderr)
+                    print("Not updated " + args.outputfile + "; waiting for changes.", file=sys.stderr)
+                else:
+                    print("Updated " + args.outputfile + " in " +
+                          str(round(1000*(time.perf_counter() - start))) + " ms.", file=sys.stderr)
+            time.sleep(args.watch_interval)
+    except KeyboardInterrupt:
+        pass
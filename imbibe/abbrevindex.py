@@ -0,0 +1,156 @@
+import os
+import os.path
+import json
+import mmap
+import struct
+import hashlib
+import zlib
+from imbibe.cache import write_atomically
+
+# On-disk hash table mapping journal names to their abbreviations, so that a
+# lookup only touches a couple of pages of a memory-mapped file instead of
+# requiring all the CSV files to be parsed into a dict.
+#
+# File layout (all integers little-endian):
+#   magic                  8 bytes
+#   header length          u32
+#   header                 JSON: the source files' (path, size, mtime) and a
+#                          digest of their contents
+#   number of buckets      u32 (a power of two)
+#   buckets                (crc32 of name, offset of record + 1) as u32 pairs,
+#                          with offset 0 marking an empty bucket
+#   records                (u32 name length, u32 abbreviation length, name,
+#                          abbreviation), UTF-8 encoded
+
+MAGIC = b'IMBJIDX2'
+_u32 = struct.Struct('<I')
+_bucket = struct.Struct('<II')
+_record = struct.Struct('<II')
+
+def source_stamps(sources):
+    stamps = []
+    for filename in sources:
+        st = os.stat(filename)
+        stamps.append([ filename, st.st_size, st.st_mtime_ns ])
+    return stamps
+
+def source_digest(sources):
+    h = hashlib.sha1()
+    for filename in sources:
+        h.update(filename.encode('utf-8') + b'\0')
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+        h.update(b'\0')
+    return h.hexdigest()
+
+def _encode_header(sources, digest):
+    header = json.dumps({ 'sources': source_stamps(sources), 'digest': digest }).encode('utf-8')
+    return MAGIC + _u32.pack(len(header)) + header
+
+def _encode_body(table):
+    nbuckets = 1
+    while nbuckets < 2*len(table):
+        nbuckets *= 2
+    mask = nbuckets - 1
+
+    buckets = [ (0,0) ] * nbuckets
+    records = bytearray()
+    for name,abbrev in table.items():
+        name = name.encode('utf-8')
+        abbrev = abbrev.encode('utf-8')
+        h = zlib.crc32(name)
+        i = h & mask
+        while buckets[i][1] != 0:
+            i = (i+1) & mask
+        buckets[i] = (h, len(records) + 1)
+        records += _record.pack(len(name), len(abbrev)) + name + abbrev
+
+    return (_u32.pack(nbuckets) + b''.join(_bucket.pack(*b) for b in buckets)
+            + bytes(records))
+
+def _read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        return None
+    length, = _u32.unpack(f.read(_u32.size))
+    return json.loads(f.read(length).decode('utf-8'))
+
+class JournalAbbreviationIndex(object):
+    def __init__(self, filename):
+        self.f = open(filename, 'rb')
+        try:
+            header = _read_header(self.f)
+            if header is None:
+                raise ValueError("Not a journal abbreviation index: " + filename)
+            self.digest = header['digest']
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.f.close()
+            raise
+        nbuckets_pos = self.f.tell()
+        nbuckets, = _u32.unpack_from(self.mm, nbuckets_pos)
+        self.mask = nbuckets - 1
+        self.buckets_pos = nbuckets_pos + _u32.size
+        self.records_pos = self.buckets_pos + nbuckets*_bucket.size
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    def get(self, name, default=None):
+        key = name.encode('utf-8')
+        h = zlib.crc32(key)
+        i = h & self.mask
+        mm = self.mm
+        while True:
+            bucket_hash,offset = _bucket.unpack_from(mm, self.buckets_pos + i*_bucket.size)
+            if offset == 0:
+                return default
+            if bucket_hash == h:
+                pos = self.records_pos + offset - 1
+                namelen,abbrevlen = _record.unpack_from(mm, pos)
+                pos += _record.size
+                if mm[pos:(pos+namelen)] == key:
+                    pos += namelen
+                    return mm[pos:(pos+abbrevlen)].decode('utf-8')
+            i = (i+1) & self.mask
+
+    def __getitem__(self, name):
+        ret = self.get(name)
+        if ret is None:
+            raise KeyError(name)
+        return ret
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+def index_is_current(filename, sources):
+    # Returns (current, header). The index is current if the source files have
+    # the same sizes and modification times as when it was built.
+    try:
+        with open(filename, 'rb') as f:
+            header = _read_header(f)
+    except (FileNotFoundError, ValueError, struct.error):
+        return False, None
+    if header is None:
+        return False, None
+    try:
+        return header['sources'] == source_stamps(sources), header
+    except FileNotFoundError:
+        return False, header
+
+def open_index(filename, sources, load_table):
+    # Opens the index stored at `filename`, first (re)building it from the
+    # dict returned by load_table() if any of the source files changed.
+    current, header = index_is_current(filename, sources)
+    if not current:
+        digest = source_digest(sources)
+        if header is not None and header.get('digest') == digest:
+            # Only the timestamps changed (e.g. after a fresh checkout), so we
+            # can keep the existing table and just update the header.
+            with open(filename, 'rb') as f:
+                _read_header(f)
+                body = f.read()
+        else:
+            body = _encode_body(load_table())
+        write_atomically(filename, _encode_header(sources, digest) + body, mode='wb')
+    return JournalAbbreviationIndex(filename)
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import zlib
+import argparse
+import threading
+import tempfile
+
+# Local copy of arXiv's metadata, built from the bulk JSON-lines snapshot that
+# arXiv publishes (arxiv-metadata-oai-snapshot.json, one paper per line). The
+# index is an SQLite database with the records in the same form as
+# backend.LiveBackend.arxiv_search() returns them, compressed, and looked up by
+# arXiv ID, by DOI or by title. Build it with
+#
+#     python -m imbibe.arxivsnapshot arxiv-metadata-oai-snapshot.json
+#
+# and use it with "imbibe --arxiv-snapshot".
+
+def default_index_filename():
+    from imbibe import user_cache_dir
+    return os.path.join(user_cache_dir(), 'arxiv-snapshot.sqlite')
+
+def title_key(title):
+    from imbibe import canonicalize_title
+    return ' '.join(canonicalize_title(title).split())
+
+def snapshot_paper_to_result(paper):
+    authors = []
+    for author in paper.get('authors_parsed') or []:
+        last,first = author[0],author[1]
+        suffix = author[2] if len(author) > 2 else ''
+        authors.append(' '.join(s for s in (first, last, suffix) if s != ''))
+    version = paper['versions'][-1]['version'] if paper.get('versions') else 'v1'
+    doi = paper.get('doi')
+    return { 'id': 'http://arxiv.org/abs/' + paper['id'] + version,
+             'authors': authors,
+             'title': ' '.join(paper['title'].split()),
+             'summary': paper['abstract'].strip(),
+             'doi': doi.split()[0] if doi else None }
+
+def open_snapshot(filename):
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    elif filename.endswith('.bz2'):
+        import bz2
+        return bz2.open(filename, 'rt', encoding='utf-8')
+    return open(filename, 'r', encoding='utf-8')
+
+def ingest(snapshot_filename, index_filename, batch_size=10000):
+    import sqlite3
+
+    dirname = os.path.dirname(os.path.abspath(index_filename))
+    os.makedirs(dirname, exist_ok=True)
+    fd,tmpname = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(index_filename) + '-')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmpname)
+        try:
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE papers (id TEXT PRIMARY KEY, title TEXT, record BLOB NOT NULL)")
+            conn.execute("CREATE TABLE dois (doi TEXT NOT NULL, id TEXT NOT NULL)")
+
+            def flush(papers, dois):
+                conn.executemany("INSERT OR REPLACE INTO papers (id, title, record) VALUES (?, ?, ?)", papers)
+                conn.executemany("INSERT INTO dois (doi, id) VALUES (?, ?)", dois)
+                del papers[:]
+                del dois[:]
+
+            n = 0
+            papers = []
+            dois = []
+            with open_snapshot(snapshot_filename) as f:
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    paper = json.loads(line)
+                    result = snapshot_paper_to_result(paper)
+                    papers.append((paper['id'], title_key(result['title']),
+                                   zlib.compress(json.dumps(result).encode('utf-8'))))
+                    for doi in (paper.get('doi') or '').split():
+                        dois.append((doi.lower(), paper['id']))
+                    n += 1
+                    if len(papers) >= batch_size:
+                        flush(papers, dois)
+                    if n % 100000 == 0:
+                        print(str(n) + " papers...", file=sys.stderr)
+            flush(papers, dois)
+
+            conn.execute("CREATE INDEX dois_doi ON dois (doi)")
+            conn.execute("CREATE INDEX papers_title ON papers (title)")
+            conn.commit()
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+        os.replace(tmpname, index_filename)
+    except:
+        os.remove(tmpname)
+        raise
+    return n
+
+def looks_like_doi(s):
+    return s.startswith('10.') and '/' in s
+
+class ArxivSnapshotBackend(object):
+    # Answers arXiv requests from the index, passing anything it can't answer
+    # (papers newer than the snapshot, and free-text searches) on to another
+    # backend. Crossref and HTTP requests are passed on unchanged.
+    def __init__(self, filename, backend):
+        import sqlite3
+        if not os.path.exists(filename):
+            raise FileNotFoundError("arXiv snapshot index not found: " + filename)
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect('file:' + filename + '?mode=ro', uri=True, check_same_thread=False)
+
+    def query(self, sql, params):
+        with self.lock:
+            return [ json.loads(zlib.decompress(row[0])) for row in self.conn.execute(sql, params) ]
+
+    def get(self, arxivid):
+        from imbibe import normalize_arxivid
+        results = self.query("SELECT record FROM papers WHERE id = ?", (normalize_arxivid(arxivid),))
+        if len(results) == 0:
+            return None
+        result = results[0]
+        if normalize_arxivid(arxivid) != arxivid:
+            # A specific version was asked for.
+            result['id'] = 'http://arxiv.org/abs/' + arxivid
+        return result
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        if id_list:
+            results = []
+            missing = []
+            for arxivid in id_list:
+                result = self.get(arxivid)
+                if result is None:
+                    missing.append(arxivid)
+                else:
+                    results.append(result)
+            if len(missing) > 0:
+                results += self.backend.arxiv_search(None, missing, len(missing))
+            return results[:max_results]
+
+        if query is None:
+            return []
+        if looks_like_doi(query):
+            results = self.query("SELECT papers.record FROM dois JOIN papers ON dois.id = papers.id "
+                                 "WHERE dois.doi = ? LIMIT ?", (query.lower(), max_results))
+            for result in results:
+                result['doi'] = query
+        else:
+            results = self.query("SELECT record FROM papers WHERE title = ? LIMIT ?",
+                                 (title_key(query), max_results))
+        if len(results) > 0:
+            return results
+        return self.backend.arxiv_search(query, None, max_results)
+
+    def crossref_works(self, **kwargs):
+        return self.backend.crossref_works(**kwargs)
+
+    def http_get(self, url):
+        return self.backend.http_get(url)
+
+    def save(self):
+        self.backend.save()
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m imbibe.arxivsnapshot',
+            description="Build the index used by imbibe's --arxiv-snapshot option from arXiv's "
+                        "bulk metadata snapshot (optionally compressed with gzip or bzip2).")
+    parser.add_argument("snapshot")
+    parser.add_argument("index", nargs='?',
+            help="Where to write the index (default: arxiv-snapshot.sqlite in imbibe's user "
+                 "cache directory).")
+    args = parser.parse_args()
+
+    index = args.index if args.index is not None else default_index_filename()
+    n = ingest(args.snapshot, index)
+    print("Indexed " + str(n) + " papers in " + index + ".", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
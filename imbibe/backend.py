@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import threading
+import functools
+
+# All of imbibe's network traffic (Crossref, arXiv and plain HTTP requests to
+# doi.org and publishers) goes through the backend returned by get_backend().
+# Besides the live backend, a run can record every request and its response
+# into a cassette file, and later runs can replay them from that file without
+# any network access.
+#
+# Backends have three methods:
+#   crossref_works(**kwargs)  the JSON response of habanero's Crossref.works()
+#   arxiv_search(query=None, id_list=None, max_results=10)
+#                             a list of dicts with the keys 'id' (the abstract
+#                             URL), 'authors', 'title', 'summary' and 'doi'
+#   http_get(url)             (URL after redirects, response body as bytes)
+# and raise HTTPError for HTTP error responses from Crossref, arXiv or http_get().
+
+CASSETTE_VERSION = 1
+
+class HTTPError(Exception):
+    def __init__(self, url, status):
+        Exception.__init__(self, "HTTP error " + str(status) + " for " + url)
+        self.url = url
+        self.status = status
+
+class CassetteMissError(Exception):
+    pass
+
+CROSSREF_WORKS_URL = "https://api.crossref.org/works"
+
+@functools.lru_cache(maxsize=None)
+def crossref_client():
+    import habanero
+    return habanero.Crossref(ua_string = "imbibe")
+
+@functools.lru_cache(maxsize=None)
+def arxiv_client():
+    # A single client is shared by all queries so that it can space them out
+    # by arXiv's requested delay of 3 seconds. Larger queries are paginated.
+    import arxiv
+    return arxiv.Client(page_size=100, delay_seconds=3.)
+
+def _http_status(e):
+    # The HTTP status of an error raised for an HTTP error response, or None
+    # for other errors. habanero raises its RequestError, which has the
+    # status, for JSON error responses, and otherwise whatever error the HTTP
+    # library it uses (requests or httpx, depending on the version) raises,
+    # which has the response.
+    try:
+        status = getattr(e, 'status_code', None)
+        if status is None:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+    except RuntimeError:
+        return None
+    return status if isinstance(status, int) else None
+
+class LiveBackend(object):
+    def crossref_works(self, **kwargs):
+        try:
+            return crossref_client().works(**kwargs)
+        except Exception as e:
+            status = _http_status(e)
+            if status is None:
+                raise
+            raise HTTPError(CROSSREF_WORKS_URL, status)
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        import arxiv
+        search = arxiv.Search(query=(query or ''), id_list=(id_list or []), max_results=max_results)
+        try:
+            results = list(arxiv_client().results(search))
+        except arxiv.HTTPError as e:
+            raise HTTPError(e.url, e.status)
+        return [ { 'id': result.entry_id,
+                   'authors': [ str(author) for author in result.authors ],
+                   'title': result.title,
+                   'summary': result.summary,
+                   'doi': result.doi } for result in results ]
+
+    def http_get(self, url):
+        import urllib.request
+        import urllib.error
+        try:
+            with urllib.request.urlopen(url) as f:
+                return f.geturl(), f.read()
+        except urllib.error.HTTPError as e:
+            raise HTTPError(url, e.code)
+
+    def save(self):
+        pass
+
+def _interaction_key(kind, request):
+    return kind + ' ' + json.dumps(request, sort_keys=True)
+
+def _encode_http_response(response):
+    import base64
+    url,body = response
+    return [ url, base64.b64encode(body).decode('ascii') ]
+
+def _decode_http_response(response):
+    import base64
+    url,body = response
+    return url, base64.b64decode(body)
+
+def read_cassette(filename):
+    with open(filename, 'rb') as f:
+        cassette = json.load(f)
+    if cassette.get('version') != CASSETTE_VERSION:
+        raise ValueError("Unsupported cassette version in " + filename)
+    return cassette['interactions']
+
+class RecordingBackend(object):
+    # Passes requests on to another backend (the live one by default) and
+    # records them. Recording into an existing cassette adds to it.
+    def __init__(self, filename, backend=None):
+        self.filename = filename
+        self.backend = LiveBackend() if backend is None else backend
+        self.lock = threading.Lock()
+        self.interactions = {}
+        if os.path.exists(filename):
+            for interaction in read_cassette(filename):
+                self.interactions[_interaction_key(interaction['kind'], interaction['request'])] = interaction
+
+    def record(self, kind, request, call):
+        interaction = { 'kind': kind, 'request': request }
+        start = time.monotonic()
+        try:
+            interaction['response'] = call()
+        except HTTPError as e:
+            interaction['error'] = { 'url': e.url, 'status': e.status }
+        interaction['elapsed'] = time.monotonic() - start
+        with self.lock:
+            self.interactions[_interaction_key(kind, request)] = interaction
+        if 'error' in interaction:
+            raise HTTPError(interaction['error']['url'], interaction['error']['status'])
+        return interaction['response']
+
+    def crossref_works(self, **kwargs):
+        return self.record('crossref', kwargs, lambda: self.backend.crossref_works(**kwargs))
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        return self.record('arxiv', { 'query': query, 'id_list': id_list, 'max_results': max_results },
+                lambda: self.backend.arxiv_search(query, id_list, max_results))
+
+    def http_get(self, url):
+        return _decode_http_response(self.record('http', { 'url': url },
+                lambda: _encode_http_response(self.backend.http_get(url))))
+
+    def save(self):
+        from imbibe.cache import write_atomically
+        with self.lock:
+            interactions = list(self.interactions.values())
+        write_atomically(self.filename, json.dumps(
+            { 'version': CASSETTE_VERSION, 'interactions': interactions }, indent=1))
+
+class ReplayBackend(object):
+    # Serves requests from a cassette, optionally waiting `latency` seconds
+    # for each one to simulate the network. Requests that weren't recorded
+    # raise CassetteMissError.
+    def __init__(self, filename, latency=0.):
+        self.filename = filename
+        self.latency = latency
+        self.interactions = {}
+        for interaction in read_cassette(filename):
+            self.interactions[_interaction_key(interaction['kind'], interaction['request'])] = interaction
+
+    def replay(self, kind, request):
+        try:
+            interaction = self.interactions[_interaction_key(kind, request)]
+        except KeyError:
+            raise CassetteMissError("Request not found in cassette " + self.filename + ": "
+                    + _interaction_key(kind, request))
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if 'error' in interaction:
+            raise HTTPError(interaction['error']['url'], interaction['error']['status'])
+        return interaction['response']
+
+    def crossref_works(self, **kwargs):
+        return self.replay('crossref', kwargs)
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        return self.replay('arxiv', { 'query': query, 'id_list': id_list, 'max_results': max_results })
+
+    def http_get(self, url):
+        return _decode_http_response(self.replay('http', { 'url': url }))
+
+    def save(self):
+        pass
+
+class NetworkDisabledError(Exception):
+    pass
+
+class OfflineBackend(object):
+    # Refuses all requests. Used underneath the snapshot backends to make
+    # sure a run doesn't touch the network.
+    def refuse(self, what):
+        raise NetworkDisabledError("Network access is disabled, but " + what + " is not available offline.")
+
+    def crossref_works(self, **kwargs):
+        self.refuse("Crossref query " + json.dumps(kwargs, sort_keys=True))
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        if id_list:
+            self.refuse("arXiv metadata for " + ", ".join(id_list))
+        self.refuse("arXiv search for '" + str(query) + "'")
+
+    def http_get(self, url):
+        self.refuse(url)
+
+    def save(self):
+        pass
+
+class RateLimitedBackend(object):
+    # Passes requests on to another backend, spacing out those of each kind
+    # so that at most rates[kind] of them are made per second, however many
+    # threads share the backend.
+    def __init__(self, backend, rates):
+        from imbibe import RateLimiter
+        self.backend = backend
+        self.limiters = dict( (kind, RateLimiter(rate)) for kind,rate in rates.items() )
+
+    def wait(self, kind):
+        if kind in self.limiters:
+            self.limiters[kind].wait()
+
+    def crossref_works(self, **kwargs):
+        self.wait('crossref')
+        return self.backend.crossref_works(**kwargs)
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        self.wait('arxiv')
+        return self.backend.arxiv_search(query, id_list, max_results)
+
+    def http_get(self, url):
+        self.wait('http')
+        return self.backend.http_get(url)
+
+    def save(self):
+        self.backend.save()
+
+_backend = None
+
+def get_backend():
+    # The default backend goes through the resolver daemon (see imbibe.daemon)
+    # if one is running, and straight to the servers otherwise.
+    global _backend
+    if _backend is None:
+        from imbibe import daemon
+        _backend = daemon.connect(LiveBackend()) or LiveBackend()
+    return _backend
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import contextlib
+
+# Regenerates the BibTeX files of many projects in one run ("imbibe --batch
+# MANIFEST"). The manifest is a JSON list with one object per project:
+#
+#     [ { "input": "paper1/refs.txt", "output": "paper1/refs.bib" },
+#       { "input": "paper2/refs.txt", "output": "paper2/refs.bib",
+#         "cache": "paper2/imbibe-cache.json", "flags": [ "--eprint-as-note" ] } ]
+#
+# Paths are relative to the directory of the manifest. The cache defaults to
+# imbibe-cache.json (or .sqlite, with --cache-backend) next to the input file;
+# a cache given explicitly uses the backend its extension names. The flags
+# are any of imbibe's options that affect the output, and --cache-backend.
+# Each project's capitalized_words.txt and journal_abbrev.csv are looked for
+# in the directory of its input file, as if imbibe had been run there.
+#
+# The entries of all projects are looked up together, so a paper cited by
+# several projects, or missing from several caches, is fetched only once.
+# The lookups use the options given on the command line together with
+# --batch, so options affecting them are an error in the manifest. Each
+# project's records then go into its own cache.
+
+# Options that only the command line can give: their dests, and how to say
+# them in error messages.
+BATCH_ONLY_OPTIONS = { 'refresh_eprints': '--refresh-eprints',
+                       'refresh_eprints_after': '--refresh-eprints-after', 'crossref_workers': '--crossref-workers',
+                       'crossref_rate': '--crossref-rate', 'crossref_batch_size': '--crossref-batch-size',
+                       'arxiv_chunk_size': '--arxiv-chunk-size', 'arxiv_snapshot': '--arxiv-snapshot',
+                       'crossref_snapshot': '--crossref-snapshot', 'shared_cache': '--no-shared-cache',
+                       'cache_max_age': '--cache-max-age', 'daemon': '--no-daemon', 'record': '--record',
+                       'replay': '--replay', 'offline': '--offline', 'replay_latency': '--replay-latency',
+                       'profile': '--profile', 'profile_json': '--profile-json', 'watch': '--watch',
+                       'watch_interval': '--watch-interval' }
+CACHE_BACKENDS = { '.json': 'json', '.sqlite': 'sqlite' }
+
+class Project(object):
+    def __init__(self, entry, basedir, args, parser):
+        self.input = os.path.abspath(os.path.join(basedir, entry['input']))
+        self.output = os.path.abspath(os.path.join(basedir, entry['output']))
+        self.directory = os.path.dirname(self.input)
+        self.args = parser.parse_args(list(entry.get('flags', [])) + [ self.input, self.output ])
+        for dest,option in BATCH_ONLY_OPTIONS.items():
+            if getattr(self.args, dest) != parser.get_default(dest):
+                parser.error(option + " can't be given for a single project in the manifest ("
+                             + entry['input'] + "); give it together with --batch instead")
+        if 'cache' in entry:
+            self.cache_filename = os.path.abspath(os.path.join(basedir, entry['cache']))
+            self.cache_backend = CACHE_BACKENDS.get(os.path.splitext(self.cache_filename)[1],
+                                                    self.args.cache_backend)
+        else:
+            self.cache_backend = self.args.cache_backend
+            self.cache_filename = os.path.join(self.directory, "imbibe-cache." + self.cache_backend)
+        self.cache = None
+        self.lines = []
+        self.bibitems = []
+
+def read_manifest(filename, args, parser):
+    with open(filename, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    basedir = os.path.dirname(os.path.abspath(filename))
+    return [ Project(entry, basedir, args, parser) for entry in entries ]
+
+@contextlib.contextmanager
+def in_directory(dirname):
+    # Files looked for in the current directory (capitalized_words.txt and
+    # journal_abbrev.csv) are those of the project.
+    import imbibe
+    olddir = os.getcwd()
+    os.chdir(dirname)
+    imbibe.get_protected_words.cache_clear()
+    imbibe.get_protected_words_uppercase.cache_clear()
+    imbibe.reload_journal_abbreviations()
+    try:
+        yield
+    finally:
+        os.chdir(olddir)
+
+class BatchCacheStore(object):
+    # Stands in for the project cache while the entries of all projects are
+    # looked up: records are taken from whichever project has them, and new
+    # ones are kept until they are copied to the projects that need them.
+    # Taking a record doesn't count as a use of it in the project it comes
+    # from; only the projects citing it are marked as using it. Records taken
+    # are remembered too, since the project they come from may drop them
+    # when its cache is compacted.
+    def __init__(self, stores):
+        self.stores = stores
+        self.added = {}
+        self.taken = {}
+
+    def get(self, key):
+        if key in self.added:
+            return self.added[key]
+        if key in self.taken:
+            return self.taken[key]
+        for store in self.stores:
+            value = store.peek(key)
+            if value is not None:
+                self.taken[key] = value
+                return value
+        return None
+
+    def put(self, key, value):
+        self.added[key] = value
+
+def metadata_keys(bibitem):
+    import imbibe
+    keys = []
+    if bibitem.arxivid is not None:
+        keys.append(imbibe.arxiv_cache_key(bibitem.arxivid))
+    if bibitem.doi is not None:
+        keys.append(imbibe.doi_cache_key(bibitem.doi))
+    return keys
+
+def run_batch(args, parser):
+    import imbibe
+    from imbibe import profiling
+    from imbibe import BibItem
+
+    profile = None
+    if args.profile or args.profile_json is not None:
+        profile = profiling.start()
+
+    projects = read_manifest(args.batch, args, parser)
+    failed = False
+
+    ok = []
+    for project in projects:
+        with in_directory(project.directory):
+            with profiling.phase('load cache'):
+                BibItem.load_cache(project.cache_filename, project.cache_backend)
+                project.cache = BibItem.cache
+            try:
+                with profiling.phase('read input'):
+                    project.lines, project.bibitems = imbibe.read_input_file(project.input)
+            except (OSError, RuntimeError, ValueError, IndexError) as e:
+                print("Error reading " + project.input + ": " + str(e), file=sys.stderr)
+                project.cache.close()
+                failed = True
+                continue
+        ok.append(project)
+    projects = ok
+
+    BibItem.cache = BatchCacheStore([ project.cache for project in projects ])
+    bibitems = [ bibitem for project in projects for bibitem in project.bibitems ]
+    missing = set()
+    try:
+        with profiling.phase('arXiv'):
+            imbibe.populate_arxiv_information(bibitems, args.refresh_eprints, args.arxiv_chunk_size,
+                                              args.refresh_eprints_after)
+    except imbibe.ArxivIDNotFoundError as e:
+        missing = set(e.missing_ids)
+    with profiling.phase('Crossref'):
+        imbibe.populate_doi_information([ b for b in bibitems if b.arxivid not in missing ],
+                args.crossref_workers, args.crossref_rate, args.crossref_batch_size)
+    with profiling.phase('APS'):
+        imbibe.populate_aps_information(bibitems)
+    batch_cache = BibItem.cache
+
+    # Every project gets the records it cites before any cache is compacted,
+    # which could drop records that other projects took from it.
+    for project in projects:
+        for bibitem in project.bibitems:
+            for key in metadata_keys(bibitem):
+                record = batch_cache.get(key)
+                if record is not None and project.cache.get(key) != record:
+                    project.cache.put(key, record)
+
+    for project in projects:
+        BibItem.cache = project.cache
+        not_found = [ b.arxivid for b in project.bibitems if b.arxivid in missing ]
+        if len(not_found) > 0:
+            for arxivid in not_found:
+                print(project.input + ": arXiv ID not found: " + arxivid, file=sys.stderr)
+            print("Not updated " + project.output + ".", file=sys.stderr)
+            failed = True
+        else:
+            imbibe.args = project.args
+            with in_directory(project.directory):
+                if project.args.duplicate_warnings:
+                    imbibe.report_duplicates(project.bibitems, project.lines)
+                with profiling.phase('render'):
+                    out = imbibe.new_output(project.args)
+                    imbibe.render_bibitems(project.args, project.bibitems, project.lines, out)
+                with profiling.phase('write output'):
+                    imbibe.write_output_if_changed(project.output, out.getvalue())
+
+        with profiling.phase('save cache'):
+            if BibItem.cache_max_age is not None:
+                project.cache.compact(BibItem.cache_max_age)
+            project.cache.save()
+        if profile is not None:
+            profile.add_bytes('cache read', project.cache.bytes_read)
+            profile.add_bytes('cache written', project.cache.bytes_written)
+
+    # The later projects may have taken records from the caches of earlier
+    # ones, so these are only closed at the end.
+    for project in projects:
+        project.cache.close()
+    BibItem.cache = None
+    with profiling.phase('save cache'):
+        BibItem.save_cache()
+
+    if profile is not None:
+        imbibe.report_profile(profile, args.profile, args.profile_json)
+    if failed:
+        sys.exit(1)
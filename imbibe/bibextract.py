@@ -1,8 +1,12 @@
 import imbibe
 import bibtexparser
 import sys
-import time
+import os
 import re
+import json
+import hashlib
+import argparse
+import threading
 
 def errprint(*s):
     return print(*s, file=sys.stderr)
@@ -44,7 +48,6 @@ def process_entry(entry):
     errprint(entry['ID'])
 
     match = imbibe.crossref_find_from_journalref(**kwargs)
-    time.sleep(1)
 
     if match is None:
         print("WARNING: lookup for article with bibtex ID " + entry['ID'] + " failed.",
@@ -66,35 +69,121 @@ def process_entry(entry):
 
     return id_ + ' [bibtex_id:' + entry['ID'] + ']'
 
-def process(bibdatabase):
-    lines = []
-    def process_entry_(entry):
+def entry_digest(entry):
+    # Identifies an entry in the checkpoint file, so that an entry which was
+    # edited since it was processed gets processed again.
+    return hashlib.sha1(json.dumps(entry, sort_keys=True).encode('utf-8')).hexdigest()
+
+class Checkpoint(object):
+    # The results of processed entries, one JSON object per line, appended as
+    # soon as each entry is done. An interrupted run leaves at worst a partial
+    # last line, which is ignored.
+    def __init__(self, filename):
+        self.filename = filename
+        self.results = {}
+        self.lock = threading.Lock()
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.results[record['digest']] = record['line']
+        except FileNotFoundError:
+            pass
+        self.f = open(filename, 'a', encoding='utf-8')
+
+    def add(self, digest, line):
+        with self.lock:
+            self.results[digest] = line
+            self.f.write(json.dumps({ 'digest': digest, 'line': line }) + '\n')
+            self.f.flush()
+
+    def remove(self):
+        self.f.close()
+        os.remove(self.filename)
+
+def process(bibdatabase, workers=4, checkpoint=None):
+    # Entries are processed by a pool of worker threads; the requests they
+    # make are rate-limited by the backend. Entries already in the checkpoint
+    # are not looked up again.
+    digests = [ entry_digest(entry) for entry in bibdatabase.entries ]
+    def process_entry_(item):
+        entry,digest = item
+        if checkpoint is not None and digest in checkpoint.results:
+            return checkpoint.results[digest]
         line = process_entry(entry)
-        if line is None:
-            return entry
-        else:
-            lines.append(line)
-            return None
-
-    bibdatabase.entries = [ process_entry_(entry) for entry in bibdatabase.entries ]
-    bibdatabase.entries = [ entry for entry in bibdatabase.entries if entry is not None ]
+        if checkpoint is not None:
+            checkpoint.add(digest, line)
+        return line
 
-    for line in lines:
-        print(line)
+    items = list(zip(bibdatabase.entries, digests))
+    if checkpoint is not None and len(checkpoint.results) > 0:
+        ndone = sum(1 for digest in digests if digest in checkpoint.results)
+        errprint("Resuming: " + str(ndone) + " of " + str(len(items)) + " entries already done.")
+    lines = imbibe.fetch_concurrently(process_entry_, items, workers, None)
 
-if __name__ == '__main__':
-    if sys.argv[1] == '--delete':
-        delete = True
-        filename = sys.argv[2]
-    else:
-        delete = False
-        filename = sys.argv[1]
+    bibdatabase.entries = [ entry for entry,line in zip(bibdatabase.entries, lines) if line is None ]
 
-    with open(filename, 'r') as f:
+    for line in lines:
+        if line is not None:
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(prog='bibextract')
+    parser.add_argument("--delete", action='store_true',
+            help="Remove the entries that were converted from the BibTeX file.")
+    parser.add_argument("--workers", type=int, default=4,
+            help="Number of entries to process at the same time (default: 4).")
+    parser.add_argument("--crossref-rate", type=float, default=2., dest='crossref_rate',
+            help="Maximum number of Crossref requests per second (default: 2).")
+    parser.add_argument("--arxiv-rate", type=float, default=1/3., dest='arxiv_rate',
+            help="Maximum number of arXiv requests per second (default: 1/3, "
+                 "as requested by arXiv).")
+    parser.add_argument("--checkpoint",
+            help="File in which to record the entries processed so far, so that an "
+                 "interrupted run can be resumed (default: FILENAME.bibextract-checkpoint).")
+    parser.add_argument("--no-lookup-cache", action='store_false', dest='lookup_cache',
+            help="Don't use or update the cache of journal reference and DOI lookups "
+                 "kept in the user cache directory.")
+    parser.add_argument("--arxiv-snapshot", nargs='?', const='', metavar='INDEX',
+            dest='arxiv_snapshot',
+            help="Find arXiv IDs in a local index of arXiv's metadata snapshot "
+                 "(see 'python -m imbibe.arxivsnapshot') before asking arXiv.")
+    parser.add_argument("--crossref-snapshot", nargs='?', const='', metavar='INDEX',
+            dest='crossref_snapshot',
+            help="Find journal references in a local index of Crossref's data "
+                 "(see 'python -m imbibe.crossrefsnapshot') before asking Crossref.")
+    parser.add_argument("filename")
+    args = parser.parse_args()
+
+    imbibe.use_lookup_cache = args.lookup_cache
+
+    from imbibe import backend
+    backend.set_backend(backend.RateLimitedBackend(backend.get_backend(),
+        { 'crossref': args.crossref_rate, 'arxiv': args.arxiv_rate }))
+    # Outside the rate limits, which only apply to what still goes to the servers.
+    imbibe.use_snapshots(args.arxiv_snapshot, args.crossref_snapshot)
+
+    with open(args.filename, 'r') as f:
         bibdatabase = bibtexparser.load(f)
 
-    process(bibdatabase)
+    if args.checkpoint is None:
+        args.checkpoint = args.filename + '.bibextract-checkpoint'
+    checkpoint = Checkpoint(args.checkpoint)
+
+    try:
+        process(bibdatabase, args.workers, checkpoint)
+    finally:
+        imbibe.save_lookup_cache()
 
-    if delete:
-        with open(filename, 'w') as f:
+    if args.delete:
+        with open(args.filename, 'w') as f:
             bibtexparser.dump(bibdatabase, f)
+
+    # Everything is done, so the next run should start from scratch.
+    checkpoint.remove()
+
+if __name__ == '__main__':
+    main()
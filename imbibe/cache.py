@@ -0,0 +1,517 @@
+import os
+import sys
+import json
+import tempfile
+import time
+import threading
+
+# Key-value stores used for imbibe's cache. Values are anything that can be
+# serialized to JSON with the `default` and `object_hook` functions that the
+# store was created with. Each store also has a few string-valued metadata
+# fields (e.g. the schema version of the entries).
+
+META_KEY = '__meta__'
+USED_KEY = '__used__'
+
+def write_atomically(filename, data, mode='w', encoding='utf-8', permissions=None):
+    # Writes to a temporary file in the same directory and renames it over
+    # `filename`, so that readers only ever see the old or the new contents.
+    # The file keeps its permissions unless `permissions` is given. If
+    # `filename` is a symbolic link, the file it points to is replaced.
+    filename = os.path.realpath(filename)
+    dirname = os.path.dirname(filename)
+    os.makedirs(dirname, exist_ok=True)
+    if permissions is None:
+        try:
+            permissions = os.stat(filename).st_mode & 0o777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            permissions = 0o666 & ~umask
+
+    fd,tmpname = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(filename) + '-')
+    try:
+        with os.fdopen(fd, mode, encoding=(None if 'b' in mode else encoding)) as f:
+            f.write(data)
+        os.chmod(tmpname, permissions)
+        os.replace(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+
+def lock_filename(filename):
+    # The lock file for `filename`. Lock files are kept in the user cache
+    # directory, so that none are left next to project caches in the user's
+    # paper directories.
+    import hashlib
+    from imbibe import user_cache_dir
+    key = hashlib.sha1(os.path.realpath(filename).encode('utf-8')).hexdigest()[0:16]
+    return os.path.join(user_cache_dir(), 'locks', os.path.basename(filename) + '-' + key + '.lock')
+
+class FileLock(object):
+    # Exclusive advisory lock on `filename`, held for the duration of a `with`
+    # block. Used to serialize imbibe processes writing the same cache file.
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        self.f = open(self.filename, 'a+b')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self.f.seek(0)
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        except:
+            self.f.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self.f.seek(0)
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.f.close()
+        return False
+
+def _file_stamp(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def today():
+    # Last-used times are kept as days since the epoch.
+    return int(time.time() // 86400)
+
+def _map_file(filename):
+    # Returns the contents of the file, memory-mapped so that only the parts
+    # which are actually read take up memory. On Windows, where a mapped file
+    # can't be replaced (as other imbibe processes saving it would), and for
+    # empty files, which can't be mapped, the contents are read instead.
+    with open(filename, 'rb') as f:
+        if os.name == 'nt' or os.fstat(f.fileno()).st_size == 0:
+            return f.read()
+        import mmap
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _index_lines(data):
+    # Returns a dict mapping each key of a cache file written by
+    # JsonCacheStore.save() to the (start, end) byte offsets of its value in
+    # `data`, or None if the file isn't laid out that way (e.g. it was written
+    # by an older version of imbibe, with json.dump(..., indent=2)).
+    if data[0:2] != b'{\n':
+        return None
+    offsets = {}
+    find = data.find
+    pos = 2
+    try:
+        while data[pos] == ord('"'):
+            eol = find(b'\n', pos)
+            sep = find(b'": ', pos, eol)
+            if eol < 0 or sep < 0:
+                return None
+            key = data[pos+1:sep]
+            if b'\\' in key:
+                # The key ends at the first '": ' whose quote isn't escaped.
+                while (len(key) - len(key.rstrip(b'\\'))) % 2 == 1:
+                    sep = find(b'": ', sep+1, eol)
+                    if sep < 0:
+                        return None
+                    key = data[pos+1:sep]
+                key = json.loads(b'"' + key + b'"')
+            else:
+                key = key.decode('utf-8')
+            offsets[key] = (sep+3, eol-1 if data[eol-1] == ord(',') else eol)
+            pos = eol + 1
+        if data[pos] != ord('}'):
+            return None
+    except (ValueError, IndexError):
+        return None
+    return offsets
+
+class JsonCacheStore(object):
+    # The whole cache lives in a single JSON file, with one entry per line.
+    # Opening the store maps the file into memory and only finds out where
+    # each entry is; an entry is read and decoded the first time it is asked
+    # for, so entries this run doesn't use cost next to nothing. save()
+    # rewrites the file, copying unchanged entries as they are. Other
+    # processes may save the same file concurrently, so save() holds a lock
+    # and merges this run's changes into whatever the file contains by then.
+    # The day each entry was last used is kept alongside, for compact().
+    def __init__(self, filename, default=None, object_hook=None):
+        self.filename = filename
+        self.default = default
+        self.object_hook = object_hook
+        self.decoder = json.JSONDecoder(object_hook=object_hook)
+        self.day = today()
+        self.data = b''
+        self.offsets = {}
+        self.entries = {}
+        self.meta = {}
+        self.used = {}
+        self.dirty = set()
+        self.deleted = set()
+        self.meta_dirty = False
+        self.used_dirty = False
+        self.is_new = False
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stamp = _file_stamp(filename)
+        try:
+            self.data, self.offsets, self.entries, self.meta, self.used = self.read()
+        except FileNotFoundError:
+            print("Warning: cache file not found.", file=sys.stderr)
+            self.is_new = True
+
+    def read(self):
+        data = _map_file(self.filename)
+        self.bytes_read += len(data)
+        offsets = _index_lines(data)
+        if offsets is None:
+            entries = json.loads(data[:], object_hook=self.object_hook)
+            meta = entries.pop(META_KEY, {})
+            used = entries.pop(USED_KEY, {})
+            _unmap(data)
+            return b'', {}, entries, meta, used
+
+        special = {}
+        for key in (META_KEY, USED_KEY):
+            if key in offsets:
+                start,end = offsets.pop(key)
+                special[key] = json.loads(data[start:end])
+        return data, offsets, {}, special.get(META_KEY, {}), special.get(USED_KEY, {})
+
+    def touch(self, key):
+        if self.used.get(key) != self.day:
+            self.used[key] = self.day
+            self.used_dirty = True
+
+    def get(self, key):
+        value = self.peek(key)
+        if value is not None:
+            self.touch(key)
+        return value
+
+    def peek(self, key):
+        # Like get(), but doesn't count as a use of the entry.
+        if key in self.entries:
+            return self.entries[key]
+        elif key in self.offsets:
+            start,end = self.offsets[key]
+            value = self.entries[key] = self.decoder.decode(self.data[start:end].decode('utf-8'))
+            return value
+        else:
+            return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.offsets.pop(key, None)
+        self.dirty.add(key)
+        self.deleted.discard(key)
+        self.touch(key)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+        self.offsets.pop(key, None)
+        self.used.pop(key, None)
+        self.dirty.discard(key)
+        self.deleted.add(key)
+
+    def keys(self):
+        return list(dict.fromkeys(list(self.offsets.keys()) + list(self.entries.keys())))
+
+    def get_meta(self, key):
+        return self.meta.get(key)
+
+    def set_meta(self, key, value):
+        self.meta[key] = value
+        self.meta_dirty = True
+
+    def changed(self):
+        return (len(self.dirty) > 0 or len(self.deleted) > 0 or self.meta_dirty
+                or self.used_dirty or self.stamp is None)
+
+    def compact(self, max_age):
+        # Deletes the entries that haven't been used for more than max_age
+        # days, and saves. Entries from before last-used days were recorded
+        # count as used today. Returns the number of entries deleted.
+        return self.write(max_age)
+
+    def save(self):
+        self.write(None)
+
+    def write(self, max_age):
+        if max_age is None and not self.changed():
+            return 0
+        with FileLock(lock_filename(self.filename)):
+            stamp = _file_stamp(self.filename)
+            if stamp != self.stamp:
+                self.merge()
+                self.stamp = stamp
+
+            # Ages are judged by the last-used days merged with those of
+            # other processes, so nothing they have used lately is deleted.
+            removed = 0
+            if max_age is not None:
+                cutoff = self.day - max_age
+                for key in self.keys():
+                    day = self.used.get(key)
+                    if day is None:
+                        self.touch(key)
+                    elif day < cutoff:
+                        self.delete(key)
+                        removed += 1
+            if not self.changed():
+                return removed
+
+            # The offsets of the values in the new file are noted while
+            # writing it, as _index_lines() would find them.
+            special = []
+            if len(self.meta) > 0:
+                special.append((META_KEY, self.meta))
+            keys = self.keys()
+            used = dict( (key, self.used[key]) for key in keys if key in self.used )
+            if len(used) > 0:
+                special.append((USED_KEY, used))
+            chunks = [ b'{\n' ]
+            pos = 2
+            offsets = {}
+            for key,value in special:
+                chunk = (json.dumps(key) + ': ' + json.dumps(value) + ',\n').encode('utf-8')
+                chunks.append(chunk)
+                pos += len(chunk)
+            for key in keys:
+                if key in self.offsets and key not in self.dirty:
+                    start,end = self.offsets[key]
+                    value = self.data[start:end]
+                else:
+                    value = json.dumps(self.entries[key], default=self.default).encode('utf-8')
+                prefix = json.dumps(key).encode('utf-8') + b': '
+                offsets[key] = (pos + len(prefix), pos + len(prefix) + len(value))
+                chunks.append(prefix)
+                chunks.append(value)
+                chunks.append(b',\n')
+                pos += len(prefix) + len(value) + 2
+            if len(chunks) > 1:
+                chunks[-1] = chunks[-1][:-2] + b'\n'
+            chunks.append(b'}\n')
+            data = b''.join(chunks)
+
+            write_atomically(self.filename, data, mode='wb')
+            self.bytes_written += len(data)
+            self.stamp = _file_stamp(self.filename)
+            _unmap(self.data)
+            self.data = _map_file(self.filename)
+            self.offsets = offsets
+            self.dirty = set()
+            self.deleted = set()
+            self.meta_dirty = False
+            self.used_dirty = False
+            self.day = today()
+        return removed
+
+    def merge(self):
+        # Takes the entries from the file as another process left it, with
+        # this run's changes on top.
+        try:
+            data, offsets, entries, meta, used = self.read()
+        except FileNotFoundError:
+            data, offsets, entries, meta, used = b'', {}, {}, {}, {}
+        for key in self.deleted:
+            offsets.pop(key, None)
+            entries.pop(key, None)
+            used.pop(key, None)
+        for key in self.dirty:
+            offsets.pop(key, None)
+            entries[key] = self.entries[key]
+        meta.update(self.meta)
+        for key,day in self.used.items():
+            used[key] = max(day, used.get(key, day))
+        _unmap(self.data)
+        self.data, self.offsets, self.entries, self.meta, self.used = data, offsets, entries, meta, used
+
+    def close(self):
+        _unmap(self.data)
+        self.data = b''
+        self.offsets = {}
+
+def _unmap(data):
+    if not isinstance(data, bytes):
+        data.close()
+
+class SqliteCacheStore(object):
+    # Entries are read from the database one at a time when they are asked for,
+    # and save() only writes the entries passed to put() whose serialization
+    # differs from what is already stored, in a single transaction, along with
+    # the day on which entries were last used.
+    def __init__(self, filename, default=None, object_hook=None):
+        self.filename = filename
+        self.default = default
+        self.object_hook = object_hook
+        self.stored = {}
+        self.pending = {}
+        self.deleted = set()
+        self.touched = set()
+        self.lock = threading.RLock()
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        import sqlite3
+        is_new = not os.path.exists(filename)
+        self.conn = sqlite3.connect(filename, timeout=30, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                          "used INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if 'used' not in [ row[1] for row in self.conn.execute("PRAGMA table_info(entries)") ]:
+            try:
+                self.conn.execute("ALTER TABLE entries ADD COLUMN used INTEGER")
+            except sqlite3.OperationalError:
+                # Another process got there first.
+                pass
+        self.is_new = is_new
+
+    def encode(self, value):
+        return json.dumps(value, default=self.default)
+
+    def get(self, key):
+        return self.read(key, True)
+
+    def peek(self, key):
+        # Like get(), but doesn't count as a use of the entry.
+        return self.read(key, False)
+
+    def read(self, key, touch):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            if key in self.deleted:
+                return None
+            row = self.conn.execute("SELECT value, used FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.stored[key] = row[0]
+            if touch and row[1] != today():
+                self.touched.add(key)
+            self.bytes_read += len(row[0])
+            return json.loads(row[0], object_hook=self.object_hook)
+
+    def put(self, key, value):
+        with self.lock:
+            self.pending[key] = value
+            self.deleted.discard(key)
+            self.touched.add(key)
+
+    def delete(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+            self.stored.pop(key, None)
+            self.deleted.add(key)
+
+    def keys(self):
+        with self.lock:
+            keys = set(k for (k,) in self.conn.execute("SELECT key FROM entries"))
+            return list(keys.union(self.pending.keys()).difference(self.deleted))
+
+    def save(self):
+        with self.lock:
+            day = today()
+            updates = []
+            for key,value in self.pending.items():
+                text = self.encode(value)
+                if self.stored.get(key) != text:
+                    updates.append((key, text, day))
+            touched = [ (day, key) for key in self.touched if key not in self.deleted ]
+            if len(updates) > 0 or len(self.deleted) > 0 or len(touched) > 0:
+                with self.transaction():
+                    self.conn.executemany("UPDATE entries SET used = ? WHERE key = ?", touched)
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO entries (key, value, used) VALUES (?, ?, ?)", updates)
+                    self.conn.executemany("DELETE FROM entries WHERE key = ?",
+                            ( (key,) for key in self.deleted ))
+                for key,text,day in updates:
+                    self.stored[key] = text
+                    self.bytes_written += len(text)
+                self.deleted = set()
+                self.touched = set()
+            # Everything is in the database now; later reads go there, so
+            # that they see what compact() deletes.
+            self.pending = {}
+
+    def compact(self, max_age):
+        # Deletes the entries that haven't been used for more than max_age
+        # days, after saving. Entries from before last-used days were recorded
+        # count as used today.
+        self.save()
+        with self.lock, self.transaction():
+            self.conn.execute("UPDATE entries SET used = ? WHERE used IS NULL", (today(),))
+            removed = self.conn.execute("DELETE FROM entries WHERE used < ?", (today() - max_age,)).rowcount
+            self.stored = {}
+        return removed
+
+    def transaction(self):
+        return _SqliteTransaction(self.conn)
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def migrate_from_json(self, json_filename):
+        # One-time import of all the entries of a JSON cache file.
+        with open(json_filename, 'rb') as f:
+            entries = json.load(f)
+        meta = entries.pop(META_KEY, {})
+        used = entries.pop(USED_KEY, {})
+        with self.lock, self.transaction():
+            self.conn.executemany("INSERT OR REPLACE INTO entries (key, value, used) VALUES (?, ?, ?)",
+                    ( (key, json.dumps(value), used.get(key)) for key,value in entries.items() ))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)",
+                    (os.path.abspath(json_filename),))
+            self.conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    meta.items())
+        return len(entries)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class _SqliteTransaction(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+def open_store(filename, backend, default=None, object_hook=None):
+    if backend == 'json':
+        return JsonCacheStore(filename, default, object_hook)
+    elif backend == 'sqlite':
+        return SqliteCacheStore(filename, default, object_hook)
+    else:
+        raise ValueError("Unknown cache backend: '" + backend + "'")
@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import zlib
+import argparse
+import threading
+
+# Local copy of part of Crossref's metadata, built from the compressed
+# JSON-lines files of Crossref's public data file. Works are stored in an
+# SQLite database, with only the fields imbibe uses, and indexed by DOI, by
+# (journal or ISSN, article number or first page, year) and by title, so that the
+# queries made by crossref_read and crossref_find_from_journalref can be
+# answered locally. Build it with e.g.
+#
+#     python -m imbibe.crossrefsnapshot --issn 2469-9950 --issn 2469-9969 DATADIR
+#
+# and use it with "imbibe --crossref-snapshot".
+
+kept_fields = [ 'DOI', 'type', 'container-title', 'short-container-title', 'author', 'publisher',
+                'issued', 'published-print', 'published-online', 'title', 'volume', 'issue',
+                'page', 'article-number', 'ISSN', 'issn-type' ]
+
+def default_index_filename():
+    from imbibe import user_cache_dir
+    return os.path.join(user_cache_dir(), 'crossref-snapshot.sqlite')
+
+def normalize_name(s):
+    return ' '.join(s.lower().split())
+
+def title_key(title):
+    from imbibe import canonicalize_title
+    return ' '.join(canonicalize_title(title).split())
+
+def first_page(number):
+    return number.replace(' ', '').split('-')[0].lower()
+
+def item_years(item):
+    years = set()
+    for field in ('issued', 'published-print', 'published-online'):
+        try:
+            years.add(int(item[field]['date-parts'][0][0]))
+        except (KeyError, IndexError, TypeError, ValueError):
+            pass
+    return years
+
+def data_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(('.json', '.jsonl', '.json.gz', '.jsonl.gz')):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def read_items(filename):
+    # Files contain either one work per line, or (as in older releases of the
+    # public data file) a JSON object with a list of works under "items".
+    if filename.endswith('.gz'):
+        import gzip
+        f = gzip.open(filename, 'rt', encoding='utf-8')
+    else:
+        f = open(filename, 'r', encoding='utf-8')
+    with f:
+        first = f.read(1)
+        f.seek(0)
+        if first == '{' and not filename.endswith(('.jsonl', '.jsonl.gz')):
+            data = json.load(f)
+            if 'items' in data:
+                yield from data['items']
+                return
+            yield data
+            return
+        for line in f:
+            if line.strip() != '':
+                yield json.loads(line)
+
+class ItemFilter(object):
+    def __init__(self, issns=(), publishers=(), prefixes=()):
+        self.issns = set(issn.lower() for issn in issns)
+        self.publishers = [ publisher.lower() for publisher in publishers ]
+        self.prefixes = [ prefix.lower() for prefix in prefixes ]
+
+    def __call__(self, item):
+        if len(self.issns) == 0 and len(self.publishers) == 0 and len(self.prefixes) == 0:
+            return True
+        if any(issn.lower() in self.issns for issn in item.get('ISSN', [])):
+            return True
+        publisher = item.get('publisher', '').lower()
+        if any(p in publisher for p in self.publishers):
+            return True
+        doi = item.get('DOI', '').lower()
+        return any(doi.startswith(prefix) for prefix in self.prefixes)
+
+def create_tables(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS works (doi TEXT PRIMARY KEY, record BLOB NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS journalrefs (journal TEXT NOT NULL, number TEXT NOT NULL, "
+                 "year INTEGER, doi TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS titles (title TEXT NOT NULL, year INTEGER, doi TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS journals (journal TEXT PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS issns (issn TEXT NOT NULL, journal TEXT NOT NULL, "
+                 "PRIMARY KEY (issn, journal))")
+    conn.execute("CREATE INDEX IF NOT EXISTS journalrefs_key ON journalrefs (journal, number)")
+    conn.execute("CREATE INDEX IF NOT EXISTS titles_title ON titles (title)")
+    conn.execute("CREATE INDEX IF NOT EXISTS journalrefs_doi ON journalrefs (doi)")
+    conn.execute("CREATE INDEX IF NOT EXISTS titles_doi ON titles (doi)")
+
+def ingest(paths, index_filename, item_filter, batch_size=10000):
+    # Adds the works in the given files (or directories of files) that pass
+    # item_filter to the index, creating it if necessary.
+    import sqlite3
+
+    os.makedirs(os.path.dirname(os.path.abspath(index_filename)), exist_ok=True)
+    conn = sqlite3.connect(index_filename, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    create_tables(conn)
+
+    rows = { 'works': [], 'journalrefs': [], 'titles': [], 'journals': set(), 'issns': set() }
+    def flush():
+        conn.execute("BEGIN")
+        dois = [ (doi,) for doi,record in rows['works'] ]
+        conn.executemany("DELETE FROM journalrefs WHERE doi = ?", dois)
+        conn.executemany("DELETE FROM titles WHERE doi = ?", dois)
+        conn.executemany("INSERT OR REPLACE INTO works (doi, record) VALUES (?, ?)", rows['works'])
+        conn.executemany("INSERT INTO journalrefs (journal, number, year, doi) VALUES (?, ?, ?, ?)",
+                rows['journalrefs'])
+        conn.executemany("INSERT INTO titles (title, year, doi) VALUES (?, ?, ?)", rows['titles'])
+        conn.executemany("INSERT OR IGNORE INTO journals (journal) VALUES (?)",
+                ( (journal,) for journal in rows['journals'] ))
+        conn.executemany("INSERT OR IGNORE INTO issns (issn, journal) VALUES (?, ?)", rows['issns'])
+        conn.execute("COMMIT")
+        for rowlist in rows.values():
+            rowlist.clear()
+
+    n = 0
+    nread = 0
+    for filename in data_files(paths):
+        for item in read_items(filename):
+            nread += 1
+            if 'DOI' not in item or not item_filter(item):
+                continue
+            doi = item['DOI'].lower()
+            record = dict( (field, item[field]) for field in kept_fields if field in item )
+            rows['works'].append((doi, zlib.compress(json.dumps(record).encode('utf-8'))))
+
+            years = item_years(item) or set([ None ])
+            journals = set(normalize_name(name) for field in ('container-title', 'short-container-title')
+                           for name in item.get(field, []))
+            numbers = set()
+            if 'article-number' in item:
+                numbers.add(first_page(item['article-number']))
+            if 'page' in item:
+                numbers.add(first_page(item['page']))
+            for journal in journals:
+                rows['journals'].add(journal)
+                for issn in item.get('ISSN', []):
+                    rows['issns'].add((issn.upper(), journal))
+                for number in numbers:
+                    for year in years:
+                        rows['journalrefs'].append((journal, number, year, doi))
+            for title in item.get('title', []):
+                for year in years:
+                    rows['titles'].append((title_key(title), year, doi))
+
+            n += 1
+            if len(rows['works']) >= batch_size:
+                flush()
+            if nread % 1000000 == 0:
+                print(str(nread) + " works read, " + str(n) + " kept...", file=sys.stderr)
+    flush()
+    conn.close()
+    return n
+
+def _filter_years(filter):
+    try:
+        return int(filter['from-pub-date'][:4]), int(filter['until-pub-date'][:4])
+    except (KeyError, ValueError):
+        return None, None
+
+class CrossrefSnapshotBackend(object):
+    # Answers Crossref requests from the index. Requests it can't answer are
+    # passed on to another backend: DOIs that aren't in it, and journal
+    # reference searches for journals that weren't ingested at all. arXiv and
+    # HTTP requests are passed on unchanged.
+    def __init__(self, filename, backend):
+        import sqlite3
+        if not os.path.exists(filename):
+            raise FileNotFoundError("Crossref snapshot index not found: " + filename)
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect('file:' + filename + '?mode=ro', uri=True, check_same_thread=False)
+        # Indexes made by older versions don't have the table of ISSNs.
+        self.has_issns = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                           "AND name = 'issns'").fetchone() is not None
+
+    def query(self, sql, params):
+        with self.lock:
+            return [ json.loads(zlib.decompress(row[0])) for row in self.conn.execute(sql, params) ]
+
+    def get(self, doi):
+        items = self.query("SELECT record FROM works WHERE doi = ?", (doi.lower(),))
+        return items[0] if len(items) > 0 else None
+
+    def has_journal(self, journal):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM journals WHERE journal = ?",
+                    (normalize_name(journal),)).fetchone() is not None
+
+    def journals(self, filter):
+        # The normalized names of the journals the filter asks for, or None
+        # if it doesn't restrict the journal (or does so in a way the index
+        # can't answer).
+        if 'container-title' in filter:
+            return [ normalize_name(filter['container-title']) ]
+        elif 'issn' in filter and self.has_issns:
+            issns = filter['issn'] if isinstance(filter['issn'], list) else [ filter['issn'] ]
+            with self.lock:
+                return [ row[0] for row in self.conn.execute(
+                    "SELECT DISTINCT journal FROM issns WHERE issn IN (%s)" % ','.join('?'*len(issns)),
+                    [ issn.upper() for issn in issns ]) ]
+        return None
+
+    def crossref_works(self, **kwargs):
+        ids = kwargs.get('ids')
+        filter = kwargs.get('filter', {})
+        query_bibliographic = kwargs.get('query_bibliographic')
+
+        if ids is not None:
+            item = self.get(ids)
+            if item is not None:
+                return { 'message': item }
+        elif set(filter.keys()) == set([ 'doi' ]) and query_bibliographic is None:
+            # Whatever is missing is looked up individually by crossref_read.
+            dois = filter['doi'] if isinstance(filter['doi'], list) else [ filter['doi'] ]
+            items = [ item for item in (self.get(doi) for doi in dois) if item is not None ]
+            return { 'message': { 'items': items } }
+        elif 'issn' not in filter or self.has_issns:
+            journals = self.journals(filter)
+            items = self.find(filter, journals, query_bibliographic, kwargs.get('limit') or 20)
+            if len(items) > 0 or (journals is not None and any(self.has_journal(j) for j in journals)):
+                return { 'message': { 'items': items } }
+        return self.backend.crossref_works(**kwargs)
+
+    def find(self, filter, journals, query_bibliographic, limit):
+        from_year,until_year = _filter_years(filter)
+        if from_year is None:
+            from_year,until_year = -10000, 10000
+
+        if query_bibliographic is not None:
+            items = self.query("SELECT works.record FROM titles JOIN works ON titles.doi = works.doi "
+                               "WHERE titles.title = ? AND titles.year BETWEEN ? AND ? LIMIT ?",
+                               (title_key(query_bibliographic), from_year, until_year, limit))
+            if journals is not None:
+                items = [ item for item in items if any(normalize_name(name) in journals for name in
+                          item.get('container-title', []) + item.get('short-container-title', [])) ]
+            return items
+        elif journals is not None and 'article-number' in filter:
+            items = {}
+            for journal in journals:
+                for item in self.query("SELECT DISTINCT works.record FROM journalrefs JOIN works "
+                                       "ON journalrefs.doi = works.doi WHERE journalrefs.journal = ? "
+                                       "AND journalrefs.number = ? AND journalrefs.year BETWEEN ? AND ? LIMIT ?",
+                                       (journal, first_page(filter['article-number']),
+                                        from_year, until_year, limit)):
+                    items[item['DOI'].lower()] = item
+            return list(items.values())[:limit]
+        return []
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        return self.backend.arxiv_search(query, id_list, max_results)
+
+    def http_get(self, url):
+        return self.backend.http_get(url)
+
+    def save(self):
+        self.backend.save()
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m imbibe.crossrefsnapshot',
+            description="Add works from Crossref's public data file (JSON-lines files, optionally "
+                        "gzipped, or directories of them) to the index used by imbibe's "
+                        "--crossref-snapshot option. Without any filters, all works are added.")
+    parser.add_argument("--issn", action='append', default=[],
+            help="Add works from the journal with this ISSN (may be repeated).")
+    parser.add_argument("--publisher", action='append', default=[],
+            help="Add works whose publisher name contains this text (may be repeated).")
+    parser.add_argument("--prefix", action='append', default=[],
+            help="Add works whose DOI starts with this prefix, e.g. 10.1103 (may be repeated).")
+    parser.add_argument("--index",
+            help="The index to add to (default: crossref-snapshot.sqlite in imbibe's user "
+                 "cache directory).")
+    parser.add_argument("paths", nargs='+')
+    args = parser.parse_args()
+
+    index = args.index if args.index is not None else default_index_filename()
+    n = ingest(args.paths, index, ItemFilter(args.issn, args.publisher, args.prefix))
+    print("Added " + str(n) + " works to " + index + ".", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
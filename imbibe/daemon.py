@@ -0,0 +1,376 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+# A resolver daemon for machines that run many imbibe processes at once, e.g.
+# a build server. Start it with
+#
+#     python -m imbibe.daemon
+#
+# It listens on a local HTTP port and makes the Crossref, arXiv and HTTP
+# requests of every imbibe process run by the same user. The port is written
+# to daemon.json in the user cache directory, together with a random token
+# that every request has to carry; only the user can read the file. Identical requests that are in flight
+# at the same time are merged into one upstream request, as are the single
+# DOIs and arXiv IDs of batched lookups; responses are kept in memory for a
+# while; and one rate limit per server applies to all of them. imbibe uses the
+# daemon automatically whenever it is running (see backend.get_backend()).
+
+DEFAULT_TTL = 3600.
+# How long a client waits for the daemon to answer a request before giving
+# up on it and fetching directly.
+REQUEST_TIMEOUT = 300.
+
+TOKEN_HEADER = 'X-Imbibe-Token'
+
+# The only requests clients make (see imbibe.backend).
+CROSSREF_ARGUMENTS = set([ 'ids', 'filter', 'query_bibliographic', 'limit' ])
+HTTP_HOSTS = set([ 'doi.org', 'dx.doi.org', 'journals.aps.org' ])
+
+def address_filename():
+    from imbibe import user_cache_dir
+    return os.path.join(user_cache_dir(), 'daemon.json')
+
+class RequestRejected(Exception):
+    pass
+
+class _Pending(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class Coalescer(object):
+    # Results of lookups by key, kept for `ttl` seconds. A lookup of a key
+    # that is already being looked up waits for that lookup instead of making
+    # its own. Errors are passed to everybody waiting but not kept. If a
+    # request for several keys is rejected (e.g. arXiv's HTTP 400 for a
+    # malformed ID), the error goes to everybody waiting for any of them;
+    # the clients then narrow it down themselves (see imbibe._search_arxiv),
+    # which takes far fewer requests than trying each key on its own.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results = {}
+        self.pending = {}
+        self.last_purge = time.monotonic()
+        self.upstream = 0
+        self.merged = 0
+        self.hits = 0
+
+    def get_many(self, keys, fetch):
+        # fetch(keys) makes a single upstream request for the given keys and
+        # returns a dict mapping them to their values, leaving out keys for
+        # which there is no result. Returns a dict mapping each of `keys`
+        # that has a result to its value.
+        now = time.monotonic()
+        mine = []
+        waiting = {}
+        values = {}
+        with self.lock:
+            for key in keys:
+                if key in values or key in waiting:
+                    continue
+                elif key in self.results and now - self.results[key][0] < self.ttl:
+                    self.hits += 1
+                    if self.results[key][1] is not None:
+                        values[key] = self.results[key][1]
+                elif key in self.pending:
+                    self.merged += 1
+                    waiting[key] = self.pending[key]
+                else:
+                    waiting[key] = self.pending[key] = _Pending()
+                    mine.append(key)
+
+        if len(mine) > 0:
+            # Those waiting for the keys are let go however fetch() ends. If
+            # it doesn't return or raise an ordinary exception (e.g. the
+            # thread gets a KeyboardInterrupt), they get this error.
+            fetched = {}
+            error = RuntimeError("lookup interrupted")
+            try:
+                fetched = fetch(mine)
+                error = None
+            except Exception as e:
+                error = e
+            finally:
+                with self.lock:
+                    self.upstream += 1
+                    now = time.monotonic()
+                    for key in mine:
+                        pending = self.pending.pop(key)
+                        if error is not None:
+                            pending.error = error
+                        else:
+                            pending.value = fetched.get(key)
+                            self.results[key] = (now, pending.value)
+                        pending.event.set()
+                    self.purge(now)
+
+        for key,pending in waiting.items():
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            if pending.value is not None:
+                values[key] = pending.value
+        return values
+
+    def get(self, key, fetch):
+        return self.get_many([ key ], lambda keys: { key: fetch() }).get(key)
+
+    def purge(self, now):
+        if now - self.last_purge < self.ttl:
+            return
+        self.last_purge = now
+        for key in [ key for key,(t,value) in self.results.items() if now - t >= self.ttl ]:
+            del self.results[key]
+
+def _match_arxiv_results(arxiv_ids, results):
+    from imbibe import normalize_arxivid
+    if len(arxiv_ids) == 1 and len(results) == 1:
+        return { arxiv_ids[0]: results[0] }
+    matched = {}
+    for result in results:
+        resultid = result['id'].split('arxiv.org/abs/')[-1]
+        for arxivid in arxiv_ids:
+            if arxivid == resultid or arxivid == normalize_arxivid(resultid):
+                matched[arxivid] = result
+    return matched
+
+class Resolver(object):
+    # Answers the requests of the backend interface (see imbibe.backend) from
+    # the coalescer, going to `backend` for anything it doesn't have.
+    def __init__(self, backend, ttl=DEFAULT_TTL):
+        self.backend = backend
+        self.coalescer = Coalescer(ttl)
+
+    def crossref_works(self, **kwargs):
+        if not set(kwargs.keys()) <= CROSSREF_ARGUMENTS:
+            raise RequestRejected("unsupported Crossref arguments")
+        filter = kwargs.get('filter', {})
+        if set(kwargs.keys()) <= set([ 'filter', 'limit' ]) and set(filter.keys()) == set([ 'doi' ]):
+            # A batch of DOIs, as made by crossref_read_batch. Each DOI is
+            # looked up only once, whichever batches it appears in.
+            dois = filter['doi'] if isinstance(filter['doi'], list) else [ filter['doi'] ]
+            def fetch(keys):
+                ret = self.backend.crossref_works(filter={ 'doi': [ key[4:] for key in keys ] },
+                                                  limit=len(keys))
+                return dict( ('doi:' + item['DOI'].lower(), item) for item in ret['message']['items'] )
+            items = self.coalescer.get_many([ 'doi:' + doi.lower() for doi in dois ], fetch)
+            return { 'message': { 'items': list(items.values()) } }
+        key = 'crossref ' + json.dumps(kwargs, sort_keys=True)
+        return self.coalescer.get(key, lambda: self.backend.crossref_works(**kwargs))
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        if id_list and query is None and max_results >= len(id_list):
+            def fetch(keys):
+                arxiv_ids = [ key[6:] for key in keys ]
+                results = self.backend.arxiv_search(None, arxiv_ids, len(arxiv_ids))
+                return dict( ('arXiv:' + arxivid, result) for arxivid,result
+                             in _match_arxiv_results(arxiv_ids, results).items() )
+            results = self.coalescer.get_many([ 'arXiv:' + arxivid for arxivid in id_list ], fetch)
+            return list(results.values())
+        key = 'arxiv ' + json.dumps([ query, id_list, max_results ])
+        return self.coalescer.get(key, lambda: self.backend.arxiv_search(query, id_list, max_results))
+
+    def http_get(self, url):
+        import urllib.parse
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme != 'https' or parsed.hostname not in HTTP_HOSTS:
+            raise RequestRejected("URL not allowed: " + url)
+        return self.coalescer.get('http ' + url, lambda: self.backend.http_get(url))
+
+    def stats(self):
+        with self.coalescer.lock:
+            return { 'upstream requests': self.coalescer.upstream,
+                     'merged': self.coalescer.merged,
+                     'cache hits': self.coalescer.hits,
+                     'cached': len(self.coalescer.results) }
+
+def make_server(resolver, token, port=0):
+    # Only requests carrying `token` are answered. Requesting JSON also keeps
+    # web pages from reaching the daemon, since browsers don't send such
+    # requests to other sites without asking them first.
+    import hmac
+    import http.server
+    from imbibe.backend import HTTPError, _encode_http_response
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def authorized(self):
+            if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), token):
+                self.send_error(403)
+                return False
+            return True
+
+        def do_POST(self):
+            if not self.authorized():
+                return
+            if self.headers.get('Content-Type', '').split(';')[0].strip() != 'application/json':
+                self.send_error(415)
+                return
+            kind = self.path.strip('/')
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if not isinstance(request, dict):
+                    raise RequestRejected("request is not a JSON object")
+                if kind == 'crossref':
+                    reply = { 'response': resolver.crossref_works(**request) }
+                elif kind == 'arxiv':
+                    reply = { 'response': resolver.arxiv_search(request['query'], request['id_list'],
+                                                                request['max_results']) }
+                elif kind == 'http':
+                    reply = { 'response': _encode_http_response(resolver.http_get(request['url'])) }
+                else:
+                    self.send_error(404)
+                    return
+            except HTTPError as e:
+                reply = { 'error': { 'url': e.url, 'status': e.status } }
+            except Exception as e:
+                reply = { 'exception': type(e).__name__ + ": " + str(e) }
+            self.reply(reply)
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            self.reply(resolver.stats())
+
+        def reply(self, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    return server
+
+class DaemonBackend(object):
+    # Sends requests to a running daemon. If the daemon goes away or stops
+    # answering, the rest of the run falls back to `fallback`, normally the
+    # live backend. A request the daemon can't answer for any other reason
+    # (it rejected it, or the upstream request failed other than with an
+    # HTTP error) is made directly, too.
+    def __init__(self, host, port, token, fallback):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.fallback = fallback
+        self.failed = False
+
+    def call(self, kind, request, direct):
+        import http.client
+        from imbibe import profiling
+        if self.failed:
+            return direct()
+        try:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=5)
+            conn.connect()
+            # Requests can wait a while for their turn under the rate limit.
+            conn.sock.settimeout(REQUEST_TIMEOUT)
+            conn.request('POST', '/' + kind, json.dumps(request),
+                         { 'Content-Type': 'application/json', TOKEN_HEADER: self.token })
+            response = conn.getresponse()
+            body = response.read()
+            conn.close()
+            if response.status != 200:
+                raise http.client.HTTPException("HTTP status " + str(response.status))
+            reply = json.loads(body)
+            profiling.count('daemon requests')
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            print("Warning: lost connection to the imbibe daemon (" + str(e) + "); "
+                  "fetching directly.", file=sys.stderr)
+            self.failed = True
+            return direct()
+        if 'error' in reply:
+            from imbibe.backend import HTTPError
+            raise HTTPError(reply['error']['url'], reply['error']['status'])
+        elif 'exception' in reply:
+            print("Warning: the imbibe daemon could not answer a request (" + reply['exception'] + "); "
+                  "fetching directly.", file=sys.stderr)
+            return direct()
+        return reply['response']
+
+    def crossref_works(self, **kwargs):
+        return self.call('crossref', kwargs, lambda: self.fallback.crossref_works(**kwargs))
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        return self.call('arxiv', { 'query': query, 'id_list': id_list, 'max_results': max_results },
+                lambda: self.fallback.arxiv_search(query, id_list, max_results))
+
+    def http_get(self, url):
+        from imbibe.backend import _decode_http_response, _encode_http_response
+        return _decode_http_response(self.call('http', { 'url': url },
+                lambda: _encode_http_response(self.fallback.http_get(url))))
+
+    def save(self):
+        pass
+
+def connect(fallback):
+    # Returns a DaemonBackend if a daemon is running, and None otherwise.
+    import socket
+    try:
+        with open(address_filename(), 'r') as f:
+            address = json.load(f)
+        socket.create_connection((address['host'], address['port']), timeout=0.5).close()
+        token = address['token']
+    except (OSError, ValueError, KeyError):
+        return None
+    return DaemonBackend(address['host'], address['port'], token, fallback)
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m imbibe.daemon',
+            description="Serve Crossref, arXiv and HTTP requests for all imbibe processes of "
+                        "this user, merging identical requests and sharing one rate limit.")
+    parser.add_argument("--port", type=int, default=0,
+            help="The local port to listen on (default: any free port).")
+    parser.add_argument("--crossref-rate", type=float, default=10., dest='crossref_rate',
+            help="Maximum number of Crossref requests per second (default: 10).")
+    parser.add_argument("--arxiv-rate", type=float, default=1/3., dest='arxiv_rate',
+            help="Maximum number of arXiv requests per second (default: 1/3).")
+    parser.add_argument("--http-rate", type=float, default=0., dest='http_rate',
+            help="Maximum number of other HTTP requests per second (default: no limit).")
+    parser.add_argument("--ttl", type=float, default=DEFAULT_TTL, metavar='SECONDS',
+            help="How long to keep responses in memory (default: 3600).")
+    args = parser.parse_args()
+
+    import secrets
+    from imbibe import backend, cache
+    upstream = backend.RateLimitedBackend(backend.LiveBackend(),
+            { 'crossref': args.crossref_rate, 'arxiv': args.arxiv_rate, 'http': args.http_rate })
+    resolver = Resolver(upstream, args.ttl)
+    token = secrets.token_hex(32)
+    server = make_server(resolver, token, args.port)
+    host,port = server.server_address[:2]
+
+    filename = address_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    cache.write_atomically(filename, json.dumps({ 'host': host, 'port': port, 'pid': os.getpid(),
+                                                  'token': token }), permissions=0o600)
+    print("imbibe daemon listening on " + host + ":" + str(port) + ".", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            with open(filename, 'r') as f:
+                if json.load(f).get('pid') == os.getpid():
+                    os.remove(filename)
+        except (OSError, ValueError):
+            pass
+        print(json.dumps(resolver.stats()), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
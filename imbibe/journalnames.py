@@ -0,0 +1,89 @@
+import os
+import sys
+import functools
+
+# Resolves the journal names found in references ("Phys. Rev. B", "Physical
+# review B", "PNAS") to the names to search Crossref for, full title first,
+# and to the journal's ISSNs once they are known. Full titles come from the
+# abbreviation tables (journals/*.csv and journal_abbrev.csv), which are read
+# backwards into a memory-mapped index like the one used for abbreviating
+# (see abbrevindex), and aliases from journal_aliases.txt. The tables don't
+# have ISSNs, so these are learned from the first match found for a journal
+# and kept in the lookup cache; after that, a single query by ISSN replaces
+# trying each of the journal's names in turn.
+
+def normalize_journal_name(name):
+    return ' '.join(name.lower().replace('.', ' ').split())
+
+def load_full_titles(sources):
+    # Maps the normalized full names and abbreviations in the tables to the
+    # full names. Later tables take precedence, as for abbreviating.
+    titles = {}
+    for filename in sources:
+        with open(filename, "r", encoding='utf-8') as f:
+            for line in f.readlines():
+                line = line.rstrip()
+                if ";" in line and line[0] != '#':
+                    split = line.split(";")
+                    name = split[0]
+                    titles[normalize_journal_name(split[1])] = name
+                    titles[normalize_journal_name(name)] = name
+    return titles
+
+@functools.lru_cache(maxsize=None)
+def get_full_titles():
+    import hashlib
+    from imbibe import abbrevindex, journal_abbreviation_sources, user_cache_dir
+
+    sources = journal_abbreviation_sources()
+    key = hashlib.sha1('\0'.join(sources).encode('utf-8')).hexdigest()[0:16]
+    filename = os.path.join(user_cache_dir(), 'journal-titles-' + key + '.idx')
+    try:
+        return abbrevindex.open_index(filename, sources, lambda: load_full_titles(sources))
+    except OSError as e:
+        print("Warning: could not use journal title index " + filename + ": " + str(e),
+                file=sys.stderr)
+        return load_full_titles(sources)
+
+def candidate_titles(journaltitle):
+    # The names to look for the journal under, best first: its full title,
+    # the name as given, then the aliases of either.
+    from imbibe import get_journal_aliases
+
+    names = []
+    for name in (get_full_titles().get(normalize_journal_name(journaltitle)), journaltitle):
+        if name is not None and name not in names:
+            names.append(name)
+    aliases = get_journal_aliases()
+    for name in list(names):
+        for alias in sorted(aliases.get(name.lower(), [])):
+            if alias not in names:
+                names.append(alias)
+    return names
+
+def issn_lookup_key(journaltitle):
+    return 'journal-issns:' + normalize_journal_name(candidate_titles(journaltitle)[0])
+
+def known_issns(journaltitle):
+    from imbibe import get_lookup_cache
+    store = get_lookup_cache()
+    if store is None:
+        return []
+    return store.get(issn_lookup_key(journaltitle)) or []
+
+def learn_issns(journaltitle, match):
+    from imbibe import get_lookup_cache
+    store = get_lookup_cache()
+    issns = match.get('ISSN', [])
+    if store is None or len(issns) == 0:
+        return
+    known = known_issns(journaltitle)
+    if not set(issns) <= set(known):
+        store.put(issn_lookup_key(journaltitle), sorted(set(known) | set(issns)))
+
+def matches_journal(match, names, issns):
+    if len(set(match.get('ISSN', [])) & set(issns)) > 0:
+        return True
+    names = set(normalize_journal_name(name) for name in names)
+    return any(normalize_journal_name(title) in names for field in ('container-title', 'short-container-title')
+               for title in match.get(field, [])[:1])
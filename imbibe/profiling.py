@@ -0,0 +1,146 @@
+import time
+import threading
+import contextlib
+
+# Collects the numbers for --profile: wall time per phase of a run, the number
+# and latency of requests to each backend, cache hits and misses, and bytes
+# read and written. Nothing is collected unless start() has been called, and
+# the module-level functions are then cheap no-ops.
+
+class Profile(object):
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.requests = {}
+        self.request_errors = {}
+        self.counters = {}
+        self.bytes = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.) + elapsed
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_bytes(self, name, n):
+        with self.lock:
+            self.bytes[name] = self.bytes.get(name, 0) + n
+
+    def add_request(self, kind, seconds, error=False):
+        with self.lock:
+            self.requests.setdefault(kind, []).append(seconds)
+            if error:
+                self.request_errors[kind] = self.request_errors.get(kind, 0) + 1
+
+    def report(self):
+        with self.lock:
+            requests = {}
+            for kind,latencies in self.requests.items():
+                latencies = sorted(latencies)
+                requests[kind] = { 'count': len(latencies),
+                                   'errors': self.request_errors.get(kind, 0),
+                                   'total_seconds': sum(latencies),
+                                   'p50_seconds': percentile(latencies, 50),
+                                   'p90_seconds': percentile(latencies, 90),
+                                   'p99_seconds': percentile(latencies, 99),
+                                   'max_seconds': latencies[-1] }
+            return { 'total_seconds': time.perf_counter() - self.start_time,
+                     'phases': dict(self.phases),
+                     'requests': requests,
+                     'counters': dict(self.counters),
+                     'bytes': dict(self.bytes) }
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile.
+    if len(sorted_values) == 0:
+        return None
+    rank = max(1, -(-len(sorted_values)*p // 100))
+    return sorted_values[int(rank) - 1]
+
+def format_report(report):
+    ms = lambda seconds: "%9.1f ms" % (1000*seconds)
+    lines = [ "imbibe profile:", "  wall time" ]
+    for name,seconds in report['phases'].items():
+        lines.append("    %-24s %s" % (name, ms(seconds)))
+    lines.append("    %-24s %s" % ("total", ms(report['total_seconds'])))
+
+    lines.append("  requests")
+    if len(report['requests']) == 0:
+        lines.append("    none")
+    for kind,r in sorted(report['requests'].items()):
+        lines.append("    %-10s %5d (%d errors), p50 %s, p90 %s, p99 %s, max %s" % (kind,
+            r['count'], r['errors'], ms(r['p50_seconds']).strip(), ms(r['p90_seconds']).strip(),
+            ms(r['p99_seconds']).strip(), ms(r['max_seconds']).strip()))
+
+    lines.append("  cache")
+    for name,n in sorted(report['counters'].items()):
+        lines.append("    %-24s %9d" % (name, n))
+
+    lines.append("  bytes")
+    for name,n in sorted(report['bytes'].items()):
+        lines.append("    %-24s %9d" % (name, n))
+    return '\n'.join(lines) + '\n'
+
+class ProfilingBackend(object):
+    # Wraps another backend (see imbibe.backend), timing each request for the
+    # active profile.
+    def __init__(self, backend):
+        self.backend = backend
+
+    def timed(self, kind, call):
+        from imbibe.backend import HTTPError
+        start = time.perf_counter()
+        try:
+            ret = call()
+        except HTTPError:
+            if _active is not None:
+                _active.add_request(kind, time.perf_counter() - start, error=True)
+            raise
+        if _active is not None:
+            _active.add_request(kind, time.perf_counter() - start)
+        return ret
+
+    def crossref_works(self, **kwargs):
+        return self.timed('crossref', lambda: self.backend.crossref_works(**kwargs))
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        return self.timed('arxiv', lambda: self.backend.arxiv_search(query, id_list, max_results))
+
+    def http_get(self, url):
+        return self.timed('http', lambda: self.backend.http_get(url))
+
+    def save(self):
+        self.backend.save()
+
+_active = None
+_no_phase = contextlib.nullcontext()
+
+def start():
+    global _active
+    _active = Profile()
+    return _active
+
+def active():
+    return _active
+
+def phase(name):
+    if _active is None:
+        return _no_phase
+    return _active.phase(name)
+
+def count(name, n=1):
+    if _active is not None:
+        _active.count(name, n)
+
+def add_bytes(name, n):
+    if _active is not None:
+        _active.add_bytes(name, n)
@@ -0,0 +1,59 @@
+# Shared fixtures. The tests run imbibe in this process against the
+# in-process FakeBackend of the benchmark suite, with the user cache
+# directory in a temporary directory, so they need no network access and
+# don't touch the user's caches.
+
+import os
+import sys
+import contextlib
+
+import pytest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+repodir = os.path.dirname(testdir)
+sys.path.insert(0, repodir)
+sys.path.insert(0, os.path.join(repodir, 'benchmarks'))
+
+import imbibe
+from imbibe import backend
+from fakebackend import FakeBackend
+
+# imbibe's messages and progress bars are sent here. It's never closed, since
+# progressbar keeps hold of the stream it first wrote to.
+devnull = open(os.devnull, 'w')
+
+@pytest.fixture(autouse=True)
+def user_cache(tmp_path, monkeypatch):
+    cachedir = tmp_path / 'user-cache'
+    monkeypatch.setenv('IMBIBE_CACHE_DIR', str(cachedir))
+    monkeypatch.setattr(imbibe, '_lookup_cache', None)
+    monkeypatch.setattr(imbibe, 'use_lookup_cache', True)
+    yield cachedir
+    if imbibe._lookup_cache is not None:
+        imbibe._lookup_cache.close()
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeBackend()
+    monkeypatch.setattr(backend, '_backend', fake)
+    return fake
+
+def run_imbibe(argv, directory):
+    # Runs imbibe's main() as if from the command line in `directory`, with
+    # the backend that is currently installed.
+    imbibe.BibItem.cache = None
+    imbibe.BibItem.shared_cache = None
+    olddir = os.getcwd()
+    oldargv = sys.argv
+    os.chdir(str(directory))
+    sys.argv = [ 'imbibe' ] + list(argv)
+    try:
+        with contextlib.redirect_stderr(devnull):
+            imbibe.main()
+    finally:
+        sys.argv = oldargv
+        os.chdir(olddir)
+        if imbibe.BibItem.shared_cache is not None:
+            imbibe.BibItem.shared_cache.close()
+        imbibe.BibItem.cache = None
+        imbibe.BibItem.shared_cache = None
@@ -0,0 +1,60 @@
+import os
+
+from imbibe import abbrevindex
+
+def write_table(filename, table):
+    with open(filename, 'w', encoding='utf-8') as f:
+        for name,abbrev in table.items():
+            f.write(name + ';' + abbrev + '\n')
+
+def read_table(filename):
+    import imbibe
+    return imbibe.load_journal_abbreviations([ filename ])
+
+def test_index_finds_every_entry(tmp_path):
+    source = str(tmp_path / 'journals.csv')
+    table = dict( ('Journal of Things %d' % i, 'J. Things %d' % i) for i in range(2000) )
+    table['Zeitschrift für Physik'] = 'Z. Phys.'
+    # Longer than a 16-bit length field could describe.
+    table['Long ' * 20000] = 'L.'
+    table['Long abbreviation'] = 'L.' * 40000
+    write_table(source, table)
+
+    index = abbrevindex.open_index(str(tmp_path / 'index.idx'), [ source ], lambda: read_table(source))
+    try:
+        for name,abbrev in table.items():
+            assert index[name] == abbrev
+        assert index.get('Journal of Things 2000') is None
+        assert 'Journal of Things' not in index
+    finally:
+        index.close()
+
+def test_index_is_rebuilt_when_a_source_changes(tmp_path):
+    source = str(tmp_path / 'journals.csv')
+    filename = str(tmp_path / 'index.idx')
+    write_table(source, { 'Physical Review B': 'Phys. Rev. B' })
+    abbrevindex.open_index(filename, [ source ], lambda: read_table(source)).close()
+
+    write_table(source, { 'Physical Review B': 'PRB' })
+    index = abbrevindex.open_index(filename, [ source ], lambda: read_table(source))
+    try:
+        assert index['Physical Review B'] == 'PRB'
+    finally:
+        index.close()
+
+def test_index_is_kept_when_only_timestamps_change(tmp_path):
+    source = str(tmp_path / 'journals.csv')
+    filename = str(tmp_path / 'index.idx')
+    write_table(source, { 'Physical Review B': 'Phys. Rev. B' })
+    abbrevindex.open_index(filename, [ source ], lambda: read_table(source)).close()
+    st = os.stat(source)
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def load_table():
+        raise AssertionError("the table shouldn't be read again")
+    index = abbrevindex.open_index(filename, [ source ], load_table)
+    try:
+        assert index['Physical Review B'] == 'Phys. Rev. B'
+        assert abbrevindex.index_is_current(filename, [ source ])[0]
+    finally:
+        index.close()
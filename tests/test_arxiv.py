@@ -0,0 +1,73 @@
+import pytest
+
+import imbibe
+from imbibe import backend
+from fakebackend import FakeBackend
+
+class PickyBackend(FakeBackend):
+    # Like arXiv: IDs that don't exist are left out of the results, and a
+    # query with a malformed ID is rejected as a whole.
+    def __init__(self, nonexistent=(), malformed=()):
+        FakeBackend.__init__(self)
+        self.nonexistent = set(nonexistent)
+        self.malformed = set(malformed)
+
+    def arxiv_search(self, query=None, id_list=None, max_results=10):
+        if len(self.malformed & set(id_list or [])) > 0:
+            self.count('arxiv')
+            raise backend.HTTPError('https://export.arxiv.org/api/query', 400)
+        return [ result for result in FakeBackend.arxiv_search(self, query, id_list, max_results)
+                 if result['id'].split('/abs/')[1][:-2] not in self.nonexistent ]
+
+def search(arxiv_ids, chunk_size=100):
+    missing = []
+    records = {}
+    for chunk in imbibe.iter_arxiv_records(arxiv_ids, chunk_size, missing):
+        records.update(chunk)
+    return records, missing
+
+arxiv_ids = [ '1801.%05d' % i for i in range(64) ]
+
+def test_found_ids_take_one_query(monkeypatch):
+    fake = PickyBackend()
+    monkeypatch.setattr(backend, '_backend', fake)
+    records, missing = search(arxiv_ids)
+    assert sorted(records) == arxiv_ids and missing == []
+    assert fake.requests['arxiv'] == 1
+
+def test_nonexistent_ids_are_found_without_trying_every_id(monkeypatch):
+    fake = PickyBackend(nonexistent=[ arxiv_ids[3], arxiv_ids[40] ])
+    monkeypatch.setattr(backend, '_backend', fake)
+    records, missing = search(arxiv_ids)
+    assert sorted(missing) == [ arxiv_ids[3], arxiv_ids[40] ]
+    assert len(records) == 62
+    # The first query finds everything else, the second asks for just the
+    # two left over, and then each is tried on its own.
+    assert fake.requests['arxiv'] == 4
+
+def test_malformed_ids_are_found_by_bisection(monkeypatch):
+    fake = PickyBackend(malformed=[ arxiv_ids[5], arxiv_ids[50] ])
+    monkeypatch.setattr(backend, '_backend', fake)
+    records, missing = search(arxiv_ids)
+    assert sorted(missing) == [ arxiv_ids[5], arxiv_ids[50] ]
+    assert len(records) == 62
+    # Two bad IDs out of 64 cost at most 2*log2(64) queries on top of the first.
+    assert fake.requests['arxiv'] <= 1 + 2*6*2
+
+def test_ids_are_looked_up_in_chunks(monkeypatch):
+    fake = PickyBackend()
+    monkeypatch.setattr(backend, '_backend', fake)
+    records, missing = search(arxiv_ids, chunk_size=10)
+    assert len(records) == 64
+    assert fake.requests['arxiv'] == 7
+
+def test_missing_ids_keep_the_records_found(monkeypatch):
+    fake = PickyBackend(nonexistent=[ '1801.00001' ])
+    monkeypatch.setattr(backend, '_backend', fake)
+    bibitems = [ imbibe.BibItem(arxivid=arxivid) for arxivid in [ '1801.00000', '1801.00001' ] ]
+    monkeypatch.setattr(imbibe.BibItem, 'cache', None)
+    with pytest.raises(imbibe.ArxivIDNotFoundError) as e:
+        imbibe.populate_arxiv_information(bibitems)
+    assert e.value.missing_ids == [ '1801.00001' ]
+    assert list(e.value.records) == [ '1801.00000' ]
+    assert bibitems[0].arxiv_populated and not bibitems[1].arxiv_populated
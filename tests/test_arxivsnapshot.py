@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from imbibe import arxivsnapshot
+from fakebackend import FakeBackend
+
+paper = { 'id': '1801.00001', 'title': 'Topological  phases\n of matter', 'abstract': ' Abstract. ',
+          'doi': '10.5555/Snapshot.1', 'authors_parsed': [ [ 'Kitaev', 'Alexei', '' ] ],
+          'versions': [ { 'version': 'v1' }, { 'version': 'v2' } ] }
+
+def test_index_answers_lookups_by_id_doi_and_title(tmp_path):
+    snapshot = tmp_path / 'snapshot.json'
+    snapshot.write_text(json.dumps(paper) + '\n\n', encoding='utf-8')
+    index = str(tmp_path / 'index.sqlite')
+    assert arxivsnapshot.ingest(str(snapshot), index) == 1
+
+    fake = FakeBackend()
+    snapshot_backend = arxivsnapshot.ArxivSnapshotBackend(index, fake)
+    [ result ] = snapshot_backend.arxiv_search(id_list=[ '1801.00001' ])
+    assert result['id'] == 'http://arxiv.org/abs/1801.00001v2'
+    assert result['authors'] == [ 'Alexei Kitaev' ]
+    assert result['title'] == 'Topological phases of matter'
+    assert snapshot_backend.arxiv_search(query='10.5555/snapshot.1')[0]['id'] == result['id']
+    assert len(snapshot_backend.arxiv_search(query='Topological phases of matter')) == 1
+    assert fake.requests['arxiv'] == 0
+
+    # Papers newer than the snapshot are looked up in the other backend.
+    assert len(snapshot_backend.arxiv_search(id_list=[ '1801.00001', '1801.00002' ], max_results=2)) == 2
+    assert fake.requests['arxiv'] == 1
+
+def test_failed_ingest_leaves_no_files(tmp_path):
+    snapshot = tmp_path / 'snapshot.json'
+    snapshot.write_text(json.dumps(paper) + '\n{ not json\n', encoding='utf-8')
+    with pytest.raises(ValueError):
+        arxivsnapshot.ingest(str(snapshot), str(tmp_path / 'index' / 'index.sqlite'))
+    assert list((tmp_path / 'index').iterdir()) == []
@@ -0,0 +1,42 @@
+import json
+
+from imbibe import cache
+
+from conftest import run_imbibe
+
+def write_project(directory, lines):
+    directory.mkdir()
+    (directory / 'refs.txt').write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+def test_batch_looks_up_shared_papers_once(tmp_path, fake):
+    write_project(tmp_path / 'p1', [ '1801.00001', '1801.00002' ])
+    write_project(tmp_path / 'p2', [ '1801.00002', '1801.00003' ])
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps([ { 'input': 'p1/refs.txt', 'output': 'p1/refs.bib' },
+                                     { 'input': 'p2/refs.txt', 'output': 'p2/refs.bib' } ]))
+
+    run_imbibe([ '--no-shared-cache', '--batch', str(manifest) ], tmp_path)
+
+    assert fake.requests['arxiv'] == 1
+    for project in ('p1', 'p2'):
+        assert (tmp_path / project / 'refs.bib').read_text(encoding='utf-8').count('@') == 2
+
+def test_batch_keeps_records_borrowed_from_compacted_caches(tmp_path, fake, monkeypatch):
+    # p1 has the record of a paper that it no longer cites, and that is old
+    # enough to be compacted away. p2 cites the paper and takes the record
+    # from p1's cache, so it must end up in p2's own cache.
+    write_project(tmp_path / 'p1', [ '1801.00001' ])
+    run_imbibe([ '--no-shared-cache', 'refs.txt', 'refs.bib' ], tmp_path / 'p1')
+    (tmp_path / 'p1' / 'refs.txt').write_text('1801.00002\n', encoding='utf-8')
+    write_project(tmp_path / 'p2', [ '1801.00001' ])
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps([ { 'input': 'p1/refs.txt', 'output': 'p1/refs.bib' },
+                                     { 'input': 'p2/refs.txt', 'output': 'p2/refs.bib' } ]))
+
+    day = cache.today()
+    monkeypatch.setattr(cache, 'today', lambda: day + 200)
+    run_imbibe([ '--no-shared-cache', '--cache-max-age', '180', '--batch', str(manifest) ], tmp_path)
+
+    before = dict(fake.requests)
+    run_imbibe([ '--no-shared-cache', 'refs.txt', 'refs.bib' ], tmp_path / 'p2')
+    assert fake.requests == before
@@ -0,0 +1,197 @@
+import json
+
+import pytest
+
+from imbibe import cache
+
+# Keys that need escaping in JSON, or aren't ASCII.
+awkward_keys = [ 'arXiv:1801.00001', 'doi:10.1000/"quoted"', 'line \\ with "backslashes\\"',
+                 'line": {"looks like": "a value', 'Schrödinger', 'tab\tand\nnewline' ]
+
+def open_json(filename):
+    return cache.JsonCacheStore(str(filename))
+
+@pytest.fixture
+def day(monkeypatch):
+    # The day cache entries are used on, which the tests can move forward.
+    day = [ cache.today() ]
+    monkeypatch.setattr(cache, 'today', lambda: day[0])
+    return day
+
+def test_json_store_reads_back_what_it_saved(tmp_path):
+    filename = tmp_path / 'imbibe-cache.json'
+    store = open_json(filename)
+    assert store.is_new
+    for i,key in enumerate(awkward_keys):
+        store.put(key, { 'n': i, 'value': [ key ] })
+    store.set_meta('schema', '3')
+    store.save()
+    store.close()
+
+    store = open_json(filename)
+    assert store.offsets is not None and len(store.entries) == 0
+    assert sorted(store.keys()) == sorted(awkward_keys)
+    for i,key in enumerate(awkward_keys):
+        assert store.get(key) == { 'n': i, 'value': [ key ] }
+    assert store.get_meta('schema') == '3'
+    assert store.get('missing') is None
+    assert json.loads(filename.read_text(encoding='utf-8'))[awkward_keys[1]]['n'] == 1
+
+def test_json_store_copies_unchanged_entries(tmp_path):
+    filename = tmp_path / 'imbibe-cache.json'
+    store = open_json(filename)
+    for i,key in enumerate(awkward_keys):
+        store.put(key, i)
+    store.save()
+    store.close()
+
+    store = open_json(filename)
+    store.put(awkward_keys[0], 'changed')
+    store.delete(awkward_keys[1])
+    store.save()
+    store.close()
+
+    store = open_json(filename)
+    assert store.get(awkward_keys[0]) == 'changed'
+    assert store.get(awkward_keys[1]) is None
+    assert [ store.get(key) for key in awkward_keys[2:] ] == list(range(2, len(awkward_keys)))
+
+def test_json_store_reads_files_of_older_versions(tmp_path):
+    filename = tmp_path / 'imbibe-cache.json'
+    filename.write_text(json.dumps({ 'arXiv:1801.00001': { 'title': 'T' } }, indent=2))
+    store = open_json(filename)
+    assert store.get('arXiv:1801.00001') == { 'title': 'T' }
+    store.put('arXiv:1801.00002', { 'title': 'U' })
+    store.save()
+    assert open_json(filename).get('arXiv:1801.00001') == { 'title': 'T' }
+
+def test_json_store_merges_concurrent_saves(tmp_path):
+    filename = tmp_path / 'imbibe-cache.json'
+    store = open_json(filename)
+    store.put('a', 1)
+    store.put('b', 2)
+    store.save()
+
+    first = open_json(filename)
+    second = open_json(filename)
+    first.put('c', 3)
+    first.delete('a')
+    first.save()
+    second.put('d', 4)
+    second.put('b', 'second')
+    second.save()
+
+    store = open_json(filename)
+    assert dict( (key, store.get(key)) for key in store.keys() ) == { 'b': 'second', 'c': 3, 'd': 4 }
+
+@pytest.mark.parametrize('backend', [ 'json', 'sqlite' ])
+def test_compact_drops_entries_unused_for_too_long(tmp_path, day, backend):
+    filename = str(tmp_path / ('imbibe-cache.' + backend))
+    store = cache.open_store(filename, backend)
+    store.put('old', 1)
+    store.put('used', 2)
+    store.save()
+    store.close()
+
+    day[0] += 100
+    store = cache.open_store(filename, backend)
+    assert store.get('used') == 2
+    store.save()
+    store.close()
+
+    day[0] += 100
+    store = cache.open_store(filename, backend)
+    assert store.compact(180) == 1
+    store.close()
+    store = cache.open_store(filename, backend)
+    assert sorted(store.keys()) == [ 'used' ]
+    store.close()
+
+def test_compact_keeps_entries_used_by_other_processes(tmp_path, day):
+    filename = tmp_path / 'imbibe-cache.json'
+    store = open_json(filename)
+    store.put('a', 1)
+    store.save()
+
+    day[0] += 200
+    stale = open_json(filename)
+    other = open_json(filename)
+    assert other.get('a') == 1
+    other.save()
+    assert stale.compact(180) == 0
+    assert open_json(filename).get('a') == 1
+
+def test_peek_does_not_count_as_use(tmp_path, day):
+    filename = tmp_path / 'imbibe-cache.json'
+    store = open_json(filename)
+    store.put('a', 1)
+    store.save()
+
+    day[0] += 200
+    store = open_json(filename)
+    assert store.peek('a') == 1
+    assert store.compact(180) == 1
+
+def test_sqlite_store_only_writes_changed_entries(tmp_path):
+    filename = str(tmp_path / 'imbibe-cache.sqlite')
+    store = cache.SqliteCacheStore(filename)
+    assert store.is_new
+    store.put('a', { 'title': 'A' })
+    store.put('b', { 'title': 'B' })
+    store.save()
+    store.close()
+
+    store = cache.SqliteCacheStore(filename)
+    assert not store.is_new
+    store.put('a', store.get('a'))
+    store.put('b', { 'title': 'changed' })
+    assert store.get('b') == { 'title': 'changed' }
+    store.save()
+    assert store.bytes_written == len(json.dumps({ 'title': 'changed' }))
+    assert store.get('b') == { 'title': 'changed' }
+    store.delete('a')
+    assert store.get('a') is None
+    store.save()
+    store.close()
+
+    store = cache.SqliteCacheStore(filename)
+    assert store.keys() == [ 'b' ]
+    store.close()
+
+def test_sqlite_store_adds_last_used_days_to_old_databases(tmp_path):
+    import sqlite3
+    filename = str(tmp_path / 'imbibe-cache.sqlite')
+    conn = sqlite3.connect(filename)
+    conn.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.execute("INSERT INTO entries (key, value) VALUES ('a', '1')")
+    conn.commit()
+    conn.close()
+
+    store = cache.SqliteCacheStore(filename)
+    assert store.get('a') == 1
+    store.save()
+    assert store.compact(180) == 0
+    store.close()
+
+def test_sqlite_cache_imports_json_cache_once(tmp_path, monkeypatch):
+    import imbibe
+    legacy = tmp_path / 'imbibe-cache.json'
+    legacy.write_text(json.dumps({ '__meta__': { 'schema': imbibe.CACHE_SCHEMA },
+                                   '__used__': { 'arXiv:1801.00001': cache.today() },
+                                   'arXiv:1801.00001': { 'title': 'T', 'authors': [], 'doi': None,
+                                                         'abstract': None } }))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(imbibe.BibItem, 'use_shared_cache', False)
+    try:
+        imbibe.BibItem.load_cache('imbibe-cache.sqlite', 'sqlite')
+        assert imbibe.BibItem.cache.get('arXiv:1801.00001')['title'] == 'T'
+        assert imbibe.BibItem.cache.get_meta('migrated_from') == str(legacy)
+        imbibe.BibItem.cache.close()
+
+        # Once the database exists, the JSON file is left alone.
+        legacy.write_text(legacy.read_text().replace('"T"', '"U"'))
+        imbibe.BibItem.load_cache('imbibe-cache.sqlite', 'sqlite')
+        assert imbibe.BibItem.cache.get('arXiv:1801.00001')['title'] == 'T'
+        imbibe.BibItem.cache.close()
+    finally:
+        imbibe.BibItem.cache = None
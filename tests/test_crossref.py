@@ -0,0 +1,63 @@
+import json
+import threading
+import http.server
+
+import pytest
+
+import imbibe
+from imbibe import backend
+
+@pytest.fixture
+def crossref_server(monkeypatch):
+    # A local stand-in for api.crossref.org, reached through habanero, that
+    # rejects every multi-DOI filter query with a plain-text HTTP 400 and
+    # answers single-DOI lookups.
+    habanero = pytest.importorskip('habanero')
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if self.path.startswith('/works/'):
+                doi = self.path[len('/works/'):]
+                body = json.dumps({ 'status': 'ok', 'message-type': 'work',
+                                    'message': { 'DOI': doi } }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+            else:
+                body = b'Bad filter'
+                self.send_response(400)
+                self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://127.0.0.1:' + str(server.server_address[1])
+    monkeypatch.setattr(backend, 'crossref_client', lambda: habanero.Crossref(base_url=base_url))
+    monkeypatch.setattr(backend, '_backend', backend.LiveBackend())
+    yield requests
+    server.shutdown()
+    server.server_close()
+
+def test_live_backend_reports_plain_text_errors(crossref_server):
+    with pytest.raises(backend.HTTPError) as e:
+        backend.get_backend().crossref_works(filter={ 'doi': [ '10.1/a', '10.1/b' ] }, limit=2)
+    assert e.value.status == 400
+
+def test_rejected_batch_is_looked_up_one_by_one(crossref_server):
+    dois = [ '10.1/a', '10.1/b', '10.1/c' ]
+    results = imbibe.crossref_read(dois, workers=1, rate=0., batch_size=2)
+    assert [ result['message']['DOI'] for result in results ] == dois
+    assert len([ path for path in crossref_server if path.startswith('/works/') ]) == 3
+
+def test_batches_are_merged(fake):
+    dois = [ '10.5555/x.%d' % i for i in range(5) ] + [ '10.5555/X.0' ]
+    results = imbibe.crossref_read(dois, workers=2, rate=0., batch_size=2)
+    assert [ result['message']['DOI'].lower() for result in results ] == [ doi.lower() for doi in dois ]
+    assert fake.requests['crossref'] == 3
@@ -0,0 +1,133 @@
+import threading
+
+import pytest
+
+import imbibe
+from imbibe import backend, daemon
+from fakebackend import FakeBackend
+
+class BlockingFetch(object):
+    # A fetch function for Coalescer.get_many() that waits until released,
+    # then returns a value for every key or raises `error`.
+    def __init__(self, error=None):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.error = error
+        self.calls = []
+
+    def __call__(self, keys):
+        self.calls.append(list(keys))
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return dict( (key, key.upper()) for key in keys )
+
+def in_thread(fn):
+    result = {}
+    def run():
+        try:
+            result['value'] = fn()
+        except BaseException as e:
+            result['error'] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+def test_coalescer_merges_concurrent_lookups():
+    coalescer = daemon.Coalescer(60)
+    fetch = BlockingFetch()
+    first, first_result = in_thread(lambda: coalescer.get_many([ 'a', 'b' ], fetch))
+    fetch.started.wait(5)
+    second, second_result = in_thread(lambda: coalescer.get_many([ 'b', 'c' ], fetch))
+    fetch.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert first_result['value'] == { 'a': 'A', 'b': 'B' }
+    assert second_result['value'] == { 'b': 'B', 'c': 'C' }
+    assert sorted(map(sorted, fetch.calls)) == [ [ 'a', 'b' ], [ 'c' ] ]
+    assert coalescer.get_many([ 'a', 'c' ], fetch) == { 'a': 'A', 'c': 'C' }
+    assert len(fetch.calls) == 2
+
+def test_coalescer_passes_errors_on_without_keeping_them():
+    coalescer = daemon.Coalescer(60)
+    fetch = BlockingFetch(backend.HTTPError('https://export.arxiv.org/api/query', 400))
+    fetch.release.set()
+    with pytest.raises(backend.HTTPError):
+        coalescer.get_many([ 'a', 'b' ], fetch)
+    assert len(fetch.calls) == 1
+
+    fetch.error = None
+    assert coalescer.get_many([ 'a' ], fetch) == { 'a': 'A' }
+
+def test_coalescer_lets_waiters_go_when_a_lookup_is_interrupted():
+    coalescer = daemon.Coalescer(60)
+    fetch = BlockingFetch(KeyboardInterrupt())
+    first, first_result = in_thread(lambda: coalescer.get_many([ 'a' ], fetch))
+    fetch.started.wait(5)
+    second, second_result = in_thread(lambda: coalescer.get_many([ 'a' ], fetch))
+    fetch.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert not second.is_alive()
+    assert isinstance(first_result['error'], KeyboardInterrupt)
+    assert isinstance(second_result['error'], RuntimeError)
+    assert coalescer.pending == {}
+
+@pytest.fixture
+def daemon_backend(monkeypatch):
+    # A daemon serving from one FakeBackend, and a client of it that falls
+    # back to another one.
+    upstream = FakeBackend()
+    resolver = daemon.Resolver(upstream)
+    server = daemon.make_server(resolver, 'token')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    direct = FakeBackend()
+    client = daemon.DaemonBackend('127.0.0.1', server.server_address[1], 'token', direct)
+    monkeypatch.setattr(backend, '_backend', client)
+    yield client, upstream, direct
+    server.shutdown()
+    server.server_close()
+
+def test_daemon_answers_batched_lookups_once(daemon_backend):
+    client, upstream, direct = daemon_backend
+    arxiv_ids = [ '1801.%05d' % i for i in range(4) ]
+    first = client.arxiv_search(id_list=arxiv_ids, max_results=4)
+    second = client.arxiv_search(id_list=arxiv_ids[2:], max_results=2)
+    assert sorted(result['id'] for result in first) == sorted(
+        'http://arxiv.org/abs/' + arxivid + 'v1' for arxivid in arxiv_ids)
+    assert len(second) == 2
+    assert upstream.requests['arxiv'] == 1
+    assert direct.requests['arxiv'] == 0
+
+def test_daemon_client_fetches_rejected_requests_directly(daemon_backend):
+    client, upstream, direct = daemon_backend
+    assert client.http_get('https://example.com/') == ('https://example.com/', b'')
+    assert upstream.requests['http'] == 0
+    assert direct.requests['http'] == 1
+    assert not client.failed
+
+def test_rejected_batches_are_bisected_by_the_client(daemon_backend, monkeypatch):
+    # arXiv rejects a whole query if one of its IDs is malformed. The
+    # daemon passes the error on, and the client finds the bad ID.
+    client, upstream, direct = daemon_backend
+    search = upstream.arxiv_search
+    def arxiv_search(query=None, id_list=None, max_results=10):
+        if 'bad' in (id_list or []):
+            upstream.count('arxiv')
+            raise backend.HTTPError('https://export.arxiv.org/api/query', 400)
+        return search(query, id_list, max_results)
+    monkeypatch.setattr(upstream, 'arxiv_search', arxiv_search)
+
+    arxiv_ids = [ '1801.%05d' % i for i in range(7) ] + [ 'bad' ]
+    missing = []
+    records = {}
+    for chunk in imbibe.iter_arxiv_records(arxiv_ids, missing=missing):
+        records.update(chunk)
+    assert missing == [ 'bad' ]
+    assert sorted(records) == sorted(arxiv_ids[:-1])
+    assert upstream.requests['arxiv'] <= 2 * 3 + 1
+    assert direct.requests['arxiv'] == 0
@@ -0,0 +1,42 @@
+import imbibe
+from imbibe import backend, journalnames
+
+class JournalBackend(object):
+    # Answers Crossref's journal searches from a fixed list of items.
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+
+    def crossref_works(self, filter=None, **kwargs):
+        self.queries.append(dict(filter))
+        if 'issn' in filter:
+            items = [ item for item in self.items if set(item['ISSN']) & set(filter['issn']) ]
+        else:
+            items = [ item for item in self.items if filter.get('container-title') in item['container-title'] ]
+        return { 'message': { 'items': items } }
+
+    def save(self):
+        pass
+
+item = { 'DOI': '10.1103/PhysRevB.61.1', 'ISSN': [ '2469-9950', '2469-9969' ],
+         'container-title': [ 'Physical Review B' ], 'issued': { 'date-parts': [ [ 2000 ] ] },
+         'volume': '61', 'article-number': '1' }
+
+def test_journal_is_searched_by_learned_issn(monkeypatch):
+    fake = JournalBackend([ item ])
+    monkeypatch.setattr(backend, '_backend', fake)
+    journalnames.learn_issns('Physical Review B', item)
+
+    assert imbibe.crossref_find_from_journalref('Physical Review B', '61', '1', '2000') == item
+    assert [ 'issn' in query for query in fake.queries ] == [ True ]
+
+def test_incomplete_learned_issns_fall_back_to_names(monkeypatch):
+    # Only the print ISSN was learned, but Crossref only has the electronic
+    # one for this paper.
+    fake = JournalBackend([ dict(item, ISSN=[ '2469-9969' ]) ])
+    monkeypatch.setattr(backend, '_backend', fake)
+    journalnames.learn_issns('Physical Review B', { 'ISSN': [ '2469-9950' ] })
+
+    assert imbibe.crossref_find_from_journalref('Physical Review B', '61', '1', '2000')['DOI'] == item['DOI']
+    assert 'container-title' in fake.queries[-1]
+    assert journalnames.known_issns('Physical Review B') == [ '2469-9950', '2469-9969' ]